@@ -0,0 +1,184 @@
+import json
+import logging
+import os
+import threading
+from collections import deque
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking, single process only
+    fcntl = None
+
+
+class AccountPool:
+    """Warm pool of pre-created mail.tm accounts
+
+    Creating a mail.tm account takes an upstream round-trip and has to be
+    spaced out to stay under the rate limit, so doing it inside a request
+    blocks a worker for seconds. The pool keeps up to ``size`` accounts
+    ready. A background thread refills it, at most one account every
+    ``refill_interval`` seconds, whenever it drops to ``low_water``. A
+    request then only has to ``take()`` one.
+
+    With ``path`` set the accounts live in that JSON file instead of in
+    process memory. They survive restarts, and every worker process takes
+    from the same pool under a file lock. Every process runs the refill
+    thread, but only the one holding ``<path>.refill.lock`` refills.
+    Refills are paced here by ``refill_interval``, not by the service, so
+    a request creating an account after a miss never waits behind them.
+    """
+
+    def __init__(self, service, size=10, low_water=3, refill_interval=5, path=None):
+        self.service = service
+        self.size = size
+        self.low_water = min(low_water, size)
+        self.refill_interval = refill_interval
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.failures = 0
+        self._accounts = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._refill_fd = None
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    def _locked(self):
+        """Take the pool file lock; returns the fd to close, or None"""
+        if self.path is None or fcntl is None:
+            return None
+        lock_fd = os.open(f'{self.path}.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        return lock_fd
+
+    def _load(self):
+        if self.path is None:
+            return self._accounts
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return deque(json.load(f))
+        except FileNotFoundError:
+            return deque()
+        except Exception as e:
+            logging.error(f"Error reading account pool {self.path}: {e}")
+            return deque()
+
+    def _save(self, accounts):
+        if self.path is None:
+            return
+        # The file holds account passwords, so keep it private
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(list(accounts), f)
+        os.replace(tmp_path, self.path)
+
+    def _update(self, change):
+        """Run ``change(accounts)`` on the stored accounts and save them"""
+        with self._lock:
+            lock_fd = self._locked()
+            try:
+                accounts = self._load()
+                result = change(accounts)
+                self._save(accounts)
+                return result, len(accounts)
+            finally:
+                if lock_fd is not None:
+                    os.close(lock_fd)
+
+    def take(self):
+        """Return a ready account dict, or None if the pool is empty"""
+        try:
+            account, depth = self._update(lambda accounts: accounts.popleft() if accounts else None)
+        except Exception as e:
+            logging.error(f"Error taking account from pool: {e}")
+            account, depth = None, 0
+        with self._lock:
+            if account is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if depth <= self.low_water:
+            self._wakeup.set()
+        if account is None:
+            logging.warning("Account pool empty, creating mail.tm account in request")
+        return account
+
+    def depth(self):
+        if self.path is None:
+            return len(self._accounts)
+        with self._lock:
+            lock_fd = self._locked()
+            try:
+                return len(self._load())
+            finally:
+                if lock_fd is not None:
+                    os.close(lock_fd)
+
+    def _try_lead(self):
+        """Take the refill lock file without blocking; True once this process holds it"""
+        if self.path is None or fcntl is None:
+            return True
+        if self._refill_fd is None:
+            self._refill_fd = os.open(f'{self.path}.refill.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self._refill_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+    def _refill(self):
+        """Create accounts until the pool is full, pacing creations"""
+        while self.depth() < self.size and not self._stop.is_set():
+            account = self.service.provision_account(paced=False)
+            if account:
+                self._update(lambda accounts: accounts.append(account))
+            with self._lock:
+                if account:
+                    self.created += 1
+                else:
+                    self.failures += 1
+            if self._stop.wait(self.refill_interval):
+                return
+
+    def _run(self):
+        # Takes in other processes cannot wake this thread, so a shared
+        # pool is checked every refill_interval instead
+        idle = self.refill_interval if self.path else self.refill_interval * 12
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            try:
+                if self._try_lead() and self.depth() <= self.low_water:
+                    self._refill()
+            except Exception as e:
+                logging.error(f"Error refilling account pool: {e}")
+            self._wakeup.wait(idle)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name='account-pool', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def stats(self):
+        depth = self.depth()
+        with self._lock:
+            return {
+                'depth': depth,
+                'size': self.size,
+                'low_water': self.low_water,
+                'hits': self.hits,
+                'misses': self.misses,
+                'created': self.created,
+                'failures': self.failures
+            }
@@ -1,73 +1,94 @@
 import os
 import logging
-from flask import Flask
+import time
+from flask import Flask, g, request
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_mail import Mail
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'DEBUG').upper())
 
 # In-memory storage for emails and messages with persistence using session
 import pickle
 import json
+from store import InboxStore, MessageStore
+from email_utils import rendered_content_cache
 
-# In-memory storage for emails and messages
-temp_emails = {}
-email_messages = {}
+# Storage for emails and messages: per-process memory (persisted through the
+# journal below) or one SQLite database shared by all workers on the host
+STORE_BACKEND = os.environ.get('STORE_BACKEND', 'memory').lower()
+MAX_MESSAGES_PER_INBOX = int(os.environ.get('MAX_MESSAGES_PER_INBOX', 200))
+if STORE_BACKEND == 'sqlite':
+    from sqlite_store import SQLiteDatabase, SQLiteInboxStore, SQLiteMessageStore
+    store_db = SQLiteDatabase(os.environ.get('SQLITE_PATH', 'instance/store.db'))
+    temp_emails = SQLiteInboxStore(
+        store_db, max_objects=int(os.environ.get('SQLITE_INBOX_CACHE_SIZE', 10000))
+    )
+    email_messages = SQLiteMessageStore(store_db, max_per_inbox=MAX_MESSAGES_PER_INBOX,
+                                        rendered_cache=rendered_content_cache)
+else:
+    # Message bodies beyond the memory budget are compressed and spilled to disk
+    from body_budget import BodyBudget
+    MESSAGE_MEMORY_BUDGET_MB = float(os.environ.get('MESSAGE_MEMORY_BUDGET_MB', 256))
+    body_budget = None
+    if MESSAGE_MEMORY_BUDGET_MB > 0:
+        body_budget = BodyBudget(
+            int(MESSAGE_MEMORY_BUDGET_MB * 1024 * 1024),
+            compress_threshold=int(os.environ.get('MESSAGE_COMPRESS_THRESHOLD', 4096)),
+            spill_dir=os.environ.get('MESSAGE_SPILL_DIR') or None
+        )
+    temp_emails = InboxStore()
+    email_messages = MessageStore(max_per_inbox=MAX_MESSAGES_PER_INBOX, budget=body_budget,
+                                  rendered_cache=rendered_content_cache)
 
-# File-based persistence for critical data
+# File-based persistence: every store change is appended to a journal in
+# JOURNAL_DIR; temp_emails.json is the pre-journal cache, imported once
 EMAILS_CACHE_FILE = 'temp_emails.json'
-MESSAGES_CACHE_FILE = 'temp_messages.json'
 
-def save_emails_to_cache():
-    """Save emails to cache file"""
+def load_emails_from_cache():
+    """Replay the journal snapshot and segments into the stores, then start journaling"""
     try:
-        cache_data = {}
-        for email_id, email in temp_emails.items():
-            if hasattr(email, '__dict__'):
-                cache_data[email_id] = {
-                    'id': email.id,
-                    'email_address': email.email_address,
-                    'session_id': email.session_id,
-                    'is_active': email.is_active,
-                    'mail_tm_id': getattr(email, 'mail_tm_id', None),
-                    'mail_tm_password': getattr(email, 'mail_tm_password', None),
-                    'created_at': email.created_at.isoformat() if hasattr(email, 'created_at') else None
-                }
-        
-        with open(EMAILS_CACHE_FILE, 'w') as f:
-            json.dump(cache_data, f)
+        inboxes, messages = journal.load(temp_emails, email_messages)
+        logging.info(f"Restored {inboxes} emails and {messages} messages from journal")
     except Exception as e:
-        logging.error(f"Error saving emails cache: {e}")
+        logging.error(f"Error loading journal: {e}")
+    
+    temp_emails.journal = journal
+    email_messages.journal = journal
+    
+    if os.path.exists(EMAILS_CACHE_FILE):
+        import_legacy_cache()
 
-def load_emails_from_cache():
-    """Load emails from cache file"""
+def import_legacy_cache():
+    """Move inboxes from the old temp_emails.json cache into the store"""
     try:
-        if os.path.exists(EMAILS_CACHE_FILE):
-            with open(EMAILS_CACHE_FILE, 'r') as f:
-                cache_data = json.load(f)
-            
-            from models import TempEmail
-            from datetime import datetime
-            
-            for email_id, data in cache_data.items():
-                if email_id not in temp_emails:
-                    # Recreate TempEmail object
-                    email = TempEmail(session_id=data['session_id'], use_real_email=True)
-                    email.id = data['id']
-                    email.email_address = data['email_address']
-                    email.is_active = data['is_active']
-                    email.mail_tm_id = data['mail_tm_id']
-                    email.mail_tm_password = data['mail_tm_password']
-                    if data['created_at']:
-                        email.created_at = datetime.fromisoformat(data['created_at'])
-                    
-                    temp_emails[email_id] = email
-                    
+        with open(EMAILS_CACHE_FILE, 'r') as f:
+            cache_data = json.load(f)
+        
+        from models import TempEmail
+        from datetime import datetime, timedelta
+        
+        for email_id, data in cache_data.items():
+            if email_id not in temp_emails:
+                # Recreate TempEmail object
+                email = TempEmail(session_id=data['session_id'], use_real_email=True)
+                email.id = data['id']
+                email.email_address = data['email_address']
+                email.is_active = data['is_active']
+                email.mail_tm_id = data['mail_tm_id']
+                email.mail_tm_password = data['mail_tm_password']
+                if data['created_at']:
+                    email.created_at = datetime.fromisoformat(data['created_at'])
+                # The old cache did not keep expiry times
+                email.expires_at = email.created_at + timedelta(hours=24)
+                
+                temp_emails[email_id] = email
+        
+        os.replace(EMAILS_CACHE_FILE, f'{EMAILS_CACHE_FILE}.imported')
     except Exception as e:
-        logging.error(f"Error loading emails cache: {e}")
+        logging.error(f"Error importing emails cache: {e}")
 
 mail = Mail()
 
@@ -124,14 +145,154 @@ limiter = Limiter(
 )
 
 # Initialize extensions
+app.config['RATELIMIT_ENABLED'] = os.environ.get('RATELIMIT_ENABLED', 'True').lower() == 'true'
 mail.init_app(app)
 limiter.init_app(app)
 
-# Load emails from cache on startup
-load_emails_from_cache()
+# Load emails from the journal on startup and compact it in the background;
+# the SQLite store persists by itself
+from journal import Journal
+journal = None
+if STORE_BACKEND != 'sqlite':
+    journal = Journal(
+        os.environ.get('JOURNAL_DIR', 'data'),
+        compact_interval=float(os.environ.get('JOURNAL_COMPACT_INTERVAL', 300))
+    )
+    load_emails_from_cache()
+    journal.start()
+elif os.path.exists(EMAILS_CACHE_FILE):
+    import_legacy_cache()
+
+# Remove expired emails in the background instead of on every request
+from expiry import ExpiryReaper
+expiry_reaper = ExpiryReaper(
+    temp_emails,
+    email_messages,
+    interval=float(os.environ.get('EXPIRY_REAP_INTERVAL', 30)),
+    batch_size=int(os.environ.get('EXPIRY_REAP_BATCH_SIZE', 500))
+)
+expiry_reaper.start()
+
+# Keep pre-created mail.tm accounts ready so inbox creation never waits upstream
+from account_pool import AccountPool
+from mail_tm_service import mail_tm_service
+# Accounts are kept in ACCOUNT_POOL_PATH, shared by all workers and kept
+# across restarts; one worker at a time refills it
+ACCOUNT_POOL_SIZE = int(os.environ.get('ACCOUNT_POOL_SIZE', 10))
+if ACCOUNT_POOL_SIZE > 0:
+    mail_tm_service.account_pool = AccountPool(
+        mail_tm_service,
+        size=ACCOUNT_POOL_SIZE,
+        low_water=int(os.environ.get('ACCOUNT_POOL_LOW_WATER', 3)),
+        refill_interval=float(os.environ.get('ACCOUNT_POOL_REFILL_INTERVAL', 5)),
+        path=os.environ.get('ACCOUNT_POOL_PATH', 'instance/account_pool.json')
+    )
+    mail_tm_service.account_pool.start()
+
+# Pull new mail.tm messages in the background so requests only read local state
+from poller import MailPoller
+from models import EmailMessage
+MAIL_POLLER_ENABLED = os.environ.get('MAIL_POLLER_ENABLED', 'True').lower() == 'true'
+mail_poller = MailPoller(
+    temp_emails,
+    mail_tm_service,
+    EmailMessage,
+    workers=int(os.environ.get('MAIL_POLLER_WORKERS', 8)),
+    interval=float(os.environ.get('MAIL_POLL_INTERVAL', 5)),
+    idle_interval=float(os.environ.get('MAIL_POLL_IDLE_INTERVAL', 60)),
+    jitter=float(os.environ.get('MAIL_POLL_JITTER', 1.0)),
+    active_window=float(os.environ.get('MAIL_POLL_ACTIVE_WINDOW', 300)),
+    # Workers sharing the SQLite store elect a single poller through this lock
+    lock_path=f"{store_db.path}.poller.lock" if STORE_BACKEND == 'sqlite' else None
+)
+if MAIL_POLLER_ENABLED:
+    mail_poller.watch_all(temp_emails.values())
+    mail_poller.start()
+
+# Server-Sent Events push of new messages. Every open stream holds a worker
+# thread, so it is off (0 streams) unless the server runs threaded workers
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', 0))
+SSE_HEARTBEAT_INTERVAL = float(os.environ.get('SSE_HEARTBEAT_INTERVAL', 15))
+SSE_MAX_STREAM_DURATION = float(os.environ.get('SSE_MAX_STREAM_DURATION', 300))
+
+# Prometheus-style metrics served at /metrics. Each worker writes its samples
+# to METRICS_DIR, so a scrape of any worker reports the totals of all of them.
+# Every deployment needs its own directory or their totals get mixed
+from metrics import Metrics
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'True').lower() == 'true'
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+metrics = Metrics(
+    directory=os.environ.get('METRICS_DIR') or 'instance/metrics',
+    flush_interval=float(os.environ.get('METRICS_FLUSH_INTERVAL', 10))
+)
+metrics.describe('tempmail_http_request_duration_seconds', 'histogram',
+                 'Time to handle a request, by route, method and status code')
+metrics.describe('tempmail_upstream_request_duration_seconds', 'histogram',
+                 'Duration of mail.tm API calls, by endpoint, method and status code')
+metrics.describe('tempmail_inboxes', 'gauge', 'Inboxes in the store')
+metrics.describe('tempmail_messages', 'gauge', 'Messages in the store')
+metrics.describe('tempmail_store_bytes', 'gauge',
+                 'Message bodies held in memory (memory backend) or database file size (sqlite)')
+metrics.describe('tempmail_message_bodies_spilled_total', 'counter',
+                 'Message bodies moved to disk by the memory budget')
+metrics.describe('tempmail_cache_hits_total', 'counter', 'Cache lookups answered from the cache')
+metrics.describe('tempmail_cache_misses_total', 'counter', 'Cache lookups that had to compute or fetch')
+metrics.describe('tempmail_cache_entries', 'gauge', 'Entries held by a cache')
+
+def collect_store_metrics():
+    samples = [('tempmail_inboxes', (), len(temp_emails)), ('tempmail_messages', (), len(email_messages))]
+    if STORE_BACKEND == 'sqlite':
+        paths = (store_db.path, f'{store_db.path}-wal')
+        samples.append(('tempmail_store_bytes', (),
+                        sum(os.path.getsize(path) for path in paths if os.path.exists(path))))
+    elif body_budget is not None:
+        stats = body_budget.stats()
+        samples.append(('tempmail_store_bytes', (), stats['resident_bytes']))
+        samples.append(('tempmail_message_bodies_spilled_total', (), stats['spilled']))
+    return samples
+
+def collect_cache_metrics():
+    caches = {
+        'rendered_content': rendered_content_cache.stats(),
+        'mail_tm_token': mail_tm_service.token_cache.stats(),
+        'mail_tm_domains': mail_tm_service.domain_cache.stats()
+    }
+    if mail_tm_service.account_pool:
+        caches['account_pool'] = mail_tm_service.account_pool.stats()
+    samples = []
+    for cache, stats in caches.items():
+        labels = (('cache', cache),)
+        samples.append(('tempmail_cache_hits_total', labels, stats['hits']))
+        samples.append(('tempmail_cache_misses_total', labels, stats['misses']))
+        samples.append(('tempmail_cache_entries', labels, stats.get('depth', stats['size'])))
+    return samples
+
+if METRICS_ENABLED:
+    # The SQLite store is shared, so only the worker answering a scrape counts it
+    metrics.add_collector(collect_store_metrics, shared=STORE_BACKEND == 'sqlite')
+    metrics.add_collector(collect_cache_metrics)
+    mail_tm_service.metrics = metrics
+    metrics.start()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if METRICS_ENABLED and started is not None:
+        # The URL rule, not the path, so inbox ids do not create new series
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe(
+            'tempmail_http_request_duration_seconds',
+            (('route', route), ('method', request.method), ('status', str(response.status_code))),
+            time.perf_counter() - started
+        )
+    return response
 
 # Add template filters for email processing
-from email_utils import process_email_content
+from email_utils import process_email_content, render_message
 from markupsafe import Markup
 
 @app.template_filter('process_email')
@@ -144,5 +305,14 @@ def process_email_filter(html_content, text_content='', body_content=''):
         logging.error(f"Error processing email content: {e}")
         return Markup('<div class="text-gray-500 italic">Error processing email content</div>')
 
+@app.template_filter('render_message')
+def render_message_filter(message):
+    """Template filter returning a message's processed content from the render cache"""
+    try:
+        return Markup(render_message(message))  # Mark as safe HTML
+    except Exception as e:
+        logging.error(f"Error processing email content: {e}")
+        return Markup('<div class="text-gray-500 italic">Error processing email content</div>')
+
 # Import routes
 import routes
@@ -0,0 +1,411 @@
+"""End-to-end latency benchmark for ``/``, ``/generate-email`` and ``/fetch-emails``
+
+Starts the local mail.tm stand-in (``fake_mail_tm.py``) and seeds
+``--sessions`` browser sessions, ``--inboxes`` inboxes in total (sessions
+beyond ``--sessions`` only fill the store) and ``--messages`` messages per
+inbox. It then sends ``--requests`` requests per route from
+``--concurrency`` threads, either through Flask's test client in this
+process (``client``) or over HTTP against gunicorn (``http``), and reports
+p50/p95/p99 latency, throughput and RSS per route. Results are written as
+JSON so runs can be compared:
+
+    python benchmarks/bench_e2e.py --mode client
+    python benchmarks/bench_e2e.py --mode http --workers 1 --threads 16 --concurrency 16
+    python benchmarks/bench_e2e.py --compare benchmarks/results/e2e-20240101-120000.json
+
+The background poller is disabled, so ``/fetch-emails`` includes the
+upstream sync. App settings not set by the harness (e.g. ``STORE_BACKEND``)
+are taken from the environment; app logs go to a file in the run directory.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+EMAIL_ID_RE = re.compile(r"const emailId = '([^']+)'")
+EMAIL_ADDRESS_RE = re.compile(r'data-text="([^"]+@[^"]+)"')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code < 500:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def rss_bytes(pid):
+    """Resident set size of a process, 0 if unknown"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def process_tree(pid):
+    """``pid`` and all of its descendants (Linux only)"""
+    pids = [pid]
+    for current in pids:
+        try:
+            with open(f'/proc/{current}/task/{current}/children') as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+# Transports: one per simulated browser session, used by one thread at a time
+class ClientTransport:
+    """Flask test client with its own cookie jar"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, **kwargs):
+        response = self.client.open(path, method=method, **kwargs)
+        return response.status_code, response.get_data(as_text=True)
+
+
+class HTTPTransport:
+    """Keep-alive HTTP session against a running server"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.session = requests.Session()
+        # The session cookie is marked Secure; send it back over plain HTTP anyway
+        self.cookies = {}
+
+    def request(self, method, path, **kwargs):
+        response = self.session.request(method, self.base_url + path, allow_redirects=False,
+                                        timeout=60, cookies=self.cookies, **kwargs)
+        self.cookies.update(response.cookies.get_dict())
+        return response.status_code, response.text
+
+
+class FakeUpstream:
+    """fake_mail_tm.py in a subprocess, so its memory is not counted as the app's"""
+
+    def __init__(self, directory, latency, messages_size):
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.log = open(os.path.join(directory, 'fake_mail_tm.log'), 'w')
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(BENCHMARKS_DIR, 'fake_mail_tm.py'), '--port', str(self.port),
+             '--latency', str(latency), '--message-size', str(messages_size)],
+            stdout=self.log, stderr=subprocess.STDOUT
+        )
+        wait_for(f'{self.url}/domains')
+        self.session = requests.Session()
+
+    def inject(self, address, count):
+        for _ in range(count):
+            self.session.post(f'{self.url}/_fake/messages', json={'address': address}).raise_for_status()
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+        self.log.close()
+
+
+class Target:
+    """The app under test: in this process or behind gunicorn"""
+
+    def __init__(self, mode, directory, args, upstream_url):
+        self.mode = mode
+        self.server = None
+        # Only applied if not already set, so any app setting can be overridden
+        env = {
+            'MAIL_TM_BASE_URL': upstream_url,
+            'MAIL_TM_ACCOUNT_CREATION_INTERVAL': '0',
+            'MAIL_POLLER_ENABLED': 'False',
+            'RATELIMIT_ENABLED': 'False',
+            # Its atexit flush would run after the run directory is deleted
+            'METRICS_ENABLED': 'False',
+            'JOURNAL_DIR': os.path.join(directory, f'data-{mode}'),
+            'SQLITE_PATH': os.path.join(directory, f'tempmail-{mode}.db'),
+            'SESSION_SECRET': 'benchmark',
+        }
+        self.env = dict(os.environ)
+        for key, value in env.items():
+            self.env.setdefault(key, value)
+        self.log_path = os.path.join(directory, f'app-{mode}.log')
+
+        if mode == 'client':
+            os.environ.update({key: value for key, value in self.env.items() if key in env})
+            # Same level as app.py's basicConfig, which is a no-op once this is set
+            logging.basicConfig(filename=self.log_path, level=logging.DEBUG)
+            # Relative paths (e.g. the legacy temp_emails.json) resolve in the run directory
+            os.chdir(directory)
+            from app import app
+            self.app = app
+            self.pid = os.getpid()
+        else:
+            gunicorn = shutil.which('gunicorn')
+            if gunicorn is None:
+                raise RuntimeError("gunicorn is not installed; install it or use --mode client")
+            port = free_port()
+            self.base_url = f'http://127.0.0.1:{port}'
+            self.log = open(self.log_path, 'w')
+            self.server = subprocess.Popen(
+                [gunicorn, '--bind', f'127.0.0.1:{port}', '--workers', str(args.workers),
+                 '--worker-class', 'gthread', '--threads', str(args.threads),
+                 '--timeout', '120', 'main:app'],
+                cwd=directory, env=dict(self.env, PYTHONPATH=ROOT_DIR),
+                stdout=self.log, stderr=subprocess.STDOUT
+            )
+            wait_for(f'{self.base_url}/robots.txt')
+            self.pid = self.server.pid
+
+    def transport(self):
+        if self.mode == 'client':
+            return ClientTransport(self.app)
+        return HTTPTransport(self.base_url)
+
+    def rss(self):
+        return sum(rss_bytes(pid) for pid in process_tree(self.pid))
+
+    def stop(self):
+        if self.server is not None:
+            self.server.terminate()
+            self.server.wait()
+            self.log.close()
+
+
+def open_inbox(transport):
+    """Load the index page, which creates the session's inbox; returns (id, address)"""
+    status, body = transport.request('GET', '/')
+    email_id, address = EMAIL_ID_RE.search(body), EMAIL_ADDRESS_RE.search(body)
+    if status != 200 or not email_id or not address:
+        raise RuntimeError(f"Could not create an inbox (status {status})")
+    return email_id.group(1), address.group(1)
+
+
+def seed(target, upstream, args):
+    """Create the sessions and inboxes and deliver their messages"""
+    def create(index):
+        transport = target.transport()
+        email_id, address = open_inbox(transport)
+        upstream.inject(address, args.messages)
+        # The first fetch stores the messages
+        transport.request('GET', f'/fetch-emails/{email_id}')
+        return transport, email_id
+
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        created = list(pool.map(create, range(max(args.inboxes, args.sessions))))
+    return created[:args.sessions]
+
+
+def measure(target, jobs, concurrency):
+    """Run ``jobs`` (callables returning a status) from ``concurrency`` threads"""
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def run(job):
+        nonlocal errors
+        start = time.perf_counter()
+        try:
+            status = job()
+        except Exception:
+            status = None
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if status is None or status >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(run, jobs))
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': len(latencies) / wall if wall else None,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+        'rss_bytes': target.rss(),
+    }
+
+
+def session_jobs(sessions, count, concurrency, make_job):
+    """``count`` jobs over the seeded sessions; each session only ever runs on one thread"""
+    lanes = [sessions[lane::concurrency] for lane in range(concurrency)]
+    locks = [threading.Lock() for _ in lanes]
+    jobs = []
+    for index in range(count):
+        lane = index % concurrency
+        if not lanes[lane]:
+            lane = 0
+        transport, email_id = lanes[lane][(index // concurrency) % len(lanes[lane])]
+        jobs.append(make_job(locks[lane], transport, email_id))
+    return jobs
+
+
+def run_mode(mode, directory, args, upstream):
+    target = Target(mode, directory, args, upstream.url)
+    try:
+        started = time.perf_counter()
+        sessions = seed(target, upstream, args)
+        seed_seconds = time.perf_counter() - started
+        results = {'seed_seconds': seed_seconds, 'rss_after_seed_bytes': target.rss(), 'routes': {}}
+
+        def page(lock, transport, email_id):
+            def job():
+                with lock:
+                    return transport.request('GET', '/')[0]
+            return job
+
+        def fetch(lock, transport, email_id):
+            def job():
+                with lock:
+                    return transport.request('GET', f'/fetch-emails/{email_id}')[0]
+            return job
+
+        def generate():
+            transport = target.transport()
+            return lambda: transport.request('POST', '/generate-email')[0]
+
+        concurrency = min(args.concurrency, len(sessions))
+        routes = {
+            'GET /': session_jobs(sessions, args.requests, concurrency, page),
+            'GET /fetch-emails/<id>': session_jobs(sessions, args.requests, concurrency, fetch),
+            'POST /generate-email': [generate() for _ in range(args.requests)],
+        }
+        for route, jobs in routes.items():
+            results['routes'][route] = measure(target, jobs, args.concurrency)
+        return results
+    finally:
+        target.stop()
+
+
+def print_results(results, baseline=None):
+    for mode, result in results['modes'].items():
+        if 'error' in result:
+            print(f"\n[{mode}] skipped: {result['error']}")
+            continue
+        print(f"\n[{mode}] seeded in {result['seed_seconds']:.1f}s, "
+              f"RSS {result['rss_after_seed_bytes'] / 2**20:.1f} MiB")
+        print(f"{'route':<24} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8} "
+              f"{'errors':>6} {'RSS MiB':>8}")
+        for route, stats in result['routes'].items():
+            line = (f"{route:<24} {stats['p50_ms']:>8.1f} {stats['p95_ms']:>8.1f} "
+                    f"{stats['p99_ms']:>8.1f} {stats['throughput_rps']:>8.1f} "
+                    f"{stats['errors']:>6} {stats['rss_bytes'] / 2**20:>8.1f}")
+            old = (baseline or {}).get('modes', {}).get(mode, {}).get('routes', {}).get(route)
+            if old:
+                line += (f"   p50 {(stats['p50_ms'] / old['p50_ms'] - 1) * 100:+.0f}%"
+                         f" p95 {(stats['p95_ms'] / old['p95_ms'] - 1) * 100:+.0f}%")
+            print(line)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=('client', 'http', 'both'), default='both')
+    parser.add_argument('--sessions', type=int, default=20, help='sessions the requests use')
+    parser.add_argument('--inboxes', type=int, default=100, help='inboxes in the store')
+    parser.add_argument('--messages', type=int, default=10, help='messages per inbox')
+    parser.add_argument('--message-size', type=int, default=2000, help='approximate text body size')
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=4, help='client threads')
+    parser.add_argument('--upstream-latency', type=float, default=0.01,
+                        help='seconds added to every fake mail.tm response')
+    parser.add_argument('--workers', type=int, default=1, help='gunicorn workers (http mode)')
+    parser.add_argument('--threads', type=int, default=16, help='gunicorn threads per worker (http mode)')
+    parser.add_argument('--output', help='JSON results file (default benchmarks/results/e2e-<time>.json)')
+    parser.add_argument('--compare', help='earlier JSON results to show changes against')
+    args = parser.parse_args()
+    # Client mode changes into the run directory
+    args.output = args.output and os.path.abspath(args.output)
+    args.compare = args.compare and os.path.abspath(args.compare)
+
+    modes = ['client', 'http'] if args.mode == 'both' else [args.mode]
+    results = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'parameters': vars(args),
+        'modes': {},
+    }
+    # http first: client mode imports the app into this process
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        upstream = FakeUpstream(directory, args.upstream_latency, args.message_size)
+        try:
+            for mode in sorted(modes, key=lambda mode: mode != 'http'):
+                try:
+                    results['modes'][mode] = run_mode(mode, directory, args, upstream)
+                except RuntimeError as e:
+                    results['modes'][mode] = {'error': str(e)}
+        finally:
+            upstream.stop()
+            # Leave the run directory before it is deleted
+            os.chdir(cwd)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    output = args.output or os.path.join(
+        BENCHMARKS_DIR, 'results', f"e2e-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Micro-benchmark for rendering email bodies with ``process_email_content``
+
+Renders every message of a corpus a number of times and reports the time per
+message and the throughput. Without ``--corpus`` a synthetic corpus of
+marketing-style HTML emails (nested tables, inline styles, many tracked
+links) is generated; pass a directory of ``.html``/``.eml``/``.txt`` files to
+benchmark real messages instead.
+
+    python benchmarks/bench_email_render.py
+    python benchmarks/bench_email_render.py --corpus ~/mail --repeat 20
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from email_utils import process_email_content  # noqa: E402
+
+LINK_PATHS = ['verify-email', 'confirm', 'account/activate', 'reset-password',
+              'download/app', 'login', 'register', 'unsubscribe', 'deals/today',
+              'p/summer-sale']
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod '
+         'tempor incididunt ut labore et dolore magna aliqua offer sale free '
+         'shipping exclusive members only &amp; today &nbsp; save').split()
+
+
+def synthetic_email(rng, target_size):
+    """Build one marketing email of roughly ``target_size`` characters"""
+    parts = ['<!DOCTYPE html><html><head><style>td{padding:0}.x{color:red}</style>'
+             '</head><body><!-- preheader -->']
+    size = 0
+    while size < target_size:
+        text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 40)))
+        link = f'https://click.example.com/{rng.choice(LINK_PATHS)}?u={rng.randint(1, 10**9)}&amp;t=x'
+        block = (
+            '<table role="presentation" width="100%" cellpadding="0" cellspacing="0" '
+            'style="max-width:600px;border-collapse:collapse"><tr><td align="center" '
+            f'style="font-family:Arial,sans-serif;font-size:14px"><div><p>{text}</p>'
+            f'<h2>{text[:30]}</h2><p><b>{text[:20]}</b> <i>{text[-20:]}</i><br>'
+            f'<span style="color:#333">{text}</span></p>'
+            f'<a href="{link}" style="display:inline-block"><span>Shop now</span></a>'
+            f'<a href="{link}">{link}</a></div></td></tr></table>'
+        )
+        parts.append(block)
+        size += len(block)
+    parts.append('</body></html>')
+    return ''.join(parts)
+
+
+def load_corpus(path):
+    corpus = []
+    for name in sorted(os.listdir(path)):
+        if name.endswith(('.html', '.htm', '.eml', '.txt')):
+            with open(os.path.join(path, name), encoding='utf-8', errors='replace') as f:
+                corpus.append(f.read())
+    return corpus
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--corpus', help='directory of email bodies to render')
+    parser.add_argument('--messages', type=int, default=20, help='synthetic messages to generate')
+    parser.add_argument('--size', type=int, default=200_000, help='approximate synthetic message size')
+    parser.add_argument('--repeat', type=int, default=5, help='renders of the whole corpus')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.corpus:
+        corpus = load_corpus(args.corpus)
+    else:
+        rng = random.Random(args.seed)
+        corpus = [synthetic_email(rng, args.size) for _ in range(args.messages)]
+    if not corpus:
+        sys.exit('Empty corpus')
+
+    total_bytes = sum(len(body) for body in corpus)
+    timings = []
+    for _ in range(args.repeat):
+        for body in corpus:
+            start = time.perf_counter()
+            process_email_content(body, '', '')
+            timings.append(time.perf_counter() - start)
+
+    elapsed = sum(timings)
+    print(f"messages: {len(corpus)} x {args.repeat}, avg size {total_bytes / len(corpus) / 1024:.1f} KiB")
+    print(f"per message: mean {statistics.mean(timings) * 1000:.2f} ms, "
+          f"median {statistics.median(timings) * 1000:.2f} ms, max {max(timings) * 1000:.2f} ms")
+    print(f"throughput: {total_bytes * args.repeat / elapsed / 2**20:.2f} MiB/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Memory benchmark for the ``TempEmail`` and ``EmailMessage`` models
+
+Builds a number of inboxes and messages the way the app does and reports
+the bytes allocated per inbox and per message, measured with tracemalloc.
+Messages are built twice: as ingested from a mail.tm response, and as
+restored from a journal/SQLite record, where every field (including the
+body) is a freshly decoded string.
+
+    python benchmarks/bench_model_memory.py
+    python benchmarks/bench_model_memory.py --inboxes 50000 --messages 5 --size 4000
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from journal import inbox_from_record, inbox_to_record, message_from_record, message_to_record  # noqa: E402
+from models import EmailMessage, TempEmail  # noqa: E402
+
+WORDS = ('your verification code is please confirm account sign in security '
+         'team welcome thanks regards click link below expires minutes').split()
+
+
+def measure(build):
+    """Return (result, bytes allocated by ``build()`` and still alive)"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+
+def make_inbox(index):
+    # Mirrors MailTMService.create_real_temp_email
+    email = TempEmail(session_id=str(uuid.uuid4()), use_real_email=True)
+    email.email_address = f'user{index:08d}@example.com'
+    email.expires_at = datetime.utcnow() + timedelta(hours=24)
+    email.is_active = True
+    email.created_at = datetime.utcnow()
+    email.mail_tm_password = uuid.uuid4().hex
+    email.mail_tm_id = uuid.uuid4().hex[:24]
+    email.sync_cursor = None
+    return email
+
+
+def make_details(rng, size):
+    """A mail.tm message detail document, decoded from JSON like the real one"""
+    text = ' '.join(rng.choice(WORDS) for _ in range(size // 6))[:size]
+    html = f'<html><body><p>{text}</p></body></html>'
+    return json.loads(json.dumps({
+        'id': uuid.uuid4().hex[:24],
+        'from': {'address': 'noreply@example.com', 'name': 'Example'},
+        'subject': 'Your verification code',
+        'text': text,
+        'html': html,
+    }))
+
+
+def make_message(temp_email_id, details):
+    # Mirrors MailTMService.fetch_emails_for_account
+    return EmailMessage(
+        temp_email_id=temp_email_id,
+        sender_email=details['from']['address'],
+        sender_name=details['from']['name'],
+        subject=details['subject'],
+        body=details.get('text', details.get('html', '')),
+        text_content=details.get('text', ''),
+        html_content=details.get('html', ''),
+        mail_tm_id=details['id']
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--inboxes', type=int, default=10_000, help='inboxes to build')
+    parser.add_argument('--messages', type=int, default=3, help='messages per inbox')
+    parser.add_argument('--size', type=int, default=2_000, help='approximate text body size')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    inboxes, inbox_bytes = measure(lambda: [make_inbox(i) for i in range(args.inboxes)])
+    inbox_records = [json.dumps(inbox_to_record(email)) for email in inboxes]
+    restored_inboxes, restored_inbox_bytes = measure(
+        lambda: [inbox_from_record(json.loads(record)) for record in inbox_records]
+    )
+    del restored_inboxes
+
+    message_count = args.inboxes * args.messages
+    details = [make_details(rng, args.size) for _ in range(message_count)]
+    messages, message_bytes = measure(
+        lambda: [make_message(inboxes[i % args.inboxes].id, d) for i, d in enumerate(details)]
+    )
+    del details
+    message_records = [json.dumps(message_to_record(message)) for message in messages]
+    del messages
+    restored, restored_message_bytes = measure(
+        lambda: [message_from_record(json.loads(record)) for record in message_records]
+    )
+    content = sum(len(m.text_content) + len(m.html_content) for m in restored) / message_count
+
+    print(f"{args.inboxes} inboxes, {message_count} messages "
+          f"(~{content:.0f} characters of text + html each)")
+    print(f"inbox, created:     {inbox_bytes / args.inboxes:10.0f} bytes")
+    print(f"inbox, restored:    {restored_inbox_bytes / args.inboxes:10.0f} bytes")
+    print(f"message, ingested:  {message_bytes / message_count:10.0f} bytes "
+          f"(excluding the decoded mail.tm payload)")
+    print(f"message, restored:  {restored_message_bytes / message_count:10.0f} bytes")
+
+
+if __name__ == '__main__':
+    main()
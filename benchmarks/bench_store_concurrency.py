@@ -0,0 +1,142 @@
+"""Concurrent stress test for the inbox and message stores
+
+Runs a mix of the operations request handlers, the poller and the expiry
+reaper perform (create/delete inboxes, add messages, list and poll inboxes,
+iterate the stores, reap expired inboxes) from a growing number of threads
+and reports the operations per second for each thread count together with
+any exception raised, e.g. ``RuntimeError: dictionary changed size during
+iteration``.
+
+    python benchmarks/bench_store_concurrency.py
+    python benchmarks/bench_store_concurrency.py --threads 1 4 16 64 --duration 5
+    python benchmarks/bench_store_concurrency.py --backend sqlite
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from collections import Counter
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import EmailMessage, TempEmail  # noqa: E402
+from store import InboxStore, MessageStore  # noqa: E402
+
+
+def make_stores(backend, directory):
+    if backend == 'sqlite':
+        from sqlite_store import SQLiteDatabase, SQLiteInboxStore, SQLiteMessageStore
+        db = SQLiteDatabase(os.path.join(directory, f'stress-{time.time_ns()}.db'))
+        return SQLiteInboxStore(db), SQLiteMessageStore(db)
+    return InboxStore(), MessageStore()
+
+
+def create_inbox(temp_emails, rng):
+    email = TempEmail(f'session-{rng.randrange(1000)}', use_real_email=False)
+    email.expires_at = datetime.utcnow() + timedelta(seconds=rng.choice((-1, 3600)))
+    temp_emails.add(email)
+    return email.id
+
+
+def worker(temp_emails, email_messages, seed, target, ready, stop, counts, errors):
+    rng = random.Random(seed)
+    # Each thread owns about ``target`` inboxes, so the stores have the same
+    # size whatever the thread count
+    mine = [create_inbox(temp_emails, rng) for _ in range(target)]
+    ready.wait()
+    ops = 0
+    while not stop.is_set():
+        try:
+            roll = rng.random()
+            if roll < 0.1 or not mine:
+                if len(mine) < target:
+                    mine.append(create_inbox(temp_emails, rng))
+                else:
+                    email_id = mine.pop(rng.randrange(len(mine)))
+                    email_messages.delete_for_inbox(email_id)
+                    temp_emails.remove(email_id)
+            elif roll < 0.4:
+                message = EmailMessage(rng.choice(mine), 'sender@example.com', subject='Hello',
+                                       text_content='Your code is 123456',
+                                       mail_tm_id=str(rng.randrange(10**6)))
+                email_messages.add(message)
+            elif roll < 0.7:
+                email_id = rng.choice(mine)
+                email_messages.for_inbox(email_id)
+                email_messages.messages_since(email_id, email_messages.inbox_version(email_id) - 5)
+            elif roll < 0.85:
+                email = temp_emails.get(rng.choice(mine))
+                if email is not None:
+                    temp_emails.for_session(email.session_id)
+            elif roll < 0.95:
+                # Whole-store scans, as the old routes and cache writers did
+                for email_id in temp_emails.keys()[:200]:
+                    email_id in temp_emails
+                for message in email_messages.values()[:200]:
+                    message.id in email_messages
+            else:
+                for email in temp_emails.pop_expired(datetime.utcnow(), 50):
+                    email_messages.delete_for_inbox(email.id)
+                    if email.id in mine:
+                        mine.remove(email.id)
+            ops += 1
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+            errors[error] += 1
+            if errors[error] == 1:
+                traceback.print_exc()
+    counts.append(ops)
+
+
+def run(backend, directory, threads, duration, seed, inboxes):
+    temp_emails, email_messages = make_stores(backend, directory)
+    ready = threading.Barrier(threads + 1)
+    stop = threading.Event()
+    counts = []
+    errors = Counter()
+    target = max(inboxes // threads, 1)
+    pool = [
+        threading.Thread(target=worker, args=(temp_emails, email_messages, seed + i, target,
+                                              ready, stop, counts, errors))
+        for i in range(threads)
+    ]
+    for thread in pool:
+        thread.start()
+    ready.wait()
+    start = time.perf_counter()
+    time.sleep(duration)
+    stop.set()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return sum(counts) / elapsed, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', choices=('memory', 'sqlite'), default='memory')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--inboxes', type=int, default=2000, help='live inboxes across all threads')
+    parser.add_argument('--duration', type=float, default=3, help='seconds per thread count')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'threads':>8} {'ops/s':>12}  errors")
+        for threads in args.threads:
+            throughput, errors = run(args.backend, directory, threads, args.duration, args.seed,
+                                     args.inboxes)
+            failed = failed or bool(errors)
+            summary = ', '.join(f'{error} x{count}' for error, count in errors.most_common()) or 'none'
+            print(f"{threads:>8} {throughput:>12.0f}  {summary}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
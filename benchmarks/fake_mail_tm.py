@@ -0,0 +1,370 @@
+"""Local stand-in for the mail.tm API, for offline tests and load testing
+
+Implements the part of https://api.mail.tm the app uses, with the same
+hydra-style JSON documents:
+
+    GET  /domains                  active domains
+    POST /accounts                 create an account (201, 422 if taken)
+    POST /token                    bearer token for address + password
+    GET  /messages?page=N          30 messages per page, newest first
+    GET  /messages/{id}            message with text and html bodies
+
+Latency, 5xx errors and 429 responses can be injected to see how the app
+behaves against a slow or flaky upstream, and messages can be delivered to
+any account either in-process (``FakeMailTM.inject_message``) or over HTTP
+(``POST /_fake/messages``), so a benchmark can feed a separately running app.
+
+Point the app at it with ``MAIL_TM_BASE_URL``:
+
+    python benchmarks/fake_mail_tm.py --port 8025 --latency 0.05 --error-rate 0.01
+    MAIL_TM_BASE_URL=http://127.0.0.1:8025 MAIL_TM_ACCOUNT_CREATION_INTERVAL=0 python main.py
+
+or use it from Python:
+
+    with FakeMailTM(latency=0.02) as fake:
+        mail_tm_service.base_url = fake.url
+        fake.inject_message('user@fake.test', subject='Your code is 123456')
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+PAGE_SIZE = 30
+
+
+def _now():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S+00:00')
+
+
+def _hex_id():
+    return uuid.uuid4().hex[:24]
+
+
+class FakeAccount:
+    def __init__(self, address, password):
+        self.id = _hex_id()
+        self.address = address
+        self.password = password
+        self.created_at = _now()
+        # Newest last; listed in reverse
+        self.messages = []
+
+    def to_json(self):
+        return {
+            '@context': '/contexts/Account',
+            '@id': f'/accounts/{self.id}',
+            '@type': 'Account',
+            'id': self.id,
+            'address': self.address,
+            'quota': 40000000,
+            'used': sum(message['size'] for message in self.messages),
+            'isDisabled': False,
+            'isDeleted': False,
+            'createdAt': self.created_at,
+            'updatedAt': self.created_at
+        }
+
+
+class FakeMailTM:
+    """In-memory mail.tm server running on a background thread
+
+    ``latency`` (plus up to ``jitter``) seconds are added to every response;
+    ``error_rate`` and ``rate_limit_rate`` are the fractions of requests
+    answered with a 500 and a 429. ``messages_per_account`` messages are
+    delivered to every new account, and ``on_request(method, path)`` is
+    called for each request before it is answered.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, domains=('fake.test',), latency=0.0,
+                 jitter=0.0, error_rate=0.0, rate_limit_rate=0.0, messages_per_account=0,
+                 message_size=2000, seed=None, on_request=None):
+        self.domains = list(domains)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.messages_per_account = messages_per_account
+        self.message_size = message_size
+        self.on_request = on_request
+        # 'METHOD /endpoint' -> number of requests received
+        self.requests = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._accounts = {}
+        self._tokens = {}
+        self._message_numbers = itertools.count(1)
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def serve_forever(self):
+        """Serve on the calling thread until interrupted"""
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._server.server_close()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-mail-tm',
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    # Accounts and messages
+    def create_account(self, address, password):
+        """Create an account directly, returning None if the address is taken"""
+        with self._lock:
+            if address in self._accounts:
+                return None
+            account = self._accounts[address] = FakeAccount(address, password)
+        for _ in range(self.messages_per_account):
+            self.inject_message(address)
+        return account
+
+    def inject_message(self, address, subject=None, text=None, html=None,
+                       sender='noreply@example.com', sender_name='Example'):
+        """Deliver a message to ``address``; returns its id, or None for unknown accounts"""
+        with self._lock:
+            account = self._accounts.get(address)
+            if account is None:
+                return None
+            number = next(self._message_numbers)
+        if subject is None:
+            subject = f'Your verification code is {100000 + number % 900000}'
+        if text is None:
+            filler = 'Thanks for signing up. Enter the code below to confirm your account. '
+            text = f'{subject}\n\n' + filler * max(self.message_size // len(filler), 1)
+        if html is None:
+            html = f'<html><body><h1>{subject}</h1><p>{text}</p>' \
+                   f'<a href="https://example.com/verify?n={number}">Verify email</a></body></html>'
+        created_at = _now()
+        message_id = _hex_id()
+        message = {
+            '@id': f'/messages/{message_id}',
+            '@type': 'Message',
+            'id': message_id,
+            'accountId': f'/accounts/{account.id}',
+            'msgid': f'<{uuid.uuid4().hex}@example.com>',
+            'from': {'address': sender, 'name': sender_name},
+            'to': [{'address': address, 'name': ''}],
+            'subject': subject,
+            'intro': text[:120],
+            'seen': False,
+            'isDeleted': False,
+            'hasAttachments': False,
+            'size': len(text) + len(html),
+            'downloadUrl': f'/messages/{message_id}/download',
+            'createdAt': created_at,
+            'updatedAt': created_at,
+            'text': text,
+            'html': [html]
+        }
+        with self._lock:
+            account.messages.append(message)
+        return message_id
+
+    def account(self, address):
+        with self._lock:
+            return self._accounts.get(address)
+
+    # HTTP
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                fake._handle(self, 'GET')
+
+            def do_POST(self):
+                fake._handle(self, 'POST')
+
+        return Handler
+
+    def _handle(self, handler, method):
+        path = urlparse(handler.path).path
+        length = int(handler.headers.get('Content-Length') or 0)
+        body = handler.rfile.read(length) if length else b''
+        endpoint = '/messages/{id}' if path.startswith('/messages/') else path
+        with self._lock:
+            self.requests[f'{method} {endpoint}'] = self.requests.get(f'{method} {endpoint}', 0) + 1
+
+        if self.on_request is not None:
+            self.on_request(method, path)
+        delay = self.latency + (self._random.random() * self.jitter if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+        if not path.startswith('/_fake/'):
+            roll = self._random.random()
+            if roll < self.rate_limit_rate:
+                return self._send(handler, 429, {'message': 'Too Many Requests'})
+            if roll < self.rate_limit_rate + self.error_rate:
+                return self._send(handler, 500, {'message': 'Internal Server Error'})
+
+        try:
+            payload = json.loads(body) if body else {}
+        except ValueError:
+            return self._send(handler, 400, {'message': 'Invalid JSON'})
+        status, document = self._route(handler, method, path, payload)
+        self._send(handler, status, document)
+
+    def _route(self, handler, method, path, payload):
+        if method == 'GET' and path == '/domains':
+            return 200, self._collection('/domains', [
+                {'@id': f'/domains/{domain}', '@type': 'Domain', 'id': domain, 'domain': domain,
+                 'isActive': True, 'isPrivate': False, 'createdAt': _now(), 'updatedAt': _now()}
+                for domain in self.domains
+            ])
+        if method == 'POST' and path == '/accounts':
+            address, password = payload.get('address', ''), payload.get('password', '')
+            if address.rpartition('@')[2] not in self.domains or not password:
+                return 422, {'violations': [{'propertyPath': 'address', 'message': 'Invalid address'}]}
+            account = self.create_account(address, password)
+            if account is None:
+                return 422, {'violations': [{'propertyPath': 'address',
+                                             'message': 'This value is already used.'}]}
+            return 201, account.to_json()
+        if method == 'POST' and path == '/token':
+            account = self.account(payload.get('address'))
+            if account is None or account.password != payload.get('password'):
+                return 401, {'code': 401, 'message': 'Invalid credentials.'}
+            token = uuid.uuid4().hex
+            with self._lock:
+                self._tokens[token] = account.address
+            return 200, {'id': account.id, 'token': token}
+        if method == 'POST' and path == '/_fake/messages':
+            message_id = self.inject_message(
+                payload.get('address'), subject=payload.get('subject'), text=payload.get('text'),
+                html=payload.get('html'), sender=payload.get('sender', 'noreply@example.com')
+            )
+            if message_id is None:
+                return 404, {'message': 'Unknown account'}
+            return 201, {'id': message_id}
+
+        if method == 'GET' and (path == '/messages' or path.startswith('/messages/')):
+            account = self._authorized(handler)
+            if account is None:
+                return 401, {'code': 401, 'message': 'JWT Token not found'}
+            with self._lock:
+                messages = account.messages[::-1]
+            if path == '/messages':
+                return 200, self._messages_page(handler, messages)
+            message_id = path[len('/messages/'):]
+            for message in messages:
+                if message['id'] == message_id:
+                    return 200, dict(message, **{'@context': '/contexts/Message'})
+            return 404, {'message': 'Not Found'}
+        return 404, {'message': 'Not Found'}
+
+    def _authorized(self, handler):
+        authorization = handler.headers.get('Authorization', '')
+        if not authorization.startswith('Bearer '):
+            return None
+        with self._lock:
+            address = self._tokens.get(authorization[len('Bearer '):])
+            return self._accounts.get(address) if address else None
+
+    def _collection(self, path, members, total=None, view=None):
+        document = {
+            '@context': f'/contexts/{path.strip("/").capitalize()}',
+            '@id': path,
+            '@type': 'hydra:Collection',
+            'hydra:member': members,
+            'hydra:totalItems': len(members) if total is None else total
+        }
+        if view:
+            document['hydra:view'] = view
+        return document
+
+    def _messages_page(self, handler, messages):
+        query = parse_qs(urlparse(handler.path).query)
+        try:
+            page = max(int(query.get('page', ['1'])[0]), 1)
+        except ValueError:
+            page = 1
+        last = max((len(messages) + PAGE_SIZE - 1) // PAGE_SIZE, 1)
+        listed = [
+            {key: value for key, value in message.items() if key not in ('text', 'html')}
+            for message in messages[(page - 1) * PAGE_SIZE:page * PAGE_SIZE]
+        ]
+        view = None
+        if len(messages) > PAGE_SIZE:
+            view = {
+                '@id': f'/messages?page={page}',
+                '@type': 'hydra:PartialCollectionView',
+                'hydra:first': '/messages?page=1',
+                'hydra:last': f'/messages?page={last}'
+            }
+            if page > 1:
+                view['hydra:previous'] = f'/messages?page={page - 1}'
+            if page < last:
+                view['hydra:next'] = f'/messages?page={page + 1}'
+        return self._collection('/messages', listed, total=len(messages), view=view)
+
+    def _send(self, handler, status, document):
+        data = json.dumps(document).encode('utf-8')
+        handler.send_response(status)
+        content_type = 'application/ld+json' if status < 400 else 'application/problem+json'
+        handler.send_header('Content-Type', f'{content_type}; charset=utf-8')
+        handler.send_header('Content-Length', str(len(data)))
+        if status == 429:
+            handler.send_header('Retry-After', '1')
+        handler.end_headers()
+        handler.wfile.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument('--domain', action='append', help='domain to offer (repeatable)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra latency, up to this')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of 500 responses')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='fraction of 429 responses')
+    parser.add_argument('--messages-per-account', type=int, default=0,
+                        help='messages delivered to every new account')
+    parser.add_argument('--message-size', type=int, default=2000, help='approximate text body size')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    fake = FakeMailTM(args.host, args.port, domains=args.domain or ('fake.test',),
+                      latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                      rate_limit_rate=args.rate_limit_rate,
+                      messages_per_account=args.messages_per_account,
+                      message_size=args.message_size, seed=args.seed)
+    print(f"Fake mail.tm listening on {fake.url}", flush=True)
+    fake.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+import atexit
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
+
+# EmailMessage slots behind text_content/html_content; they hold either the
+# original value or a PackedBody
+BODY_SLOTS = ('_text_content', '_html_content')
+
+# Rough per-object cost of a PackedBody on top of its compressed bytes
+_PACKED_OVERHEAD = 96
+
+
+class PackedBody:
+    """A message body held zlib-compressed in memory or spilled to a file
+
+    ``EmailMessage`` unpacks it on attribute access, so code reading
+    ``message.text_content`` always gets the original value back. mail.tm
+    sends ``html`` as a list of strings; lists are packed as JSON.
+    """
+
+    __slots__ = ('data', 'path', 'is_list')
+
+    def __init__(self, value):
+        self.is_list = not isinstance(value, str)
+        raw = json.dumps(value) if self.is_list else value
+        self.data = zlib.compress(raw.encode('utf-8'))
+        self.path = None
+
+    def unpack(self):
+        data = self.data
+        if data is None:
+            try:
+                with open(self.path, 'rb') as f:
+                    data = f.read()
+            except OSError as e:
+                logging.error(f"Error reading spilled message body {self.path}: {e}")
+                return [] if self.is_list else ''
+        raw = zlib.decompress(data).decode('utf-8')
+        return json.loads(raw) if self.is_list else raw
+
+    def spill(self, path):
+        """Move the compressed bytes to ``path`` and drop them from memory"""
+        with open(path, 'wb') as f:
+            f.write(self.data)
+        self.path = path
+        self.data = None
+
+    @property
+    def size(self):
+        return _PACKED_OVERHEAD + (len(self.data) if self.data is not None else 0)
+
+
+def _value_size(value):
+    if isinstance(value, PackedBody):
+        return value.size
+    if isinstance(value, list):
+        return sys.getsizeof(value) + sum(sys.getsizeof(item) for item in value)
+    return sys.getsizeof(value) if value else 0
+
+
+class BodyBudget:
+    """Store-wide memory budget for message bodies
+
+    Bodies of at least ``compress_threshold`` bytes are compressed when a
+    message is stored. The resident bodies of all messages are counted
+    against ``max_bytes``; once it is exceeded, the bodies of the least
+    recently read messages are written to a spill directory and only read
+    back (from disk, without returning to memory) when someone asks for them.
+    Victims are picked under the lock but written after releasing it, so
+    disk IO never blocks other threads using the budget or the store.
+    Spill files live in a private directory per process that is removed at
+    exit, since every body can be restored from the journal on restart.
+
+    Processed HTML in ``email_utils.RenderedContentCache`` is bounded
+    separately (``RENDERED_CONTENT_CACHE_MB``).
+    """
+
+    def __init__(self, max_bytes, compress_threshold=4096, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.compress_threshold = compress_threshold
+        self.spill_dir = spill_dir
+        self.resident_bytes = 0
+        self.compressed = 0
+        self.spilled = 0
+        self._lock = threading.Lock()
+        # message id -> (message, resident bytes), least recently read first
+        self._resident = OrderedDict()
+        # message id -> True once forgotten while its bodies were being spilled
+        self._spilling = {}
+        self._directory = None
+
+    def admit(self, message):
+        """Start accounting for a newly stored message, compressing large bodies"""
+        size = 0
+        for field in BODY_SLOTS:
+            value = getattr(message, field, None)
+            if value and not isinstance(value, PackedBody) and _value_size(value) >= self.compress_threshold:
+                value = PackedBody(value)
+                setattr(message, field, value)
+                self.compressed += 1
+            size += _value_size(value)
+
+        with self._lock:
+            previous = self._resident.pop(message.id, None)
+            if previous is not None:
+                self.resident_bytes -= previous[1]
+            self._resident[message.id] = (message, size)
+            self.resident_bytes += size
+            victims = self._evict()
+        self._spill_all(victims)
+
+    def touch(self, messages):
+        """Mark messages as just read so they are evicted last"""
+        with self._lock:
+            for message in messages:
+                if message.id in self._resident:
+                    self._resident.move_to_end(message.id)
+
+    def forget(self, message):
+        """Stop accounting for a removed message and delete its spill files"""
+        with self._lock:
+            entry = self._resident.pop(message.id, None)
+            if entry is not None:
+                self.resident_bytes -= entry[1]
+            if message.id in self._spilling:
+                self._spilling[message.id] = True
+        self._remove_files(message)
+
+    def _remove_files(self, message):
+        for field in BODY_SLOTS:
+            value = getattr(message, field, None)
+            if isinstance(value, PackedBody) and value.path:
+                try:
+                    os.remove(value.path)
+                except OSError:
+                    pass
+
+    def _evict(self):
+        """Pick the least recently read messages to spill until within budget
+
+        Call with the lock held, then pass the result to ``_spill_all``
+        after releasing it.
+        """
+        victims = []
+        while self.resident_bytes > self.max_bytes and len(self._resident) > 1:
+            _, (message, size) = self._resident.popitem(last=False)
+            self.resident_bytes -= size
+            self._spilling[message.id] = False
+            victims.append(message)
+        if victims:
+            self._spill_directory()
+        return victims
+
+    def _spill_all(self, victims):
+        """Write the bodies of evicted messages to disk (call without the lock)"""
+        spilled = []
+        for message in victims:
+            try:
+                self._spill(message)
+                spilled.append(message)
+            except (OSError, ValueError) as e:
+                logging.error(f"Error spilling message body {message.id}: {e}")
+        if not victims:
+            return
+        with self._lock:
+            self.spilled += len(spilled)
+            forgotten = [message for message in victims if self._spilling.pop(message.id, False)]
+        # Removed from the store while being written out
+        for message in forgotten:
+            self._remove_files(message)
+
+    def _spill(self, message):
+        directory = self._directory
+        for field in BODY_SLOTS:
+            value = getattr(message, field, None)
+            if not value:
+                continue
+            packed = value if isinstance(value, PackedBody) else PackedBody(value)
+            packed.spill(os.path.join(directory, f'{message.id}{field}'))
+            setattr(message, field, packed)
+
+    def _spill_directory(self):
+        if self._directory is None:
+            if self.spill_dir:
+                os.makedirs(self.spill_dir, exist_ok=True)
+            self._directory = tempfile.mkdtemp(prefix='tempmail-bodies-', dir=self.spill_dir)
+            atexit.register(shutil.rmtree, self._directory, ignore_errors=True)
+        return self._directory
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_bytes': self.max_bytes,
+                'resident_bytes': self.resident_bytes,
+                'resident_messages': len(self._resident),
+                'compressed': self.compressed,
+                'spilled': self.spilled
+            }
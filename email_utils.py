@@ -1,103 +1,243 @@
+import os
 import re
 import html
-from html.parser import HTMLParser
+import sys
+import threading
+from collections import OrderedDict
 
-class EmailHTMLParser(HTMLParser):
-    """Custom HTML parser for email content that preserves links and formatting"""
+EMAIL_HTML_MAX_INPUT = int(os.environ.get('EMAIL_HTML_MAX_INPUT', 512 * 1024))
+EMAIL_HTML_MAX_DEPTH = int(os.environ.get('EMAIL_HTML_MAX_DEPTH', 64))
+
+# Markup emitted for every tag the sanitizer keeps; all other tags are dropped
+# and only their text survives
+_HEADING_TAGS = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+_OPEN_MARKUP = {
+    'p': '<div class="email-paragraph mb-3">',
+    'div': '<div class="email-paragraph mb-3">',
+    'strong': '<strong>',
+    'b': '<strong>',
+    'em': '<em>',
+    'i': '<em>',
+    **{tag: f'<{tag} class="email-heading font-bold mb-2">' for tag in _HEADING_TAGS}
+}
+_CLOSE_MARKUP = {
+    'p': '</div>',
+    'div': '</div>',
+    'strong': '</strong>',
+    'b': '</strong>',
+    'em': '</em>',
+    'i': '</em>',
+    **{tag: f'</{tag}>' for tag in _HEADING_TAGS}
+}
+# Paragraphs are not opened inside a link button
+_BLOCK_TAGS = frozenset(('p', 'div'))
+_SKIPPED_CONTENT_TAGS = frozenset(('script', 'style'))
+_SAFE_LINK_PREFIXES = ('http://', 'https://', 'mailto:')
+_LINK_OPEN = ('<div class="email-link-section my-3"><a href="{}" target="_blank" '
+              'rel="noopener noreferrer" class="email-link-button">')
+_LINK_CLOSE = '</a></div>'
+_TRUNCATED_NOTICE = '<div class="email-paragraph mb-3"><em>[Message truncated]</em></div>'
+
+# One token per match: text, comment, declaration/processing instruction, tag
+# or a stray '<' that does not start a tag. The possessive quantifiers keep a
+# tag that is never closed from being retried at every split of its name
+_TOKEN_RE = re.compile(r'''
+    (?P<text>[^<]+)
+  | <!--.*?(?:-->|\Z)
+  | <[!?][^>]*>
+  | <(?P<end>/)?(?P<tag>[a-zA-Z][^\s/>]*+)(?P<attrs>(?:[^>"']|"[^"]*"|'[^']*')*+)>
+  | (?P<lt><)
+''', re.VERBOSE | re.DOTALL)
+# A '<' that starts a tag, comment or declaration. When the tokenizer still
+# matches it as a stray '<', the construct is never closed
+_TAG_START_RE = re.compile(r'<(?:[!?]|/?[a-zA-Z])')
+_ATTR_RE = re.compile(r'''([^\s=/>]+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]*)))?''')
+_SKIPPED_CONTENT_END = {tag: re.compile(rf'</{tag}\s*>', re.IGNORECASE) for tag in _SKIPPED_CONTENT_TAGS}
+
+# Link button labels by priority, first entry with a matching keyword wins:
+# (keywords, label)
+_URL_LABELS = (
+    (('verify', 'verification'), 'Verify Email'),
+    (('confirm', 'confirmation'), 'Confirm Account'),
+    (('activate', 'activation'), 'Activate Account'),
+    (('reset', 'password'), 'Reset Password'),
+    (('download',), 'Download'),
+    (('login', 'signin'), 'Login'),
+    (('signup', 'register'), 'Sign Up'),
+    (('unsubscribe',), 'Unsubscribe'),
+)
+_LINK_TEXT_LABELS = (
+    (('verify', 'verification'), 'Verify Email'),
+    (('confirm',), 'Confirm Account'),
+)
+
+def _compile_labels(table):
+    """Build one regex finding every keyword of a label table plus keyword -> (priority, label)"""
+    labels = {}
+    for priority, (keywords, label) in enumerate(table):
+        for keyword in keywords:
+            labels.setdefault(keyword, (priority, label))
+    # Zero-width lookahead so overlapping keywords are all found; longest
+    # first so a keyword is not shadowed by its own prefix
+    keywords = sorted(labels, key=len, reverse=True)
+    return re.compile('(?=(%s))' % '|'.join(map(re.escape, keywords))), labels
+
+_URL_LABEL_MATCHER = _compile_labels(_URL_LABELS)
+_LINK_TEXT_LABEL_MATCHER = _compile_labels(_LINK_TEXT_LABELS)
+
+def _match_label(matcher, value):
+    """Label of the highest-priority keyword contained in ``value``, or None"""
+    pattern, labels = matcher
+    best = None
+    for match in pattern.finditer(value):
+        found = labels[match.group(1)]
+        if best is None or found < best:
+            best = found
+    return best[1] if best else None
+
+class EmailHTMLParser:
+    """Single-pass sanitizer for email HTML that preserves links and formatting
+    
+    Walks the markup once with a precompiled tokenizer and emits only the
+    tags in ``_OPEN_MARKUP`` plus safe link buttons; everything else is
+    reduced to escaped text. Open tags are tracked on a stack so the output
+    is always balanced. Input beyond ``max_input_size`` characters is cut
+    off and tags nested deeper than ``max_depth`` are flattened.
+    """
     
-    def __init__(self):
-        super().__init__()
+    def __init__(self, max_input_size=None, max_depth=None):
+        self.max_input_size = max_input_size or EMAIL_HTML_MAX_INPUT
+        self.max_depth = max_depth or EMAIL_HTML_MAX_DEPTH
         self.output = []
-        self.current_tag = None
-        self.current_attrs = {}
-        self.in_link = False
+        self.truncated = False
+        # (tag, closing markup) of every open tag; None for tags that emitted nothing
+        self._stack = []
+        self._link_href = None
+        self._link_open = False
         
-    def handle_starttag(self, tag, attrs):
-        attrs_dict = dict(attrs)
+    def feed(self, data):
+        if len(data) > self.max_input_size:
+            data = self._truncate(data)
         
-        if tag == 'a' and 'href' in attrs_dict:
-            self.in_link = True
-            href = attrs_dict['href']
-            # Ensure the URL is valid and safe
-            if href.startswith(('http://', 'https://', 'mailto:')):
-                self.output.append(f'<div class="email-link-section my-3">')
-                self.output.append(f'<a href="{html.escape(href)}" target="_blank" rel="noopener noreferrer" class="email-link-button">')
-        elif tag in ['p', 'div']:
-            if not self.in_link:
-                self.output.append('<div class="email-paragraph mb-3">')
+        match_token = _TOKEN_RE.match
+        pos = 0
+        end = len(data)
+        while pos < end:
+            token = match_token(data, pos)
+            pos = token.end()
+            # Comments, doctypes and processing instructions have no group
+            kind = token.lastgroup
+            
+            if kind == 'text':
+                self.handle_data(html.unescape(token.group('text')))
+            elif kind == 'lt':
+                if _TAG_START_RE.match(data, token.start()):
+                    # Nothing after an unterminated tag can close it, and
+                    # retrying at every later '<' would be quadratic
+                    self.handle_data(html.unescape(data[token.start():]))
+                    break
+                self.handle_data('<')
+            elif kind == 'attrs':
+                tag = token.group('tag').lower()
+                if token.group('end'):
+                    self.handle_endtag(tag)
+                elif tag in _SKIPPED_CONTENT_TAGS:
+                    skipped_end = _SKIPPED_CONTENT_END[tag].search(data, pos)
+                    pos = skipped_end.end() if skipped_end else end
+                else:
+                    attrs = token.group('attrs')
+                    self.handle_starttag(tag, attrs)
+                    if attrs.endswith('/'):
+                        self.handle_endtag(tag)
+    
+    def _truncate(self, data):
+        """Cut ``data`` to the size limit without splitting a tag"""
+        limit = self.max_input_size
+        last_open = data.rfind('<', 0, limit)
+        if last_open != -1 and data.find('>', last_open, limit) == -1:
+            limit = last_open
+        self.truncated = True
+        return data[:limit]
+    
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            href = _parse_href(attrs)
+            if href is None:
+                return
+            # Links do not nest; a new one ends the previous
+            self._close_link()
+            self._link_href = href
+            if href.startswith(_SAFE_LINK_PREFIXES):
+                self.output.append(_LINK_OPEN.format(html.escape(href)))
+                self._link_open = True
         elif tag == 'br':
             self.output.append('<br>')
-        elif tag in ['strong', 'b']:
-            self.output.append('<strong>')
-        elif tag in ['em', 'i']:
-            self.output.append('<em>')
-        elif tag in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
-            self.output.append(f'<{tag} class="email-heading font-bold mb-2">')
-        
-        self.current_tag = tag
-        self.current_attrs = attrs_dict
-        
+        elif tag in _OPEN_MARKUP:
+            if len(self._stack) >= self.max_depth:
+                return
+            if tag in _BLOCK_TAGS and self._link_href is not None:
+                self._stack.append((tag, None))
+            else:
+                self.output.append(_OPEN_MARKUP[tag])
+                self._stack.append((tag, _CLOSE_MARKUP[tag]))
+    
     def handle_endtag(self, tag):
-        if tag == 'a' and self.in_link:
-            self.output.append('</a></div>')
-            self.in_link = False
-        elif tag in ['p', 'div'] and not self.in_link:
-            self.output.append('</div>')
-        elif tag in ['strong', 'b']:
-            self.output.append('</strong>')
-        elif tag in ['em', 'i']:
-            self.output.append('</em>')
-        elif tag in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
-            self.output.append(f'</{tag}>')
-            
-        self.current_tag = None
-        
+        if tag == 'a':
+            self._close_link()
+        elif tag in _CLOSE_MARKUP:
+            stack = self._stack
+            for index in range(len(stack) - 1, -1, -1):
+                if stack[index][0] == tag:
+                    break
+            else:
+                return
+            # Close the matching tag and anything left open inside it
+            while len(stack) > index:
+                closing = stack.pop()[1]
+                if closing:
+                    self.output.append(closing)
+    
     def handle_data(self, data):
-        # Clean and format the text data
         clean_data = data.strip()
         if clean_data:
-            if self.in_link:
+            if self._link_href is not None:
                 # For links, create smart button text
-                link_text = self.get_smart_link_text(clean_data, self.current_attrs.get('href', ''))
-                self.output.append(link_text)
-            else:
-                # For regular text, escape HTML and preserve formatting
-                self.output.append(html.escape(clean_data))
+                clean_data = self.get_smart_link_text(clean_data, self._link_href)
+            self.output.append(html.escape(clean_data))
+    
+    def _close_link(self):
+        if self._link_open:
+            self.output.append(_LINK_CLOSE)
+        self._link_href = None
+        self._link_open = False
     
     def get_smart_link_text(self, original_text, href):
         """Generate smart link button text based on URL and content"""
-        href_lower = href.lower() if href else ""
-        text_lower = original_text.lower()
-        
-        # Smart button text based on URL patterns
-        if any(keyword in href_lower for keyword in ['verify', 'verification']):
-            return 'Verify Email'
-        elif any(keyword in href_lower for keyword in ['confirm', 'confirmation']):
-            return 'Confirm Account'
-        elif any(keyword in href_lower for keyword in ['activate', 'activation']):
-            return 'Activate Account'
-        elif any(keyword in href_lower for keyword in ['reset', 'password']):
-            return 'Reset Password'
-        elif any(keyword in href_lower for keyword in ['download']):
-            return 'Download'
-        elif any(keyword in href_lower for keyword in ['login', 'signin']):
-            return 'Login'
-        elif any(keyword in href_lower for keyword in ['signup', 'register']):
-            return 'Sign Up'
-        elif any(keyword in href_lower for keyword in ['unsubscribe']):
-            return 'Unsubscribe'
-        elif any(keyword in text_lower for keyword in ['verify', 'verification']):
-            return 'Verify Email'
-        elif any(keyword in text_lower for keyword in ['confirm']):
-            return 'Confirm Account'
-        elif len(original_text) > 50:  # Long URLs
-            return 'Open Link'
-        else:
-            return original_text if len(original_text) < 30 else 'Open Link'
+        label = (_match_label(_URL_LABEL_MATCHER, href.lower())
+                 or _match_label(_LINK_TEXT_LABEL_MATCHER, original_text.lower()))
+        if label:
+            return label
+        return original_text if len(original_text) < 30 else 'Open Link'
     
     def get_output(self):
+        self._close_link()
+        while self._stack:
+            closing = self._stack.pop()[1]
+            if closing:
+                self.output.append(closing)
+        if self.truncated:
+            self.output.append(_TRUNCATED_NOTICE)
+            self.truncated = False
         return ''.join(self.output)
 
+def _parse_href(attrs):
+    """Unescaped href value from a raw attribute string, or None without one"""
+    href = None
+    for name, double_quoted, single_quoted, unquoted in _ATTR_RE.findall(attrs):
+        if name.lower() == 'href':
+            href = double_quoted or single_quoted or unquoted
+    return html.unescape(href) if href is not None else None
+
 def process_email_content(html_content, text_content, body_content):
     """
     Process email content to create properly formatted HTML with working links
@@ -151,19 +291,115 @@ def process_email_content(html_content, text_content, body_content):
         # Process plain text content
         return process_text_content(content)
 
+class RenderedContentCache:
+    """Bounded LRU of processed message HTML keyed by message id
+    
+    Messages never change after they arrive, so the output of
+    ``process_email_content`` can be computed once and reused by every
+    page render and poll. At most ``max_size`` entries and ``max_bytes``
+    bytes of HTML are kept; the message stores ``discard`` the entries of
+    messages they drop.
+    """
+    
+    def __init__(self, max_size=5000, max_bytes=32 * 1024 * 1024):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def put(self, key, value):
+        size = sys.getsizeof(value)
+        with self._lock:
+            self._pop(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.size_bytes += size
+            while len(self._entries) > self.max_size or self.size_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size_bytes -= evicted_size
+    
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size_bytes -= entry[1]
+    
+    def discard(self, key):
+        with self._lock:
+            self._pop(key)
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'bytes': self.size_bytes,
+                'max_bytes': self.max_bytes
+            }
+
+rendered_content_cache = RenderedContentCache(
+    max_size=int(os.environ.get('RENDERED_CONTENT_CACHE_SIZE', 5000)),
+    max_bytes=int(float(os.environ.get('RENDERED_CONTENT_CACHE_MB', 32)) * 1024 * 1024)
+)
+
+def render_message(message):
+    """Return the processed HTML of a stored message, computing it at most once"""
+    processed = rendered_content_cache.get(message.id)
+    if processed is None:
+        processed = process_email_content(
+            getattr(message, 'html_content', ''),
+            getattr(message, 'text_content', ''),
+            getattr(message, 'body', '')
+        )
+        rendered_content_cache.put(message.id, processed)
+    return processed
+
+# Escaped line breaks (optionally after a real CR), CRLF and escaped tabs/quotes
+_JSON_ESCAPE_RE = re.compile(r'\r?(?:\\r\\n|\\n)|\r\n|\\t|\\["\']')
+_JSON_ESCAPES = {'\\n': '\n', '\r\n': '\n', '\\t': '\t', '\\"': '"', "\\'": "'"}
+
+# Leading and trailing JSON wrappers; '$' also matches before a final newline
+_JSON_ARRAY_START_RE = re.compile(r'\["?')
+_JSON_ARRAY_END_RE = re.compile(r'"?\]$')
+_JSON_QUOTE_START_RE = re.compile(r'"')
+_JSON_QUOTE_END_RE = re.compile(r'"?$')
+
+def _strip_ends(content, start_re, end_re):
+    """Remove a wrapper from both ends without scanning the whole string"""
+    match = start_re.match(content)
+    if match:
+        content = content[match.end():]
+    # The end patterns span at most three characters
+    return content[:-3] + end_re.sub('', content[-3:])
+
+def _unescape_json_artifact(match):
+    return _JSON_ESCAPES[match.group()[-2:]]
+
 def clean_json_artifacts(content):
     """Remove JSON formatting artifacts from content"""
     # Remove JSON array brackets and quotes
-    content = re.sub(r'^\["?|"?\]$', '', content)
-    content = re.sub(r'^"?|"?$', '', content)
+    content = _strip_ends(content, _JSON_ARRAY_START_RE, _JSON_ARRAY_END_RE)
+    content = _strip_ends(content, _JSON_QUOTE_START_RE, _JSON_QUOTE_END_RE)
     
-    # Fix escaped characters
-    content = content.replace('\\r\\n', '\n')
-    content = content.replace('\\n', '\n')
-    content = content.replace('\r\n', '\n')
-    content = content.replace('\\t', '\t')
-    content = content.replace('\\"', '"')
-    content = content.replace("\\'", "'")
+    # Fix escaped characters in one pass
+    content = _JSON_ESCAPE_RE.sub(_unescape_json_artifact, content)
     
     return content.strip()
 
@@ -184,87 +420,169 @@ def process_html_content(html_content):
         # If HTML parsing fails, process as text
         return process_text_content(html_content)
 
+# URLs in plain text, with or without a scheme
+_TEXT_URL_RE = re.compile(
+    r'https?://[^\s<>"\']{2,}|www\.[^\s<>"\']{2,}',
+    re.IGNORECASE
+)
+
+def _url_link_button(match):
+    """Replacement for one URL match: a link button pointing at it"""
+    url = match.group()
+    # Ensure URL has protocol
+    clean_url = url if url.startswith(('http://', 'https://')) else f'http://{url}'
+    return f'{_LINK_OPEN.format(html.escape(clean_url))}{get_url_button_text(clean_url)}{_LINK_CLOSE}'
+
 def process_text_content(text_content):
     """Process plain text email content, converting URLs to clickable links"""
-    lines = text_content.split('\n')
     processed_lines = []
     
-    # URL regex pattern
-    url_pattern = re.compile(
-        r'https?://[^\s<>"\']{2,}|www\.[^\s<>"\']{2,}',
-        re.IGNORECASE
-    )
-    
-    for line in lines:
+    for line in text_content.split('\n'):
         line = line.strip()
         if not line:
             continue
-            
-        # Check if line contains URLs
-        urls = url_pattern.findall(line)
         
-        if urls:
-            # Process each URL in the line
-            processed_line = line
-            for url in urls:
-                # Ensure URL has protocol
-                clean_url = url if url.startswith(('http://', 'https://')) else f'http://{url}'
-                
-                # Create button for the URL
-                button_text = get_url_button_text(clean_url)
-                link_html = f'<div class="email-link-section my-3"><a href="{html.escape(clean_url)}" target="_blank" rel="noopener noreferrer" class="email-link-button">{button_text}</a></div>'
-                
-                # Replace URL in text with the button
-                processed_line = processed_line.replace(url, link_html)
-            
-            processed_lines.append(processed_line)
+        # Replace every URL in the line with a button in a single pass,
+        # escaping the text between them
+        parts = []
+        pos = 0
+        for match in _TEXT_URL_RE.finditer(line):
+            parts.append(html.escape(line[pos:match.start()]))
+            parts.append(_url_link_button(match))
+            pos = match.end()
+        if parts:
+            parts.append(html.escape(line[pos:]))
+            processed_lines.append(''.join(parts))
         else:
             # Regular text line
-            if line:
-                processed_lines.append(f'<div class="email-paragraph mb-3">{html.escape(line)}</div>')
+            processed_lines.append(f'<div class="email-paragraph mb-3">{html.escape(line)}</div>')
     
     return f'<div class="gmail-email-content">{"".join(processed_lines)}</div>'
 
 def get_url_button_text(url):
     """Generate appropriate button text for a URL"""
-    url_lower = url.lower()
+    return _match_label(_URL_LABEL_MATCHER, url.lower()) or 'Open Link'
+
+# One-time code candidates: 4-8 digits (optionally split as 123-456 or
+# 123 456) or 4-8 uppercase letters/digits containing at least one digit
+_CODE_RE = re.compile(
+    r'\b(?:(?P<split>\d{3,4})[- ](?P<split_end>\d{3,4})'
+    r'|(?P<digits>\d{4,8})'
+    r'|(?P<mixed>(?=[A-Z]*\d)[A-Z0-9]{4,8}))\b'
+)
+# Words that introduce a code, searched for just before each candidate
+_CODE_CONTEXT_RE = re.compile(
+    r'code|otp|pin|passcode|password|one[- ]time|verif|confirm|security|log ?in|sign[- ]?in|token',
+    re.IGNORECASE
+)
+# Prices, order numbers and phone numbers are not codes
+_NON_CODE_CONTEXT_RE = re.compile(r'[$€£#]\s*$|(?:order|invoice|phone|tel|call|ref|id)\W{0,3}$', re.IGNORECASE)
+_CODE_CONTEXT_WINDOW = 40
+# Tags end at the next '<' too, so an unclosed one is not rescanned from
+# every later '<'
+_HTML_SKIPPED_START_RE = re.compile(r'<(script|style)\b', re.IGNORECASE)
+_HTML_TAG_RE = re.compile(r'<[^<>]*>')
+_HREF_VALUE_RE = re.compile(r'\bhref\s*=\s*(?:"([^"]*)"|\'([^\']*)\')', re.IGNORECASE)
+_URL_LABEL_PRIORITY = {label: priority for priority, (_, label) in enumerate(_URL_LABELS)}
+_MAX_CODES = 5
+_MAX_ACTION_LINKS = 5
+
+def _html_to_text(html_content):
+    """Visible text of an HTML body, tags replaced by spaces"""
+    parts = []
+    pos = 0
+    while True:
+        start = _HTML_SKIPPED_START_RE.search(html_content, pos)
+        end = start and _SKIPPED_CONTENT_END[start.group(1).lower()].search(html_content, start.end())
+        if not end:
+            # An unclosed script or style is kept, as the tags around it are
+            parts.append(html_content[pos:])
+            break
+        parts.append(html_content[pos:start.start()])
+        pos = end.end()
+    text = ' '.join(parts)
+    return html.unescape(_HTML_TAG_RE.sub(' ', text))
+
+def _score_code(match, text):
+    """Rank a code candidate, higher is more likely; None rejects it"""
+    before = text[max(0, match.start() - _CODE_CONTEXT_WINDOW):match.start()]
+    if _NON_CODE_CONTEXT_RE.search(before):
+        return None
     
-    if any(keyword in url_lower for keyword in ['verify', 'verification']):
-        return 'Verify Email'
-    elif any(keyword in url_lower for keyword in ['confirm', 'confirmation']):
-        return 'Confirm Account'
-    elif any(keyword in url_lower for keyword in ['activate', 'activation']):
-        return 'Activate Account'
-    elif any(keyword in url_lower for keyword in ['reset', 'password']):
-        return 'Reset Password'
-    elif any(keyword in url_lower for keyword in ['download']):
-        return 'Download'
-    elif any(keyword in url_lower for keyword in ['login', 'signin']):
-        return 'Login'
-    elif any(keyword in url_lower for keyword in ['signup', 'register']):
-        return 'Sign Up'
-    elif any(keyword in url_lower for keyword in ['unsubscribe']):
-        return 'Unsubscribe'
+    digits = match.group('digits')
+    if digits is not None:
+        # Four digits starting 19/20 are far more often a year than a code,
+        # unless the code context below says otherwise
+        if len(digits) == 4 and digits[:2] in ('19', '20'):
+            score = 0
+        else:
+            score = 3 if len(digits) == 6 else 2
+    elif match.group('split') is not None:
+        score = 2
     else:
-        return 'Open Link'
+        score = 1
+    
+    if _CODE_CONTEXT_RE.search(before):
+        score += 5
+    return score or None
 
-def extract_verification_codes(content):
-    """Extract and highlight verification codes from email content"""
-    # Common patterns for verification codes
-    patterns = [
-        r'\b[A-Z0-9]{4,8}\b',  # Alphanumeric codes
-        r'\b\d{4,8}\b',        # Numeric codes
-        r'\b[A-Z]{4,8}\b',     # Letter codes
-    ]
+def extract_verification_info(subject, text_content, html_content):
+    """Find one-time codes and action links in a message
+    
+    Returns ``(codes, links)``: up to five candidate codes, most likely
+    first, and up to five ``{'url', 'label'}`` links that look like account
+    actions (verify, confirm, reset, ...), highest-priority label first.
+    """
+    if isinstance(html_content, list):
+        # mail.tm sends the HTML body as a list of parts
+        html_content = ' '.join(part for part in html_content if isinstance(part, str))
+    text = text_content or _html_to_text(html_content or '')
+    # URLs are only scanned for links; their path segments are not codes
+    urls = _TEXT_URL_RE.findall(text)
+    text = f"{subject or ''}\n{_TEXT_URL_RE.sub(' ', text)}"
     
-    highlighted_content = content
-    for pattern in patterns:
-        matches = re.finditer(pattern, content)
-        for match in matches:
-            code = match.group()
-            # Only highlight if it looks like a verification code (not too common words)
-            if not code.lower() in ['your', 'email', 'code', 'here', 'link', 'click', 'this', 'that']:
-                highlighted_code = f'<span class="verification-code">{code}</span>'
-                highlighted_content = highlighted_content.replace(code, highlighted_code, 1)
+    scored = {}
+    for position, match in enumerate(_CODE_RE.finditer(text)):
+        score = _score_code(match, text)
+        if score is None:
+            continue
+        code = match.group('digits') or match.group('mixed') or match.group('split') + match.group('split_end')
+        if code not in scored or scored[code][0] < score:
+            scored[code] = (score, -position)
+    codes = sorted(scored, key=scored.get, reverse=True)[:_MAX_CODES]
     
-    return highlighted_content
\ No newline at end of file
+    hrefs = [double_quoted or single_quoted
+             for double_quoted, single_quoted in _HREF_VALUE_RE.findall(html_content or '')]
+    links = {}
+    for url in map(html.unescape, hrefs + urls):
+        if url in links or not url.startswith(('http://', 'https://')):
+            continue
+        label = _match_label(_URL_LABEL_MATCHER, url.lower())
+        if label and label != 'Unsubscribe':
+            links[url] = label
+    ranked_links = sorted(links.items(), key=lambda item: _URL_LABEL_PRIORITY[item[1]])
+    return codes, [{'url': url, 'label': label} for url, label in ranked_links[:_MAX_ACTION_LINKS]]
+
+def annotate_message(message):
+    """Store verification codes and action links on a message, once at ingest"""
+    message.verification_codes, message.action_links = extract_verification_info(
+        getattr(message, 'subject', ''),
+        getattr(message, 'text_content', ''),
+        getattr(message, 'html_content', '')
+    )
+    return message
+
+# Words the highlighter never treats as codes
+_CODE_STOPWORDS = frozenset(('your', 'email', 'code', 'here', 'link', 'click', 'this', 'that'))
+_HIGHLIGHT_CODE_RE = re.compile(r'\b[A-Z0-9]{4,8}\b')
+
+def _highlight_code(match):
+    code = match.group()
+    if code.lower() in _CODE_STOPWORDS:
+        return code
+    return f'<span class="verification-code">{code}</span>'
+
+def extract_verification_codes(content):
+    """Extract and highlight verification codes from email content"""
+    # One pattern covers the alphanumeric, numeric and letter codes
+    return _HIGHLIGHT_CODE_RE.sub(_highlight_code, content)
@@ -0,0 +1,53 @@
+import logging
+import threading
+from datetime import datetime
+
+
+class ExpiryReaper:
+    """Background thread that deletes expired inboxes and their messages
+
+    Expiry times live in the inbox store's min-heap, so each tick only looks
+    at inboxes that are actually due. At most ``batch_size`` inboxes are
+    removed per tick to keep lock hold times short.
+    """
+
+    def __init__(self, temp_emails, email_messages, interval=30, batch_size=500,
+                 backlog_interval=1):
+        self.temp_emails = temp_emails
+        self.email_messages = email_messages
+        self.interval = interval
+        self.batch_size = batch_size
+        self.backlog_interval = backlog_interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def reap(self, now=None):
+        """Remove one batch of expired inboxes, returning how many were removed"""
+        expired = self.temp_emails.pop_expired(now or datetime.utcnow(), self.batch_size)
+        for email in expired:
+            self.email_messages.delete_for_inbox(email.id)
+
+        if expired:
+            logging.info(f"Reaped {len(expired)} expired emails")
+        return len(expired)
+
+    def _run(self):
+        delay = self.interval
+        while not self._stop.wait(delay):
+            try:
+                removed = self.reap()
+            except Exception as e:
+                logging.error(f"Error reaping expired emails: {e}")
+                removed = 0
+
+            # Come back sooner while there is a backlog of expired inboxes
+            delay = self.backlog_interval if removed >= self.batch_size else self.interval
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='expiry-reaper', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
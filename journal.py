@@ -0,0 +1,365 @@
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking, single process only
+    fcntl = None
+
+from models import TempEmail, EmailMessage
+
+SNAPSHOT_FILE = 'snapshot.jsonl'
+SEGMENT_PATTERN = 'journal-*.log'
+LOCK_FILE = 'compact.lock'
+
+INBOX_FIELDS = ('id', 'email_address', 'session_id', 'is_active', 'mail_tm_id',
+                'mail_tm_password', 'created_at', 'expires_at')
+MESSAGE_FIELDS = ('id', 'temp_email_id', 'sender_email', 'sender_name', 'subject', 'body',
+                  'text_content', 'html_content', 'received_at', 'is_spam', 'is_read',
+                  'mail_tm_id', 'verification_codes', 'action_links')
+DATETIME_FIELDS = ('created_at', 'expires_at', 'received_at')
+
+
+def _to_record(obj, fields):
+    record = {}
+    for field in fields:
+        value = getattr(obj, field, None)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        record[field] = value
+    return record
+
+
+def _restore(obj, record):
+    for field, value in record.items():
+        if field in DATETIME_FIELDS and value:
+            value = datetime.fromisoformat(value)
+        setattr(obj, field, value)
+    return obj
+
+
+def inbox_to_record(email):
+    return _to_record(email, INBOX_FIELDS)
+
+
+def message_to_record(message):
+    return _to_record(message, MESSAGE_FIELDS)
+
+
+def inbox_from_record(record):
+    return _restore(TempEmail(session_id=record['session_id'], use_real_email=True), record)
+
+
+def message_from_record(record):
+    message = _restore(EmailMessage(record['temp_email_id'], record['sender_email']),
+                       {field: value for field, value in record.items() if field != 'body'})
+    # Set after the content fields so a body repeating them is not stored twice
+    message.body = record.get('body')
+    return message
+
+
+def _segment_ts(path):
+    """Creation time in the name of a segment; all its records are at least this new"""
+    return int(os.path.basename(path).rsplit('-', 1)[1].split('.')[0])
+
+
+def _try_lock(fd):
+    """Take an exclusive lock on ``fd`` without blocking; True on success"""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+class JournalState:
+    """Inboxes and messages folded from snapshot and journal records
+
+    Every record sets or deletes one entry, so folding is last-writer-wins
+    and replaying a record twice is harmless.
+    """
+
+    def __init__(self):
+        self.inboxes = {}
+        self.messages = {}
+        # temp_email_id -> {message_id: None}
+        self._by_inbox = {}
+
+    def apply(self, record):
+        op = record['op']
+        if op == 'inbox':
+            self.inboxes[record['data']['id']] = record['data']
+        elif op == 'message':
+            data = record['data']
+            self.messages[data['id']] = data
+            self._by_inbox.setdefault(data['temp_email_id'], {})[data['id']] = None
+        elif op == 'message_delete':
+            data = self.messages.pop(record['id'], None)
+            if data is not None:
+                self._by_inbox.get(data['temp_email_id'], {}).pop(record['id'], None)
+        elif op in ('inbox_delete', 'inbox_messages_delete'):
+            if op == 'inbox_delete':
+                self.inboxes.pop(record['id'], None)
+            for message_id in self._by_inbox.pop(record['id'], ()):
+                self.messages.pop(message_id, None)
+
+    def drop_inboxes(self, email_ids):
+        for email_id in email_ids:
+            self.apply({'op': 'inbox_delete', 'id': email_id})
+
+    def drop_orphans(self):
+        """Forget messages whose inbox no longer exists"""
+        self.drop_inboxes([email_id for email_id in self._by_inbox if email_id not in self.inboxes])
+
+
+class Journal:
+    """Append-only persistence for the inbox and message stores
+
+    Every change is appended as one JSON line to this process's journal
+    segment with a single ``write`` call, so the cost of an event does not
+    depend on how much is stored. A background thread periodically folds
+    the snapshot and all finished segments into a new snapshot, written to
+    a temporary file and swapped in with ``os.replace`` so a crash never
+    leaves a half-written snapshot behind.
+
+    Several processes (e.g. gunicorn workers) can share one directory:
+    each appends to its own segment and holds a lock on it while it is
+    being written. Records are replayed in timestamp order, so compaction
+    only folds finished segments whose records are all older than every
+    record left outside the snapshot.
+    """
+
+    def __init__(self, directory, compact_interval=300):
+        self.directory = directory
+        self.compact_interval = compact_interval
+        self._lock = threading.Lock()
+        self._fd = None
+        self._segment = None
+        self._stop = threading.Event()
+        self._thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    # Recording
+    def inbox_added(self, email):
+        self._append({'op': 'inbox', 'data': inbox_to_record(email)})
+
+    def inbox_removed(self, email_id):
+        self._append({'op': 'inbox_delete', 'id': email_id})
+
+    def message_added(self, message):
+        self._append({'op': 'message', 'data': message_to_record(message)})
+
+    def message_removed(self, message_id):
+        self._append({'op': 'message_delete', 'id': message_id})
+
+    def inbox_messages_removed(self, temp_email_id):
+        self._append({'op': 'inbox_messages_delete', 'id': temp_email_id})
+
+    def _append(self, record):
+        with self._lock:
+            try:
+                if self._fd is None:
+                    self._open_segment()
+                # Stamped after the segment is opened, so no record is older
+                # than the time in its segment's name
+                record['ts'] = time.time_ns()
+                os.write(self._fd, (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8'))
+            except OSError as e:
+                logging.error(f"Error writing journal record: {e}")
+
+    def _open_segment(self):
+        # Lock the segment before it becomes visible to compaction
+        segment = os.path.join(self.directory, f'journal-{os.getpid()}-{time.time_ns()}.log')
+        fd = os.open(f'{segment}.new', os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        _try_lock(fd)
+        os.rename(f'{segment}.new', segment)
+        self._fd = fd
+        self._segment = segment
+
+    def _close_segment(self):
+        """Finish the current segment so compaction can fold it (call with the lock held)"""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._segment = None
+    
+    # Reading
+    def _read_snapshot(self, state):
+        """Fold the snapshot into ``state``, returning the segments it already contains"""
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        if not os.path.exists(path):
+            return set()
+        folded = set()
+        with open(path, encoding='utf-8') as f:
+            for number, line in enumerate(f):
+                record = json.loads(line)
+                if number == 0 and record.get('op') == 'header':
+                    folded = set(record.get('folded', ()))
+                    continue
+                state.apply(record)
+        return folded
+
+    def _read_segments(self, paths):
+        """All records of the given segments, in the order they were written"""
+        records = []
+        for path in paths:
+            try:
+                with open(path, encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            # Torn last line of a segment whose writer crashed
+                            continue
+            except OSError as e:
+                logging.error(f"Error reading journal segment {path}: {e}")
+        records.sort(key=lambda record: record.get('ts', 0))
+        return records
+
+    def _segments(self):
+        return sorted(glob.glob(os.path.join(self.directory, SEGMENT_PATTERN)))
+
+    def load(self, temp_emails, email_messages):
+        """Fill the stores from snapshot plus journal, returning (inboxes, messages)"""
+        state = JournalState()
+        folded = self._read_snapshot(state)
+        segments = [path for path in self._segments() if os.path.basename(path) not in folded]
+        for record in self._read_segments(segments):
+            state.apply(record)
+        state.drop_orphans()
+
+        for record in state.inboxes.values():
+            temp_emails.add(inbox_from_record(record))
+        for record in state.messages.values():
+            email_messages.add(message_from_record(record))
+        return len(state.inboxes), len(state.messages)
+
+    # Compaction
+    def compact(self, now=None):
+        """Fold the snapshot and every finished segment into a new snapshot
+
+        Returns the number of segments folded, or None if another process
+        is compacting right now.
+        """
+        with self._lock:
+            self._close_segment()
+        if not self._segments():
+            return 0
+
+        lock_fd = os.open(os.path.join(self.directory, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if not _try_lock(lock_fd):
+                return None
+
+            state = JournalState()
+            folded = self._read_snapshot(state)
+
+            # Segments still held open by a writer are left for a later pass
+            segments = []
+            finished = []
+            segment_fds = []
+            held_since = float('inf')
+            for path in self._segments():
+                if os.path.basename(path) in folded:
+                    segments.append(path)
+                    continue
+                try:
+                    fd = os.open(path, os.O_RDONLY)
+                except OSError:
+                    continue
+                if _try_lock(fd):
+                    finished.append(path)
+                    segment_fds.append(fd)
+                else:
+                    os.close(fd)
+                    held_since = min(held_since, _segment_ts(path))
+
+            try:
+                new_segments, records = self._foldable(finished, held_since)
+                segments += new_segments
+                for record in records:
+                    state.apply(record)
+
+                # Expired inboxes would only be reaped again after a restart
+                now = now or datetime.utcnow()
+                state.drop_inboxes([
+                    email_id for email_id, data in state.inboxes.items()
+                    if data.get('expires_at') and datetime.fromisoformat(data['expires_at']) <= now
+                ])
+                state.drop_orphans()
+                self._write_snapshot(state, [os.path.basename(path) for path in segments])
+            finally:
+                for fd in segment_fds:
+                    os.close(fd)
+
+            for path in segments:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            return len(new_segments)
+        finally:
+            os.close(lock_fd)
+
+    def _foldable(self, finished, held_since):
+        """The oldest finished segments that can be folded, and their records
+
+        A segment is only folded if all its records are older than every
+        record of the segments left out (held ones included). Otherwise,
+        replaying those after the snapshot could re-add an inbox or a message
+        that a folded, later record deleted.
+        """
+        finished = sorted((path for path in finished if _segment_ts(path) < held_since),
+                          key=_segment_ts)
+        records = [self._read_segments([path]) for path in finished]
+        newest = [segment[-1].get('ts', 0) if segment else 0 for segment in records]
+        count = len(finished)
+        while count:
+            # Records of unfolded segments are no older than their segment's name
+            boundary = held_since
+            if count < len(finished):
+                boundary = min(boundary, _segment_ts(finished[count]))
+            if max(newest[:count]) < boundary:
+                break
+            count -= 1
+        folded = [record for segment in records[:count] for record in segment]
+        folded.sort(key=lambda record: record.get('ts', 0))
+        return finished[:count], folded
+
+    def _write_snapshot(self, state, folded):
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'op': 'header', 'folded': folded}) + '\n')
+            for data in state.inboxes.values():
+                f.write(json.dumps({'op': 'inbox', 'data': data}, separators=(',', ':')) + '\n')
+            for data in state.messages.values():
+                f.write(json.dumps({'op': 'message', 'data': data}, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _run(self):
+        while not self._stop.wait(self.compact_interval):
+            try:
+                self.compact()
+            except Exception as e:
+                logging.error(f"Error compacting journal: {e}")
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='journal-compactor', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._lock:
+            self._close_segment()
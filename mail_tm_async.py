@@ -0,0 +1,227 @@
+import asyncio
+import logging
+import os
+
+import aiohttp
+
+from mail_tm_service import TokenCache, extract_members, has_next_page, parse_domains
+
+
+class AsyncMailTMClient:
+    """Asyncio client for the mail.tm API
+
+    Offers the same operations as ``MailTMService`` but as coroutines over
+    one shared aiohttp connection pool, so a single event loop can keep many
+    inbox fetches in flight without a thread per request. Like the blocking
+    client it talks to ``MAIL_TM_BASE_URL`` unless given ``base_url``, reads
+    at most ``MAIL_TM_SYNC_MAX_PAGES`` pages of messages, and syncs
+    incrementally with a ``SyncCursor``. Use it as an async context manager,
+    or call ``close()`` when done:
+
+        async with AsyncMailTMClient() as client:
+            token = await client.get_cached_token(address, password)
+            new_items, known_items, complete = await client.get_new_messages(token, cursor)
+    """
+
+    def __init__(self, base_url=None, max_connections=100, timeout=30, token_cache=None,
+                 sync_max_pages=None):
+        self.base_url = (base_url or os.environ.get('MAIL_TM_BASE_URL', "https://api.mail.tm")).rstrip('/')
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.token_cache = token_cache or TokenCache()
+        self.sync_max_pages = sync_max_pages or int(os.environ.get('MAIL_TM_SYNC_MAX_PAGES', 10))
+        self._session = None
+        # address -> asyncio.Lock held while a token for it is fetched
+        self._fetch_locks = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @property
+    def session(self):
+        """Lazily created aiohttp session shared by all requests of this client"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={
+                    'Content-Type': 'application/json',
+                    'Accept': 'application/json'
+                }
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def get_available_domains(self):
+        """Get list of available domains from mail.tm"""
+        try:
+            async with self.session.get(f"{self.base_url}/domains") as response:
+                if response.status != 200:
+                    logging.error(f"Failed to get domains: {response.status} - {await response.text()}")
+                    return []
+                data = await response.json(content_type=None)
+
+            domains = parse_domains(data)
+            if domains is None:
+                logging.error(f"Unexpected response format: {data}")
+                return []
+            return domains
+        except Exception as e:
+            logging.error(f"Error getting domains: {e}")
+            return []
+
+    async def create_account(self, email_address, password):
+        """Create a new account on mail.tm"""
+        try:
+            data = {"address": email_address, "password": password}
+            async with self.session.post(f"{self.base_url}/accounts", json=data) as response:
+                if response.status == 201:
+                    return await response.json(content_type=None)
+                logging.error(f"Failed to create account: {await response.text()}")
+                return None
+        except Exception as e:
+            logging.error(f"Error creating account: {e}")
+            return None
+
+    async def get_auth_token(self, email_address, password):
+        """Get authentication token for accessing emails"""
+        try:
+            data = {"address": email_address, "password": password}
+            async with self.session.post(f"{self.base_url}/token", json=data) as response:
+                if response.status == 200:
+                    return (await response.json(content_type=None))['token']
+                logging.error(f"Failed to get token: {await response.text()}")
+                return None
+        except Exception as e:
+            logging.error(f"Error getting token: {e}")
+            return None
+
+    async def get_cached_token(self, email_address, password):
+        """Get an authentication token, reusing a cached one while it is valid"""
+        token = self.token_cache.get(email_address)
+        if token:
+            return token
+
+        # Only one task fetches a token for a given address at a time
+        fetch_lock = self._fetch_locks.setdefault(email_address, asyncio.Lock())
+        async with fetch_lock:
+            token = self.token_cache.get(email_address)
+            if token:
+                return token
+            self.token_cache.record_miss()
+            token = await self.get_auth_token(email_address, password)
+            if token:
+                self.token_cache.put(email_address, token)
+        self._fetch_locks.pop(email_address, None)
+        return token
+
+    async def _authorized_get(self, url, token, account=None):
+        """GET a JSON document, refreshing the token once on a 401 when ``account`` is given
+
+        Returns ``(status, data)``; ``data`` is None unless the status is 200.
+        """
+        for attempt in range(2):
+            headers = {'Authorization': f'Bearer {token}'}
+            async with self.session.get(url, headers=headers) as response:
+                if response.status == 200:
+                    return response.status, await response.json(content_type=None)
+                status = response.status
+
+            if status != 401 or not account or attempt:
+                return status, None
+            email_address, password = account
+            self.token_cache.invalidate(email_address, token)
+            token = await self.get_cached_token(email_address, password)
+            if not token:
+                return status, None
+
+    async def get_messages_page(self, token, page=1, account=None):
+        """Get one page of messages, newest first
+
+        Returns ``(messages, has_next)``; ``messages`` is None if the page
+        could not be read.
+        """
+        try:
+            status, data = await self._authorized_get(
+                f"{self.base_url}/messages?page={page}", token, account
+            )
+            if status != 200:
+                logging.error(f"Failed to get messages: {status}")
+                return None, False
+
+            messages = extract_members(data, 'messages')
+            if messages is None:
+                logging.error(f"Unexpected messages response format: {data}")
+                return None, False
+            return messages, has_next_page(data)
+        except Exception as e:
+            logging.error(f"Error getting messages: {e}")
+            return None, False
+
+    async def get_messages(self, token, account=None):
+        """Get the messages of the authenticated account, newest first
+
+        Reads up to ``sync_max_pages`` pages and stops at the first page that
+        fails.
+        """
+        messages = []
+        for page in range(1, self.sync_max_pages + 1):
+            page_messages, has_next = await self.get_messages_page(token, page, account)
+            messages += page_messages or []
+            if not has_next:
+                break
+        return messages
+
+    async def get_new_messages(self, token, cursor, account=None, is_stored=None):
+        """Walk message pages newest first until reaching already-synced messages
+
+        Same contract as ``MailTMService.get_new_messages``: returns
+        ``(new_items, known_items, complete)``, and ``cursor.advance`` should
+        be given ``complete`` once the new messages are stored.
+        """
+        new_items = []
+        known_items = []
+        for page in range(1, self.sync_max_pages + 1):
+            messages, has_next = await self.get_messages_page(token, page, account)
+            if messages is None:
+                return new_items, known_items, False
+            if cursor.collect(messages, new_items, known_items, is_stored) or not has_next:
+                return new_items, known_items, True
+        return new_items, known_items, False
+
+    async def get_message_details(self, message_id, token, account=None):
+        """Get detailed content of a specific message"""
+        try:
+            status, data = await self._authorized_get(
+                f"{self.base_url}/messages/{message_id}", token, account
+            )
+            return data if status == 200 else None
+        except Exception as e:
+            logging.error(f"Error getting message details: {e}")
+            return None
+
+    async def fetch_message_lists(self, accounts, concurrency=500):
+        """Fetch the message list of many accounts at once
+
+        ``accounts`` is an iterable of ``(email_address, password)`` pairs.
+        Returns ``{email_address: [message, ...]}``; accounts that could not be
+        fetched map to an empty list. At most ``concurrency`` accounts are in
+        flight at a time.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch_one(account):
+            async with semaphore:
+                token = await self.get_cached_token(*account)
+                if not token:
+                    return account[0], []
+                return account[0], await self.get_messages(token, account)
+
+        results = await asyncio.gather(*(fetch_one(account) for account in accounts))
+        return dict(results)
@@ -1,43 +1,356 @@
+import os
 import requests
 import json
 import logging
+import base64
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import hashlib
+from email_utils import annotate_message, render_message
+from utils import spam_matcher
+
+def extract_members(data, collection_key):
+    """Return the item list of a mail.tm collection response, or None
+    
+    Handles plain lists as well as the ``hydra:member``, ``@graph``,
+    ``<collection_key>`` and ``data`` envelopes.
+    """
+    if isinstance(data, list):
+        return data
+    elif isinstance(data, dict):
+        for key in ('hydra:member', '@graph', collection_key, 'data'):
+            if key in data:
+                return data[key]
+    return None
+
+def parse_domains(data):
+    """Return the domain names from a /domains response, or None"""
+    members = extract_members(data, 'domains')
+    if members is None:
+        return None
+    return [domain['domain'] for domain in members if 'domain' in domain]
+
+def has_next_page(data):
+    """Whether a paged mail.tm collection response links to a further page"""
+    return isinstance(data, dict) and bool(data.get('hydra:view', {}).get('hydra:next'))
+
+def parse_created_at(value):
+    """Parse a mail.tm ``createdAt`` timestamp into an aware datetime, or None"""
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+class SyncCursor:
+    """Per-inbox record of how far the mail.tm message list has been synced
+    
+    ``watermark`` is the ``createdAt`` up to which every message is stored,
+    and ``seen_ids`` maps the ids stored at or after it to their
+    ``createdAt``. mail.tm lists messages newest first, so a sync can stop
+    at the first message older than the watermark.
+    """
+    
+    NEW, SEEN, OLDER = 'new', 'seen', 'older'
+    
+    def __init__(self):
+        self.watermark = None
+        self.last_seen_id = None
+        self.seen_ids = {}
+    
+    def classify(self, msg):
+        if msg['id'] in self.seen_ids:
+            return self.SEEN
+        created_at = parse_created_at(msg.get('createdAt'))
+        if self.watermark and created_at and created_at < self.watermark:
+            return self.OLDER
+        return self.NEW
+    
+    def collect(self, messages, new_items, known_items, is_stored=None):
+        """Sort one listing page into ``new_items`` and ``known_items``
+        
+        Returns True once the page reaches a message older than the
+        watermark, where a walk over the pages can stop.
+        """
+        for msg in messages:
+            state = self.classify(msg)
+            if state == self.OLDER:
+                return True
+            if state == self.SEEN:
+                continue
+            if is_stored and is_stored(msg['id']):
+                known_items.append(msg)
+            else:
+                new_items.append(msg)
+        return False
+    
+    def advance(self, stored, failed=(), complete=True):
+        """Record a sync of listing items that are now ``stored`` or ``failed``
+        
+        ``complete`` is False when the sync stopped before reaching the
+        watermark or the last page. Messages on the pages it did not read
+        are older than everything it read, so the watermark stays put and
+        only the stored ids are remembered.
+        """
+        for msg in stored:
+            self.seen_ids[msg['id']] = parse_created_at(msg.get('createdAt'))
+        
+        dated = [(created_at, msg_id) for msg_id, created_at in self.seen_ids.items() if created_at]
+        if not dated:
+            return
+        newest, self.last_seen_id = max(dated)
+        if not complete:
+            return
+        
+        # Failed messages must be listed again next time, so the watermark
+        # cannot move past the oldest of them
+        for msg in failed:
+            created_at = parse_created_at(msg.get('createdAt'))
+            if created_at is None:
+                return
+            newest = min(newest, created_at)
+        if self.watermark and newest <= self.watermark:
+            return
+        
+        self.watermark = newest
+        # Ids older than the watermark are covered by it and can be dropped
+        self.seen_ids = {
+            msg_id: created_at for msg_id, created_at in self.seen_ids.items()
+            if created_at is None or created_at >= newest
+        }
+
+class TokenCache:
+    """Thread-safe cache of mail.tm bearer tokens keyed by account address
+    
+    Tokens are reused until ``refresh_margin`` seconds before the ``exp``
+    claim of their JWT. Tokens without a readable ``exp`` are kept for
+    ``default_ttl`` seconds. At most ``max_size`` tokens are kept (LRU).
+    """
+    
+    def __init__(self, refresh_margin=60, default_ttl=600, max_size=10000):
+        self.refresh_margin = refresh_margin
+        self.default_ttl = default_ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._tokens = OrderedDict()
+        self._lock = threading.Lock()
+        self._fetch_locks = {}
+    
+    @staticmethod
+    def jwt_expiry(token):
+        """Return the ``exp`` claim of a JWT as a POSIX timestamp, or None"""
+        try:
+            payload = token.split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            claims = json.loads(base64.urlsafe_b64decode(payload))
+            return float(claims['exp'])
+        except Exception:
+            return None
+    
+    def get(self, address):
+        """Return a cached token that is still valid, or None"""
+        with self._lock:
+            entry = self._tokens.get(address)
+            if entry and entry[1] > time.time():
+                self._tokens.move_to_end(address)
+                self.hits += 1
+                return entry[0]
+            return None
+    
+    def put(self, address, token):
+        expires_at = self.jwt_expiry(token)
+        if expires_at is None:
+            expires_at = time.time() + self.default_ttl
+        with self._lock:
+            self._tokens[address] = (token, expires_at - self.refresh_margin)
+            self._tokens.move_to_end(address)
+            while len(self._tokens) > self.max_size:
+                self._tokens.popitem(last=False)
+    
+    def invalidate(self, address, token=None):
+        """Drop a cached token (only if it is still ``token``, when given)"""
+        with self._lock:
+            entry = self._tokens.get(address)
+            if entry and (token is None or entry[0] == token):
+                del self._tokens[address]
+                self.invalidations += 1
+    
+    def get_or_fetch(self, address, fetch):
+        """Return a cached token or call ``fetch()`` once per address to get one"""
+        token = self.get(address)
+        if token:
+            return token
+        
+        # Only one thread fetches a token for a given address at a time
+        with self._lock:
+            fetch_lock = self._fetch_locks.setdefault(address, threading.Lock())
+        with fetch_lock:
+            token = self.get(address)
+            if token:
+                return token
+            self.record_miss()
+            token = fetch()
+            if token:
+                self.put(address, token)
+        with self._lock:
+            self._fetch_locks.pop(address, None)
+        return token
+    
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'size': len(self._tokens)
+            }
+
+class DomainCache:
+    """Stale-while-revalidate cache for the mail.tm domain list
+    
+    A list younger than ``ttl`` seconds is served as is. An older list is
+    still served while a background thread fetches a fresh one. A failed
+    refresh keeps the last good list. Only an empty cache makes the caller
+    wait for the upstream request.
+    """
+    
+    def __init__(self, fetch, ttl=3600, retry_interval=60):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.failures = 0
+        self._domains = []
+        self._fetched_at = 0
+        self._refreshing = False
+        self._lock = threading.Lock()
+    
+    def get(self):
+        with self._lock:
+            domains = self._domains
+            stale = time.time() - self._fetched_at >= self.ttl
+            if domains:
+                self.hits += 1
+                if stale and not self._refreshing:
+                    self._refreshing = True
+                    threading.Thread(target=self._refresh, name='mail-tm-domains',
+                                     daemon=True).start()
+                return list(domains)
+            self.misses += 1
+        
+        self._refresh()
+        with self._lock:
+            return list(self._domains)
+    
+    def _refresh(self):
+        try:
+            domains = self.fetch()
+        except Exception as e:
+            logging.error(f"Error refreshing domains: {e}")
+            domains = []
+        
+        with self._lock:
+            self._refreshing = False
+            if domains:
+                self._domains = domains
+                self._fetched_at = time.time()
+                self.refreshes += 1
+            else:
+                # Keep serving the last good list and retry sooner than the TTL
+                self.failures += 1
+                if self._domains:
+                    self._fetched_at = time.time() - self.ttl + self.retry_interval
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+                'failures': self.failures,
+                'size': len(self._domains),
+                'age': time.time() - self._fetched_at if self._domains else None
+            }
 
 class MailTMService:
     """Service to integrate with mail.tm API for real temporary emails"""
     
     def __init__(self):
-        self.base_url = "https://api.mail.tm"
+        # Overridable to run against a local stand-in (benchmarks/fake_mail_tm.py)
+        self.base_url = os.environ.get('MAIL_TM_BASE_URL', "https://api.mail.tm").rstrip('/')
         self.session = requests.Session()
         self.session.headers.update({
             'Content-Type': 'application/json',
             'Accept': 'application/json'
         })
+        self.token_cache = TokenCache()
+        self.domain_cache = DomainCache(
+            self.fetch_available_domains,
+            ttl=float(os.environ.get('MAIL_TM_DOMAINS_TTL', 3600))
+        )
+        
+        # Account creation is spaced out to stay under mail.tm's rate limit
+        self.account_creation_interval = float(os.environ.get('MAIL_TM_ACCOUNT_CREATION_INTERVAL', 5))
+        self._last_account_creation = 0
+        self._account_creation_lock = threading.Lock()
+        # Optional AccountPool of pre-created accounts (see account_pool.py)
+        self.account_pool = None
+        # Optional metrics.Metrics recording every mail.tm call
+        self.metrics = None
+        
+        # Incremental sync reads at most this many pages of /messages per poll
+        self.sync_max_pages = int(os.environ.get('MAIL_TM_SYNC_MAX_PAGES', 10))
+        
+        # Message details are fetched in parallel, capped per account and globally
+        self.detail_concurrency = int(os.environ.get('MAIL_TM_DETAIL_CONCURRENCY', 4))
+        self._detail_executor = ThreadPoolExecutor(
+            max_workers=int(os.environ.get('MAIL_TM_DETAIL_WORKERS', 16)),
+            thread_name_prefix='mail-tm-details'
+        )
+    
+    def _request(self, method, endpoint, url, **kwargs):
+        """Send a mail.tm request, recording its latency and status under ``endpoint``"""
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            response = self.session.request(method, url, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe(
+                    'tempmail_upstream_request_duration_seconds',
+                    (('endpoint', endpoint), ('method', method), ('status', str(status))),
+                    time.perf_counter() - start
+                )
     
     def get_available_domains(self):
+        """Get list of available domains, served from the domain cache"""
+        return self.domain_cache.get()
+    
+    def fetch_available_domains(self):
         """Get list of available domains from mail.tm"""
         try:
-            response = self.session.get(f"{self.base_url}/domains")
+            response = self._request('GET', '/domains', f"{self.base_url}/domains")
             if response.status_code == 200:
                 data = response.json()
                 logging.debug(f"Domains response: {data}")
                 
-                # Handle different response formats
-                if isinstance(data, list):
-                    return [domain['domain'] for domain in data if 'domain' in domain]
-                elif isinstance(data, dict):
-                    if 'hydra:member' in data:
-                        return [domain['domain'] for domain in data['hydra:member']]
-                    elif '@graph' in data:
-                        return [domain['domain'] for domain in data['@graph']]
-                    elif 'domains' in data:
-                        return [domain['domain'] for domain in data['domains']]
-                    elif 'data' in data:
-                        return [domain['domain'] for domain in data['data']]
-                
-                logging.error(f"Unexpected response format: {data}")
-                return []
+                domains = parse_domains(data)
+                if domains is None:
+                    logging.error(f"Unexpected response format: {data}")
+                    return []
+                return domains
             else:
                 logging.error(f"Failed to get domains: {response.status_code} - {response.text}")
                 return []
@@ -52,7 +365,7 @@ class MailTMService:
                 "address": email_address,
                 "password": password
             }
-            response = self.session.post(f"{self.base_url}/accounts", json=data)
+            response = self._request('POST', '/accounts', f"{self.base_url}/accounts", json=data)
             if response.status_code == 201:
                 return response.json()
             else:
@@ -69,7 +382,7 @@ class MailTMService:
                 "address": email_address,
                 "password": password
             }
-            response = self.session.post(f"{self.base_url}/token", json=data)
+            response = self._request('POST', '/token', f"{self.base_url}/token", json=data)
             if response.status_code == 200:
                 return response.json()['token']
             else:
@@ -79,42 +392,82 @@ class MailTMService:
             logging.error(f"Error getting token: {e}")
             return None
     
-    def get_messages(self, token):
-        """Get all messages for the authenticated account"""
+    def get_cached_token(self, email_address, password):
+        """Get an authentication token, reusing a cached one while it is valid"""
+        return self.token_cache.get_or_fetch(
+            email_address, lambda: self.get_auth_token(email_address, password)
+        )
+    
+    def _authorized_get(self, endpoint, url, token, account=None):
+        """GET with a bearer token, refreshing it once on a 401 when ``account`` is given"""
+        response = self._request('GET', endpoint, url, headers={'Authorization': f'Bearer {token}'})
+        if response.status_code == 401 and account:
+            email_address, password = account
+            self.token_cache.invalidate(email_address, token)
+            token = self.get_cached_token(email_address, password)
+            if token:
+                response = self._request('GET', endpoint, url,
+                                         headers={'Authorization': f'Bearer {token}'})
+        return response
+    
+    def get_messages(self, token, account=None):
+        """Get the first page of messages for the authenticated account"""
+        return self.get_messages_page(token, 1, account)[0] or []
+    
+    def get_messages_page(self, token, page=1, account=None):
+        """Get one page of messages, newest first
+        
+        Returns ``(messages, has_next)`` where ``has_next`` tells whether the
+        response's ``hydra:view`` links to a further page. ``messages`` is
+        None if the page could not be read.
+        """
         try:
-            headers = {'Authorization': f'Bearer {token}'}
-            response = self.session.get(f"{self.base_url}/messages", headers=headers)
+            response = self._authorized_get(
+                '/messages', f"{self.base_url}/messages?page={page}", token, account
+            )
             if response.status_code == 200:
                 data = response.json()
                 logging.debug(f"Messages response: {data}")
                 
-                # Handle different response formats
-                if isinstance(data, list):
-                    return data
-                elif isinstance(data, dict):
-                    if 'hydra:member' in data:
-                        return data['hydra:member']
-                    elif '@graph' in data:
-                        return data['@graph']
-                    elif 'messages' in data:
-                        return data['messages']
-                    elif 'data' in data:
-                        return data['data']
-                
-                logging.error(f"Unexpected messages response format: {data}")
-                return []
+                messages = extract_members(data, 'messages')
+                if messages is None:
+                    logging.error(f"Unexpected messages response format: {data}")
+                    return None, False
+                return messages, has_next_page(data)
             else:
                 logging.error(f"Failed to get messages: {response.text}")
-                return []
+                return None, False
         except Exception as e:
             logging.error(f"Error getting messages: {e}")
-            return []
+            return None, False
+    
+    def get_new_messages(self, token, cursor, account=None, is_stored=None):
+        """Walk message pages newest first until reaching already-synced messages
+        
+        Stops at the first message older than the cursor's watermark, so a
+        steady-state poll reads a single page. ``is_stored(mail_tm_id)`` lets
+        the caller skip messages it already has when the cursor is fresh.
+        Returns ``(new_items, known_items, complete)``: the unseen messages
+        and the ones ``is_stored`` reported, both newest first, and whether
+        the walk reached the watermark or the last page. It is incomplete
+        when a page fails or ``sync_max_pages`` runs out.
+        """
+        new_items = []
+        known_items = []
+        for page in range(1, self.sync_max_pages + 1):
+            messages, has_next = self.get_messages_page(token, page, account)
+            if messages is None:
+                return new_items, known_items, False
+            if cursor.collect(messages, new_items, known_items, is_stored) or not has_next:
+                return new_items, known_items, True
+        return new_items, known_items, False
     
-    def get_message_details(self, message_id, token):
+    def get_message_details(self, message_id, token, account=None):
         """Get detailed content of a specific message"""
         try:
-            headers = {'Authorization': f'Bearer {token}'}
-            response = self.session.get(f"{self.base_url}/messages/{message_id}", headers=headers)
+            response = self._authorized_get(
+                '/messages/{id}', f"{self.base_url}/messages/{message_id}", token, account
+            )
             if response.status_code == 200:
                 return response.json()
             return None
@@ -122,41 +475,108 @@ class MailTMService:
             logging.error(f"Error getting message details: {e}")
             return None
     
-    def create_real_temp_email(self, session_id, db, TempEmail):
-        """Create a real temporary email using mail.tm"""
+    def get_message_details_batch(self, message_ids, token, account=None):
+        """Get details for several messages concurrently
+        
+        Returns a list aligned with ``message_ids``; failed fetches are None.
+        At most ``detail_concurrency`` requests run for this call, and the
+        shared executor caps them across all accounts.
+        """
+        if len(message_ids) <= 1:
+            return [self.get_message_details(message_id, token, account) for message_id in message_ids]
+        
+        slots = threading.Semaphore(self.detail_concurrency)
+        
+        def fetch(message_id):
+            try:
+                return self.get_message_details(message_id, token, account)
+            finally:
+                slots.release()
+        
+        futures = []
+        for message_id in message_ids:
+            slots.acquire()
+            futures.append(self._detail_executor.submit(fetch, message_id))
+        
+        results = []
+        for message_id, future in zip(message_ids, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logging.error(f"Error getting message details for {message_id}: {e}")
+                results.append(None)
+        return results
+    
+    def provision_account(self, paced=True):
+        """Create a mail.tm account, spacing creations out to avoid rate limiting
+        
+        With ``paced=False`` the account is created right away, without
+        waiting for ``account_creation_interval`` or for other creations.
+        The account pool paces its own refills, and a request that found
+        the pool empty should not queue behind them.
+        
+        Returns a dict with ``address``, ``password`` and ``mail_tm_id``, or
+        None if the account could not be created.
+        """
         try:
-            # Add rate limiting check
-            import time
-            if not hasattr(self, '_last_account_creation'):
-                self._last_account_creation = 0
-            
-            # Wait at least 5 seconds between account creations to avoid rate limiting
-            time_since_last = time.time() - self._last_account_creation
-            if time_since_last < 5:
-                time.sleep(5 - time_since_last)
-            
-            domains = self.get_available_domains()
-            if not domains:
-                logging.error("No domains available")
+            if paced:
+                with self._account_creation_lock:
+                    # Wait at least account_creation_interval seconds between account creations
+                    time_since_last = time.time() - self._last_account_creation
+                    if time_since_last < self.account_creation_interval:
+                        time.sleep(self.account_creation_interval - time_since_last)
+                    email_address, password, account = self._create_random_account()
+            else:
+                email_address, password, account = self._create_random_account()
+            if email_address is None:
                 return None
             
-            # Use the first available domain
-            domain = domains[0]
-            
-            # Generate unique email address
-            import uuid
-            username = uuid.uuid4().hex[:12]
-            email_address = f"{username}@{domain}"
-            
-            # Generate password
-            password = uuid.uuid4().hex
+            if not account:
+                logging.error(f"Failed to create account for {email_address}")
+                return None
             
-            # Create account on mail.tm
-            account = self.create_account(email_address, password)
-            self._last_account_creation = time.time()
+            return {
+                'address': email_address,
+                'password': password,
+                'mail_tm_id': account.get('id')
+            }
             
+        except Exception as e:
+            logging.error(f"Error provisioning mail.tm account: {e}")
+            return None
+    
+    def _create_random_account(self):
+        """Create an account with a random address; ``(address, password, account)``"""
+        domains = self.get_available_domains()
+        if not domains:
+            logging.error("No domains available")
+            return None, None, None
+        
+        # Use the first available domain
+        domain = domains[0]
+        
+        # Generate unique email address
+        import uuid
+        username = uuid.uuid4().hex[:12]
+        email_address = f"{username}@{domain}"
+        
+        # Generate password
+        password = uuid.uuid4().hex
+        
+        # Create account on mail.tm
+        account = self.create_account(email_address, password)
+        self._last_account_creation = time.time()
+        return email_address, password, account
+    
+    def create_real_temp_email(self, session_id, db, TempEmail):
+        """Create a real temporary email using mail.tm"""
+        try:
+            # Take a pre-created account from the pool, creating one only on a miss
+            account = self.account_pool.take() if self.account_pool else None
+            if account is None:
+                # With a pool, a miss is rare and should not wait on its pacing
+                account = self.provision_account(paced=self.account_pool is None)
             if not account:
-                logging.error(f"Failed to create account for {email_address}")
                 return None
             
             # Create TempEmail record
@@ -164,16 +584,16 @@ class MailTMService:
                 session_id=session_id,
                 use_real_email=True  # This prevents the __init__ from setting local email
             )
-            temp_email.email_address = email_address
+            temp_email.email_address = account['address']
             temp_email.expires_at = datetime.utcnow() + timedelta(hours=24)
             temp_email.is_active = True
             temp_email.created_at = datetime.utcnow()
             
             # Store mail.tm credentials
-            temp_email.mail_tm_password = password
-            temp_email.mail_tm_id = account.get('id')
+            temp_email.mail_tm_password = account['password']
+            temp_email.mail_tm_id = account['mail_tm_id']
             
-            logging.info(f"Successfully created temp email: {email_address}")
+            logging.info(f"Successfully created temp email: {temp_email.email_address}")
             return temp_email
             
         except Exception as e:
@@ -186,40 +606,39 @@ class MailTMService:
             if not hasattr(temp_email, 'mail_tm_password'):
                 return 0
             
-            # Get auth token
-            token = self.get_auth_token(temp_email.email_address, temp_email.mail_tm_password)
+            # Get auth token (cached until shortly before it expires)
+            account = (temp_email.email_address, temp_email.mail_tm_password)
+            token = self.get_cached_token(*account)
             if not token:
                 return 0
             
-            # Get messages
-            messages = self.get_messages(token)
-            new_messages = 0
-            
             # Import email_messages from app module
             from app import email_messages
             
-            for msg in messages:
-                logging.debug(f"Processing message: {msg['id']} - {msg.get('subject', 'No subject')}")
-                
-                # Check if message already exists in memory
-                existing = False
-                for msg_id, stored_msg in email_messages.items():
-                    if (stored_msg.temp_email_id == temp_email.id and 
-                        stored_msg.mail_tm_id == msg['id']):
-                        existing = True
-                        break
-                
-                if not existing:
-                    logging.info(f"New message found: {msg['id']} - {msg.get('subject', 'No subject')}")
-                
-                if existing:
-                    logging.debug(f"Message {msg['id']} already exists, skipping")
-                    continue
-                
-                # Get message details
-                details = self.get_message_details(msg['id'], token)
+            # Collect messages newer than what this inbox has already synced
+            cursor = getattr(temp_email, 'sync_cursor', None)
+            if cursor is None:
+                cursor = temp_email.sync_cursor = SyncCursor()
+            new_items, known_items, complete = self.get_new_messages(
+                token, cursor, account,
+                is_stored=lambda mail_tm_id: email_messages.has_mail_tm_id(temp_email.id, mail_tm_id)
+            )
+            new_messages = 0
+            pending = []
+            stored_items = []
+            failed_items = []
+            for msg in new_items:
+                logging.info(f"New message found: {msg['id']} - {msg.get('subject', 'No subject')}")
+            
+            # Get message details concurrently; results come back in list order
+            all_details = self.get_message_details_batch(
+                [msg['id'] for msg in new_items], token, account
+            )
+            
+            for msg, details in zip(new_items, all_details):
                 if not details:
                     logging.error(f"Failed to get details for message {msg['id']}")
+                    failed_items.append(msg)
                     continue
                 
                 logging.info(f"Processing new message: {msg.get('subject', 'No subject')}")
@@ -247,11 +666,33 @@ class MailTMService:
                 except:
                     email_msg.received_at = datetime.utcnow()
                 
-                # Store in memory
-                email_messages[email_msg.id] = email_msg
+                annotate_message(email_msg)
+                pending.append((msg, email_msg))
+            
+            # Classify the whole sync in one batch before anything is stored
+            spam_verdicts = spam_matcher.classify_batch(
+                (email_msg.sender_email, email_msg.subject, email_msg.body)
+                for _, email_msg in pending
+            )
+            
+            for (msg, email_msg), is_spam in zip(pending, spam_verdicts):
+                email_msg.is_spam = is_spam
+                
+                # Store in memory, unless a concurrent fetch stored it meanwhile
+                stored_items.append(msg)
+                if email_messages.add(email_msg) is not email_msg:
+                    continue
                 new_messages += 1
+                
+                # Render the content now so page loads and polls hit the cache
+                try:
+                    render_message(email_msg)
+                except Exception as e:
+                    logging.error(f"Error pre-rendering message {email_msg.id}: {e}")
                 logging.info(f"Successfully stored message: {email_msg.subject} from {email_msg.sender_email}")
             
+            cursor.advance(stored_items + known_items, failed_items, complete)
+            
             if new_messages > 0:
                 logging.info(f"Fetched {new_messages} new messages for {temp_email.email_address}")
             
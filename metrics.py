@@ -0,0 +1,278 @@
+import atexit
+import bisect
+import glob
+import json
+import logging
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking, single process only
+    fcntl = None
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+WORKER_FILE = 'worker-{pid}.json'
+WORKER_PATTERN = 'worker-*.json'
+ARCHIVE_FILE = 'archive.json'
+LOCK_FILE = 'metrics.lock'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+def _process_started(pid):
+    """Start time of a process in clock ticks since boot, or None off Linux"""
+    try:
+        with open(f'/proc/{pid}/stat', encoding='utf-8') as f:
+            # Fields after the parenthesised command name; starttime is field 22
+            return int(f.read().rsplit(')', 1)[1].split()[19])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _pid_alive(pid, started=None):
+    """Whether the worker that wrote a file still runs, not just a process with its pid"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    if started is None:
+        return True
+    return _process_started(pid) in (None, started)
+
+
+class Metrics:
+    """Counters, gauges and latency histograms in the Prometheus text format
+
+    Recording a sample only updates a dict under a lock. When ``directory``
+    is set, a background thread writes this process's samples to
+    ``worker-<pid>.json`` there every ``flush_interval`` seconds. ``render()``
+    then adds up the files of all worker processes, so a scrape of any
+    gunicorn worker reports the totals of all of them. Counters and
+    histograms of exited workers are folded into ``archive.json`` so totals
+    never go backwards. Their gauges are dropped.
+
+    Collectors added with ``add_collector`` return ``(name, labels, value)``
+    samples for state that is cheaper to read than to track, like store
+    sizes and cache statistics. Per-process collectors run at every flush.
+    ``shared=True`` collectors read state common to all workers, such as the
+    SQLite store. They only run in the worker answering a scrape.
+    """
+
+    def __init__(self, directory=None, flush_interval=10, buckets=LATENCY_BUCKETS):
+        self.directory = directory if fcntl is not None else None
+        self.flush_interval = flush_interval
+        self.buckets = tuple(buckets)
+        self._types = {}
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def describe(self, name, kind, help_text):
+        """Declare the type (``counter``, ``gauge`` or ``histogram``) and help of a metric"""
+        self._types[name] = (kind, help_text)
+
+    def inc(self, name, labels=(), amount=1):
+        """Add to a counter; ``labels`` is a tuple of ``(key, value)`` pairs"""
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        """Record one value, usually a duration in seconds, in a histogram"""
+        index = bisect.bisect_left(self.buckets, value)
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # One count per bucket, one for +Inf, then the sum
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 2)
+            histogram[index] += 1
+            histogram[-1] += value
+
+    def add_collector(self, collect, shared=False):
+        self._collectors.append((collect, shared))
+
+    def _collected(self, shared):
+        samples = []
+        for collect, is_shared in self._collectors:
+            if is_shared != shared:
+                continue
+            try:
+                for name, labels, value in collect():
+                    kind = self._types.get(name, ('gauge', ''))[0]
+                    samples.append((kind, name, labels, value))
+            except Exception as e:
+                logging.error(f"Error collecting metrics: {e}")
+        return samples
+
+    def snapshot(self):
+        """Samples of this process as ``(kind, name, labels, value)`` tuples"""
+        with self._lock:
+            samples = [('counter', name, labels, value)
+                       for (name, labels), value in self._counters.items()]
+            samples += [('histogram', name, labels, list(value))
+                        for (name, labels), value in self._histograms.items()]
+        return samples + self._collected(shared=False)
+
+    @staticmethod
+    def _merge(totals, samples, gauges=True):
+        for kind, name, labels, value in samples:
+            if kind == 'gauge' and not gauges:
+                continue
+            key = (kind, name, tuple((str(k), str(v)) for k, v in labels))
+            current = totals.get(key)
+            if current is None:
+                totals[key] = list(value) if kind == 'histogram' else value
+            elif kind != 'histogram':
+                totals[key] = current + value
+            elif len(current) == len(value):
+                for i, count in enumerate(value):
+                    current[i] += count
+
+    @staticmethod
+    def _dump(totals):
+        return [[kind, name, labels, value] for (kind, name, labels), value in totals.items()]
+
+    def _read(self, path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.error(f"Error reading metrics file {path}: {e}")
+            return None
+
+    def _write(self, path, data):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    def _locked(self, mode):
+        lock_fd = os.open(os.path.join(self.directory, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(lock_fd, mode)
+        return lock_fd
+
+    def flush(self):
+        """Write this process's samples to its file in ``directory``"""
+        if self.directory is None:
+            return
+        path = os.path.join(self.directory, WORKER_FILE.format(pid=os.getpid()))
+        self._write(path, {'pid': os.getpid(), 'started': _process_started(os.getpid()),
+                           'samples': self.snapshot()})
+
+    def _fold_exited(self):
+        """Move the counters and histograms of exited workers into the archive"""
+        lock_fd = self._locked(fcntl.LOCK_EX)
+        try:
+            totals = {}
+            archive_path = os.path.join(self.directory, ARCHIVE_FILE)
+            archive = self._read(archive_path)
+            if archive:
+                self._merge(totals, archive['samples'])
+            folded = []
+            for path in glob.glob(os.path.join(self.directory, WORKER_PATTERN)):
+                data = self._read(path)
+                if not data:
+                    continue
+                # A reused pid shows up as a different start time; without
+                # one, a file with our pid was left by an earlier process
+                started = data.get('started')
+                if not _pid_alive(data['pid'], started) or (data['pid'] == os.getpid() and started is None):
+                    self._merge(totals, data['samples'], gauges=False)
+                    folded.append(path)
+            if folded:
+                self._write(archive_path, {'pid': None, 'samples': self._dump(totals)})
+                for path in folded:
+                    os.remove(path)
+        finally:
+            os.close(lock_fd)
+
+    def collect(self):
+        """Totals of all worker processes, keyed by ``(kind, name, labels)``"""
+        totals = {}
+        if self.directory is None:
+            self._merge(totals, self.snapshot())
+        else:
+            self.flush()
+            lock_fd = self._locked(fcntl.LOCK_SH)
+            try:
+                for path in glob.glob(os.path.join(self.directory, '*.json')):
+                    data = self._read(path)
+                    if data:
+                        pid = data['pid']
+                        self._merge(totals, data['samples'],
+                                    gauges=pid is not None and _pid_alive(pid, data.get('started')))
+            finally:
+                os.close(lock_fd)
+        self._merge(totals, self._collected(shared=True))
+        return totals
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        by_name = {}
+        for (kind, name, labels), value in sorted(self.collect().items()):
+            by_name.setdefault(name, (kind, []))[1].append((labels, value))
+
+        lines = []
+        bounds = self.buckets + (float('inf'),)
+        for name, (kind, series) in by_name.items():
+            lines.append(f'# HELP {name} {self._types.get(name, (kind, name))[1]}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in series:
+                if kind != 'histogram':
+                    lines.append(f'{name}{_format_labels(labels)} {value}')
+                    continue
+                count = 0
+                for bound, bucket_count in zip(bounds, value[:-1]):
+                    count += bucket_count
+                    bucket_labels = labels + (('le', _format_bound(bound)),)
+                    lines.append(f'{name}_bucket{_format_labels(bucket_labels)} {count}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {value[-1]}')
+                lines.append(f'{name}_count{_format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Error writing metrics: {e}")
+
+    def start(self):
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            self._fold_exited()
+        except Exception as e:
+            logging.error(f"Error archiving metrics of exited workers: {e}")
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='metrics-flusher', daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def stop(self):
+        self._stop.set()
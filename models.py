@@ -1,7 +1,17 @@
 from datetime import datetime, timedelta
 import uuid
 
+from body_budget import PackedBody
+
+# Markers for an EmailMessage body that is the same as its text or html content
+_BODY_IS_TEXT = object()
+_BODY_IS_HTML = object()
+
+
 class TempEmail:
+    __slots__ = ('id', 'session_id', 'created_at', 'is_active', 'mail_tm_password', 'mail_tm_id',
+                 'email_address', 'expires_at', 'sync_cursor')
+
     def __init__(self, session_id, hours=24, use_real_email=True):
         self.id = str(uuid.uuid4())
         self.session_id = session_id
@@ -25,18 +35,67 @@ class TempEmail:
         self.is_active = False
 
 class EmailMessage:
+    __slots__ = ('id', 'temp_email_id', 'sender_email', 'sender_name', 'subject', '_body',
+                 '_text_content', '_html_content', 'received_at', 'is_spam', 'is_read',
+                 'mail_tm_id', 'verification_codes', 'action_links')
+
     def __init__(self, temp_email_id, sender_email, sender_name=None, subject=None, body=None, 
                  text_content=None, html_content=None, mail_tm_id=None):
         self.id = str(uuid.uuid4())
         self.temp_email_id = temp_email_id
-        self.sender = sender_email  # Keeping for backward compatibility
         self.sender_email = sender_email
         self.sender_name = sender_name
         self.subject = subject
-        self.body = body
         self.text_content = text_content
         self.html_content = html_content
+        self.body = body
         self.received_at = datetime.utcnow()
         self.is_spam = False
         self.is_read = False
-        self.mail_tm_id = mail_tm_id
\ No newline at end of file
+        self.mail_tm_id = mail_tm_id
+        # Filled in once at ingest by email_utils.annotate_message
+        self.verification_codes = ()
+        self.action_links = ()
+
+    @property
+    def sender(self):
+        """Alias of ``sender_email``, kept for backward compatibility"""
+        return self.sender_email
+
+    # Bodies may be held compressed or on disk by a body_budget.BodyBudget
+    @property
+    def text_content(self):
+        value = self._text_content
+        return value.unpack() if isinstance(value, PackedBody) else value
+
+    @text_content.setter
+    def text_content(self, value):
+        self._text_content = value
+
+    @property
+    def html_content(self):
+        value = self._html_content
+        return value.unpack() if isinstance(value, PackedBody) else value
+
+    @html_content.setter
+    def html_content(self, value):
+        self._html_content = value
+
+    @property
+    def body(self):
+        if self._body is _BODY_IS_TEXT:
+            return self.text_content
+        if self._body is _BODY_IS_HTML:
+            return self.html_content
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        # The body normally repeats the text or html content; keep a marker
+        # instead of a second copy (set the content fields first)
+        if value and value == getattr(self, 'text_content', None):
+            self._body = _BODY_IS_TEXT
+        elif value and value == getattr(self, 'html_content', None):
+            self._body = _BODY_IS_HTML
+        else:
+            self._body = value
@@ -0,0 +1,242 @@
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking, single process only
+    fcntl = None
+
+
+class MailPoller:
+    """Background engine that pulls new mail.tm messages into the store
+
+    Every watched inbox has its own next-due time kept in a min-heap. A
+    scheduler thread hands due inboxes to a bounded worker pool, never more
+    than ``max_in_flight`` at once and never the same inbox twice at once.
+    Inboxes that were viewed recently (see ``touch``) are polled every
+    ``interval`` seconds, the rest every ``idle_interval`` seconds, and
+    every delay gets up to ``jitter`` seconds of random spread so polls do
+    not line up.
+
+    With a store shared by several processes, pass ``lock_path``: only the
+    process holding that lock file polls, and the others take over when it
+    exits. Other processes record views in the store (``mark_viewed``).
+    The polling process picks them up every ``interval`` seconds
+    (``viewed_since``), which is also how it learns about inboxes they
+    create.
+    """
+
+    def __init__(self, temp_emails, service, EmailMessage, workers=8, interval=5,
+                 idle_interval=60, jitter=1.0, active_window=300, max_in_flight=None,
+                 lock_path=None):
+        self.temp_emails = temp_emails
+        self.service = service
+        self.EmailMessage = EmailMessage
+        self.workers = workers
+        self.interval = interval
+        self.idle_interval = idle_interval
+        self.jitter = jitter
+        self.active_window = active_window
+        self.max_in_flight = max_in_flight or workers
+        self.lock_path = lock_path if fcntl is not None else None
+        self.is_polling = self.lock_path is None
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # (due monotonic time, sequence, email_id); stale entries are skipped
+        self._heap = []
+        self._due = {}
+        self._in_flight = set()
+        self._last_viewed = {}
+        self._counter = itertools.count()
+        self._slots = threading.BoundedSemaphore(self.max_in_flight)
+        self._executor = None
+        self._thread = None
+        self._stopped = False
+        self._stop = threading.Event()
+        self._election_thread = None
+        self._lock_fd = None
+
+    def watch(self, temp_email, delay=0):
+        """Start polling an inbox, first poll after ``delay`` seconds"""
+        if not getattr(temp_email, 'mail_tm_id', None):
+            return
+        if not self.is_polling:
+            self._mark_viewed(temp_email.id, force=True)
+            return
+        self._schedule(temp_email.id, delay)
+
+    def watch_all(self, temp_emails):
+        """Start polling many inboxes, spreading first polls over the idle interval"""
+        if not self.is_polling:
+            return
+        for temp_email in temp_emails:
+            self.watch(temp_email, delay=random.uniform(0, self.idle_interval))
+
+    def touch(self, email_id):
+        """Mark an inbox as being viewed so it is polled at the fast interval"""
+        if not self.is_polling:
+            self._mark_viewed(email_id)
+            return
+        with self._lock:
+            was_idle = not self._is_active(email_id)
+            self._last_viewed[email_id] = time.monotonic()
+            due = self._due.get(email_id)
+            # An inbox this process never scheduled, e.g. created by another
+            # worker sharing the store
+            unknown = due is None and email_id not in self._in_flight
+
+        # Pull an idle inbox's next poll forward instead of waiting it out
+        if unknown or (was_idle and due is not None and due - time.monotonic() > self.interval):
+            self._schedule(email_id, 0)
+
+    def _mark_viewed(self, email_id, force=False):
+        """Record a view in the shared store, at most once per half interval per inbox"""
+        now = time.monotonic()
+        with self._lock:
+            last_marked = self._last_viewed.get(email_id)
+            if not force and last_marked is not None and now - last_marked < self.interval / 2:
+                return
+            self._last_viewed[email_id] = now
+            if len(self._last_viewed) > 10000:
+                self._last_viewed = {
+                    key: viewed for key, viewed in self._last_viewed.items()
+                    if now - viewed < self.active_window
+                }
+        try:
+            self.temp_emails.mark_viewed(email_id)
+        except Exception as e:
+            logging.error(f"Error recording view of inbox {email_id}: {e}")
+
+    def _is_active(self, email_id):
+        last_viewed = self._last_viewed.get(email_id)
+        return last_viewed is not None and time.monotonic() - last_viewed < self.active_window
+
+    def _schedule(self, email_id, delay):
+        with self._lock:
+            due = time.monotonic() + delay
+            self._due[email_id] = due
+            heapq.heappush(self._heap, (due, next(self._counter), email_id))
+            self._wakeup.notify()
+
+    def _next_delay(self, email_id):
+        base = self.interval if self._is_active(email_id) else self.idle_interval
+        return base + random.uniform(0, self.jitter)
+
+    def _pop_due(self):
+        """Block until an inbox is due, then return its id (None once stopped)"""
+        with self._lock:
+            while not self._stopped:
+                if not self._heap:
+                    self._wakeup.wait()
+                    continue
+
+                due, _, email_id = self._heap[0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self._wakeup.wait(wait)
+                    continue
+
+                heapq.heappop(self._heap)
+                # Skip superseded heap entries and inboxes already being polled
+                if self._due.get(email_id) != due or email_id in self._in_flight:
+                    continue
+                del self._due[email_id]
+                self._in_flight.add(email_id)
+                return email_id
+        return None
+
+    def _run(self):
+        while True:
+            self._slots.acquire()
+            email_id = self._pop_due()
+            if email_id is None:
+                self._slots.release()
+                return
+            self._executor.submit(self._poll, email_id)
+
+    def _poll(self, email_id):
+        temp_email = None
+        try:
+            temp_email = self.temp_emails.get(email_id)
+            if temp_email is None or not temp_email.is_active:
+                return
+            if hasattr(temp_email, 'is_expired') and temp_email.is_expired:
+                return
+            self.service.fetch_emails_for_account(temp_email, None, self.EmailMessage)
+        except Exception as e:
+            logging.error(f"Error polling inbox {email_id}: {e}")
+        finally:
+            with self._lock:
+                self._in_flight.discard(email_id)
+                if temp_email is None:
+                    self._last_viewed.pop(email_id, None)
+            self._slots.release()
+
+            # Keep polling for as long as the inbox is still stored
+            if temp_email is not None and email_id in self.temp_emails:
+                self._schedule(email_id, self._next_delay(email_id))
+
+    def _try_lead(self):
+        """Take the poller lock file without blocking; True once this process holds it"""
+        if self._lock_fd is None:
+            self._lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+    def _elect(self):
+        """Wait to become the polling process, then follow views recorded by the others"""
+        while not self._try_lead():
+            if self._stop.wait(self.interval):
+                return
+
+        logging.info(f"Process {os.getpid()} is now polling mail.tm")
+        checked = time.time() - self.active_window
+        self.is_polling = True
+        self.watch_all(self.temp_emails.values())
+        self._start_polling()
+        while not self._stop.is_set():
+            started = time.time()
+            try:
+                for email_id in self.temp_emails.viewed_since(checked):
+                    self.touch(email_id)
+                # Overlap a little so a view committed during the query is not missed
+                checked = started - 1
+            except Exception as e:
+                logging.error(f"Error reading inbox views: {e}")
+            self._stop.wait(self.interval)
+
+    def _start_polling(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped = False
+            self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                thread_name_prefix='mail-poller')
+            self._thread = threading.Thread(target=self._run, name='mail-poller-scheduler',
+                                            daemon=True)
+            self._thread.start()
+
+    def start(self):
+        if self.lock_path is None:
+            self._start_polling()
+        elif self._election_thread is None or not self._election_thread.is_alive():
+            self._stop.clear()
+            self._election_thread = threading.Thread(target=self._elect, name='mail-poller-election',
+                                                     daemon=True)
+            self._election_thread.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify_all()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
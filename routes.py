@@ -1,11 +1,17 @@
 import uuid
-from flask import render_template, request, session, redirect, url_for, flash, jsonify, send_from_directory, make_response
+import hmac
+import json
+import threading
+import time
+from flask import render_template, request, session, redirect, url_for, flash, jsonify, send_from_directory, make_response, Response
 from werkzeug.security import generate_password_hash, check_password_hash
 from markupsafe import escape
-from app import app, limiter, temp_emails, email_messages, save_emails_to_cache
+from app import (app, limiter, temp_emails, email_messages, mail_poller, metrics,
+                 MAIL_POLLER_ENABLED, SSE_MAX_STREAMS, SSE_HEARTBEAT_INTERVAL, SSE_MAX_STREAM_DURATION,
+                 METRICS_ENABLED, METRICS_TOKEN)
 from models import TempEmail, EmailMessage
 from utils import is_spam_email
-from email_utils import process_email_content
+from email_utils import process_email_content, render_message, annotate_message
 from datetime import datetime
 import logging
 import re
@@ -23,9 +29,8 @@ def index():
     active_emails = []
     
     # Get active emails from in-memory storage
-    for email_id, email in temp_emails.items():
-        if (email.session_id == session_id and 
-            email.is_active and 
+    for email in temp_emails.for_session(session_id):
+        if (email.is_active and 
             (not hasattr(email, 'is_expired') or not email.is_expired)):
             active_emails.append(email)
     
@@ -34,21 +39,9 @@ def index():
         logging.info(f"No active emails for session {session_id}, creating one automatically")
         
         # Delete any old emails for this session first
-        to_delete = []
-        for email_id, email in temp_emails.items():
-            if email.session_id == session_id:
-                to_delete.append(email_id)
-        
-        for email_id in to_delete:
+        for email_id in temp_emails.ids_for_session(session_id):
             # Delete associated messages first
-            messages_to_delete = []
-            for msg_id, msg in email_messages.items():
-                if msg.temp_email_id == email_id:
-                    messages_to_delete.append(msg_id)
-            
-            for msg_id in messages_to_delete:
-                del email_messages[msg_id]
-            
+            email_messages.delete_for_inbox(email_id)
             del temp_emails[email_id]
         
         # Create new temporary email automatically
@@ -56,36 +49,39 @@ def index():
         
         if temp_email:
             temp_emails[temp_email.id] = temp_email
+            mail_poller.watch(temp_email)
             active_emails = [temp_email]
             logging.info(f"Auto-created email: {temp_email.email_address}")
-            # Save to cache for persistence
-            save_emails_to_cache()
         else:
             logging.error("Failed to auto-create email")
     
-    # Fetch messages for active emails and attach them
+    # Fetch messages for active emails; only the first inbox is displayed
+    messages_by_email = {}
     for email in active_emails:
         if hasattr(email, 'mail_tm_id') and email.mail_tm_id:
-            # Refresh messages from mail.tm service
-            mail_tm_service.fetch_emails_for_account(email, None, EmailMessage)
-        
-        # Get messages for this email from email_messages dictionary
-        messages = []
-        for msg_id, msg in email_messages.items():
-            if msg.temp_email_id == email.id:
-                messages.append(msg)
+            if MAIL_POLLER_ENABLED:
+                # New messages arrive through the background poller
+                mail_poller.touch(email.id)
+            else:
+                # Refresh messages from mail.tm service
+                mail_tm_service.fetch_emails_for_account(email, None, EmailMessage)
         
-        # Sort messages by received date (newest first)
-        messages.sort(key=lambda x: x.received_at, reverse=True)
+        # Get messages for this email (newest first)
+        messages = email_messages.for_inbox(email.id)
         
-        # Attach messages to the email object
-        email.messages = messages
+        messages_by_email[email.id] = messages
         logging.info(f"Email {email.email_address} has {len(messages)} messages attached")
         for i, msg in enumerate(messages):
             logging.info(f"  Message {i+1}: {msg.subject} from {msg.sender_email}")
     
+    # Version of the displayed inbox, used by the page to poll for changes only
+    inbox_version = email_messages.inbox_version(active_emails[0].id) if active_emails else 0
+    
     return render_template('index.html', 
-                         active_emails=active_emails)
+                         active_emails=active_emails,
+                         messages=messages_by_email.get(active_emails[0].id, []) if active_emails else [],
+                         inbox_version=inbox_version,
+                         sse_enabled=SSE_MAX_STREAMS > 0)
 
 @app.route('/generate-email', methods=['POST'])
 @limiter.limit("10 per hour")
@@ -96,21 +92,9 @@ def generate_email():
         session['session_id'] = session_id
     
     # Delete all old emails for this session before creating new one
-    to_delete = []
-    for email_id, email in temp_emails.items():
-        if email.session_id == session_id:
-            to_delete.append(email_id)
-    
-    for email_id in to_delete:
+    for email_id in temp_emails.ids_for_session(session_id):
         # Delete associated messages first
-        messages_to_delete = []
-        for msg_id, msg in email_messages.items():
-            if msg.temp_email_id == email_id:
-                messages_to_delete.append(msg_id)
-        
-        for msg_id in messages_to_delete:
-            del email_messages[msg_id]
-        
+        email_messages.delete_for_inbox(email_id)
         del temp_emails[email_id]
     
     # Create new temporary email using mail.tm service
@@ -118,14 +102,13 @@ def generate_email():
     
     if temp_email:
         temp_emails[temp_email.id] = temp_email
-        save_emails_to_cache()  # Save to cache
+        mail_poller.watch(temp_email)
         flash(f'New temporary email created: {temp_email.email_address}', 'success')
         return redirect(url_for('index'))
     else:
         # Fallback to local email if mail.tm fails
         temp_email = TempEmail(session_id=session_id, use_real_email=False)
         temp_emails[temp_email.id] = temp_email
-        save_emails_to_cache()  # Save to cache
         flash(f'Temporary email created: {temp_email.email_address} (Demo mode)', 'warning')
         return redirect(url_for('index'))
 
@@ -135,18 +118,13 @@ def email_inbox(email_id):
     
     # Verify ownership
     temp_email = temp_emails.get(email_id)
-    if not temp_email or temp_email.session_id != session_id or not temp_email.is_active:
+    if (not temp_email or temp_email.session_id != session_id or not temp_email.is_active or
+            (hasattr(temp_email, 'is_expired') and temp_email.is_expired)):
         flash('Email not found or expired.', 'error')
         return redirect(url_for('index'))
     
-    # Get messages for this email
-    messages = []
-    for msg_id, msg in email_messages.items():
-        if msg.temp_email_id == email_id:
-            messages.append(msg)
-    
-    # Sort messages by received date (newest first)
-    messages.sort(key=lambda x: x.received_at, reverse=True)
+    # Get messages for this email (newest first)
+    messages = email_messages.for_inbox(email_id)
     
     return render_template('email_inbox.html', 
                          temp_email=temp_email, 
@@ -158,7 +136,7 @@ def fetch_emails(email_id):
     session_id = session.get('session_id')
     
     logging.info(f"Fetch emails called - Email ID: {escape(email_id)}, Session ID: {session_id}")
-    logging.info(f"Available temp_emails: {list(temp_emails.keys())}")
+    logging.info(f"Available temp_emails: {len(temp_emails)}")
     
     # Enhanced input validation
     if not email_id or len(email_id) > 100:
@@ -174,7 +152,7 @@ def fetch_emails(email_id):
         logging.error(f"Session mismatch: {escape(str(temp_email.session_id))} != {escape(str(session_id))}")
         return jsonify({'status': 'error', 'message': 'Unauthorized access'}), 403
     
-    if not temp_email.is_active:
+    if not temp_email.is_active or (hasattr(temp_email, 'is_expired') and temp_email.is_expired):
         logging.error(f"Email inactive: {escape(email_id)}")
         return jsonify({'status': 'error', 'message': 'Email inactive'}), 404
     
@@ -182,55 +160,77 @@ def fetch_emails(email_id):
         # Real-time email fetching with enhanced error handling
         new_count = 0
         if hasattr(temp_email, 'mail_tm_id') and temp_email.mail_tm_id:
-            logging.info(f"Fetching emails for account: {escape(temp_email.email_address)}")
-            new_count = mail_tm_service.fetch_emails_for_account(temp_email, None, EmailMessage)
-            logging.info(f"Fetched {new_count} new messages")
+            if MAIL_POLLER_ENABLED:
+                # Keep the background poller on its fast interval while the page is open
+                mail_poller.touch(email_id)
+            else:
+                logging.info(f"Fetching emails for account: {escape(temp_email.email_address)}")
+                new_count = mail_tm_service.fetch_emails_for_account(temp_email, None, EmailMessage)
+                logging.info(f"Fetched {new_count} new messages")
+        
+        # Unchanged inbox: answer the client's conditional request with a bare 304
+        version = email_messages.inbox_version(email_id)
+        etag = f"{email_id}-{version}"
+        if request.if_none_match.contains(etag):
+            response = make_response('', 304)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache, private'
+            return response
+        
+        # With a since cursor only messages added after that version are sent
+        since = request.args.get('since', type=int)
+        total_count = email_messages.count_for_inbox(email_id)
+        if since is not None:
+            inbox_messages = email_messages.messages_since(email_id, since)
+        else:
+            inbox_messages = email_messages.for_inbox(email_id)
         
         # Get updated messages with XSS protection
         messages = []
-        for msg_id, msg in email_messages.items():
-            if msg.temp_email_id == email_id:
-                # Enhanced email content processing
-                processed_content = process_email_content(
-                    getattr(msg, 'html_content', ''),
-                    getattr(msg, 'text_content', ''), 
-                    getattr(msg, 'body', '')
-                )
-                
-                messages.append({
-                    'id': escape(str(msg.id)),
-                    'sender': escape(getattr(msg, 'sender', getattr(msg, 'sender_email', ''))),
-                    'sender_name': escape(getattr(msg, 'sender_name', '')),
-                    'subject': escape(getattr(msg, 'subject', 'No Subject')),
-                    'body': processed_content,  # Already processed for safety
-                    'text_content': escape(getattr(msg, 'text_content', '')),
-                    'html_content': processed_content,
-                    'received_at': msg.received_at.strftime('%Y-%m-%d %H:%M:%S'),
-                    'timestamp': int(msg.received_at.timestamp()) if hasattr(msg, 'received_at') else 0,
-                    'is_spam': getattr(msg, 'is_spam', False),
-                    'is_read': getattr(msg, 'is_read', False)
-                })
+        for msg in inbox_messages:
+            # Enhanced email content processing (cached per message)
+            processed_content = render_message(msg)
+            
+            messages.append({
+                'id': escape(str(msg.id)),
+                'sender': escape(getattr(msg, 'sender', getattr(msg, 'sender_email', ''))),
+                'sender_name': escape(getattr(msg, 'sender_name', '')),
+                'subject': escape(getattr(msg, 'subject', 'No Subject')),
+                'body': processed_content,  # Already processed for safety
+                'text_content': escape(getattr(msg, 'text_content', '')),
+                'html_content': processed_content,
+                'received_at': msg.received_at.strftime('%Y-%m-%d %H:%M:%S'),
+                'timestamp': int(msg.received_at.timestamp()) if hasattr(msg, 'received_at') else 0,
+                'is_spam': getattr(msg, 'is_spam', False),
+                'is_read': getattr(msg, 'is_read', False)
+            })
         
-        # Sort messages by timestamp (newest first)
-        messages.sort(key=lambda x: x['timestamp'], reverse=True)
+        # Messages stored by the poller count as new relative to what the page already shows
+        if since is not None:
+            new_count = max(new_count, len(messages))
+        known_count = request.args.get('known', type=int)
+        if known_count is not None:
+            new_count = max(new_count, total_count - known_count)
         
-        logging.info(f"Returning {len(messages)} messages for email {escape(email_id)}")
+        logging.info(f"Returning {len(messages)} of {total_count} messages for email {escape(email_id)}")
         
         # Enhanced response with real-time metadata
         response_data = {
             'status': 'success', 
             'messages': messages, 
-            'count': len(messages),
+            'count': total_count,
             'new_count': new_count,
+            'version': version,
             'last_updated': datetime.now().isoformat(),
             'email_address': escape(temp_email.email_address),
             'session_valid': True
         }
         
         response = make_response(jsonify(response_data))
+        response.set_etag(etag)
         
-        # Prevent caching for real-time updates
-        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+        # Always revalidate so real-time updates are never served from a cache
+        response.headers['Cache-Control'] = 'no-cache, private'
         response.headers['Pragma'] = 'no-cache'
         response.headers['Expires'] = '0'
         
@@ -244,6 +244,142 @@ def fetch_emails(email_id):
             'timestamp': datetime.now().isoformat()
         }), 500
 
+@app.route('/api/inbox/<email_id>/latest-code')
+@limiter.limit("500 per hour")
+def latest_code(email_id):
+    """Verification code and action links of the newest message that has any"""
+    session_id = session.get('session_id')
+    
+    if not email_id or len(email_id) > 100:
+        return jsonify({'status': 'error', 'message': 'Invalid email ID'}), 400
+    
+    temp_email = temp_emails.get(email_id)
+    if not temp_email:
+        return jsonify({'status': 'error', 'message': 'Email not found'}), 404
+    
+    if temp_email.session_id != session_id:
+        return jsonify({'status': 'error', 'message': 'Unauthorized access'}), 403
+    
+    if not temp_email.is_active or (hasattr(temp_email, 'is_expired') and temp_email.is_expired):
+        return jsonify({'status': 'error', 'message': 'Email inactive'}), 404
+    
+    if MAIL_POLLER_ENABLED and getattr(temp_email, 'mail_tm_id', None):
+        mail_poller.touch(email_id)
+    
+    # Codes were extracted at ingest and the store keeps a pointer to the
+    # newest message that has any
+    message = email_messages.latest_with_codes(email_id)
+    if message is None:
+        return jsonify({'status': 'success', 'code': None, 'codes': [], 'links': []})
+    
+    codes = list(message.verification_codes)
+    response = make_response(jsonify({
+        'status': 'success',
+        'code': codes[0] if codes else None,
+        'codes': codes,
+        'links': list(message.action_links),
+        'message_id': message.id,
+        'subject': escape(getattr(message, 'subject', '') or ''),
+        'received_at': message.received_at.strftime('%Y-%m-%d %H:%M:%S')
+    }))
+    response.headers['Cache-Control'] = 'no-cache, private'
+    return response
+
+# Open Server-Sent Events streams are capped per process
+sse_stream_slots = threading.BoundedSemaphore(max(SSE_MAX_STREAMS, 1))
+
+@app.route('/events/<email_id>')
+@limiter.limit("500 per hour")  # Streams reconnect every SSE_MAX_STREAM_DURATION
+def inbox_events(email_id):
+    """Server-Sent Events stream announcing new messages for one inbox"""
+    session_id = session.get('session_id')
+    
+    if SSE_MAX_STREAMS <= 0:
+        return jsonify({'status': 'error', 'message': 'Event streams disabled'}), 503
+    
+    # Enhanced input validation
+    if not email_id or len(email_id) > 100:
+        return jsonify({'status': 'error', 'message': 'Invalid email ID'}), 400
+    
+    # Verify ownership
+    temp_email = temp_emails.get(email_id)
+    if not temp_email:
+        return jsonify({'status': 'error', 'message': 'Email not found', 'redirect': '/'}), 404
+    if temp_email.session_id != session_id:
+        return jsonify({'status': 'error', 'message': 'Unauthorized access'}), 403
+    
+    if not sse_stream_slots.acquire(blocking=False):
+        response = jsonify({'status': 'error', 'message': 'Too many open event streams'})
+        response.headers['Retry-After'] = '30'
+        return response, 503
+    
+    # Resume from the client's last seen version (EventSource sends Last-Event-ID)
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', 0, type=int)
+    
+    changed = email_messages.subscribe(email_id)
+    
+    def close_stream():
+        email_messages.unsubscribe(email_id, changed)
+        sse_stream_slots.release()
+    
+    # Without the background poller nothing else syncs the inbox while the
+    # stream is open, so the stream does it at the poll interval
+    sync_inline = not MAIL_POLLER_ENABLED and bool(getattr(temp_email, 'mail_tm_id', None))
+    
+    def stream():
+        nonlocal since
+        deadline = time.monotonic() + SSE_MAX_STREAM_DURATION
+        next_sync = time.monotonic()
+        last_sent = time.monotonic()
+        yield f"retry: {int(SSE_HEARTBEAT_INTERVAL * 1000)}\n\n"
+        while time.monotonic() < deadline:
+            changed.clear()
+            if email_id not in temp_emails:
+                yield "event: expired\ndata: {}\n\n"
+                return
+            
+            if sync_inline and time.monotonic() >= next_sync:
+                mail_tm_service.fetch_emails_for_account(temp_email, None, EmailMessage)
+                next_sync = time.monotonic() + mail_poller.interval
+            
+            version = email_messages.inbox_version(email_id)
+            if version > since:
+                new_messages = email_messages.messages_since(email_id, since)
+                payload = {
+                    'version': version,
+                    'count': email_messages.count_for_inbox(email_id),
+                    'new_count': len(new_messages),
+                    'messages': [{
+                        'id': str(msg.id),
+                        'sender': str(escape(msg.sender_email or '')),
+                        'subject': str(escape(msg.subject or 'No Subject')),
+                        'timestamp': int(msg.received_at.timestamp())
+                    } for msg in new_messages]
+                }
+                yield f"id: {version}\nevent: messages\ndata: {json.dumps(payload)}\n\n"
+                since = version
+                last_sent = time.monotonic()
+            
+            # Keep the inbox on the poller's fast interval while a stream is open
+            if MAIL_POLLER_ENABLED:
+                mail_poller.touch(email_id)
+            now = time.monotonic()
+            timeout = min(SSE_HEARTBEAT_INTERVAL, deadline - now)
+            if sync_inline:
+                timeout = min(timeout, next_sync - now)
+            if not changed.wait(max(timeout, 0)) and time.monotonic() - last_sent >= SSE_HEARTBEAT_INTERVAL:
+                yield ": heartbeat\n\n"
+                last_sent = time.monotonic()
+    
+    # Runs when the server closes the response, also if the client went away
+    response = Response(stream(), mimetype='text/event-stream')
+    response.call_on_close(close_stream)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Disable proxy buffering
+    return response
+
 @app.route('/delete-email/<email_id>', methods=['POST'])
 def delete_email(email_id):
     session_id = session.get('session_id')
@@ -255,13 +391,7 @@ def delete_email(email_id):
         return redirect(url_for('index'))
     
     # Delete associated messages
-    messages_to_delete = []
-    for msg_id, msg in email_messages.items():
-        if msg.temp_email_id == email_id:
-            messages_to_delete.append(msg_id)
-    
-    for msg_id in messages_to_delete:
-        del email_messages[msg_id]
+    email_messages.delete_for_inbox(email_id)
     
     # Delete the email
     del temp_emails[email_id]
@@ -282,6 +412,22 @@ def terms():
 def about():
     return render_template('about.html')
 
+@app.route('/metrics')
+@limiter.exempt
+def metrics_endpoint():
+    """Prometheus scrape endpoint, totals across all worker processes"""
+    if not METRICS_ENABLED:
+        return jsonify({'status': 'error', 'message': 'Metrics disabled'}), 404
+    
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', '').encode(),
+                                                 f'Bearer {METRICS_TOKEN}'.encode()):
+        return jsonify({'status': 'error', 'message': 'Unauthorized'}), 401
+    
+    response = make_response(metrics.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    response.headers['Cache-Control'] = 'no-cache, private'
+    return response
+
 @app.route('/robots.txt')
 def robots_txt():
     """SEO-optimized robots.txt for better search crawling"""
@@ -299,6 +445,7 @@ Disallow: /email-inbox/
 Disallow: /fetch-emails/
 Disallow: /admin/
 Disallow: /api/
+Disallow: /metrics
 
 # Sitemap
 Sitemap: https://tempmail.replit.app/sitemap.xml
@@ -367,31 +514,7 @@ def add_test_email(email_id):
         html_content="<p>This is a test email message to verify the email display functionality.</p>"
     )
     
-    email_messages[test_message.id] = test_message
+    annotate_message(test_message)
+    email_messages.add(test_message)
     flash('Test email added successfully!', 'success')
     return redirect(url_for('index'))
-
-# Helper function to clean expired emails
-def cleanup_expired_emails():
-    """Remove expired emails from memory"""
-    expired_emails = []
-    for email_id, email in temp_emails.items():
-        if hasattr(email, 'is_expired') and email.is_expired:
-            expired_emails.append(email_id)
-    
-    for email_id in expired_emails:
-        # Delete associated messages
-        messages_to_delete = []
-        for msg_id, msg in email_messages.items():
-            if msg.temp_email_id == email_id:
-                messages_to_delete.append(msg_id)
-        
-        for msg_id in messages_to_delete:
-            del email_messages[msg_id]
-        
-        del temp_emails[email_id]
-
-# Run cleanup before each request
-@app.before_request
-def cleanup_before_request():
-    cleanup_expired_emails()
\ No newline at end of file
@@ -0,0 +1,512 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from journal import inbox_from_record, inbox_to_record, message_from_record, message_to_record
+from store import utc_timestamp
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS inboxes (
+    id TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    expires_ts REAL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS inboxes_session ON inboxes (session_id);
+CREATE INDEX IF NOT EXISTS inboxes_expiry ON inboxes (expires_ts) WHERE expires_ts IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    temp_email_id TEXT NOT NULL,
+    mail_tm_id TEXT,
+    received_ts REAL NOT NULL,
+    seq INTEGER NOT NULL,
+    has_codes INTEGER NOT NULL DEFAULT 0,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_inbox ON messages (temp_email_id, received_ts, seq);
+CREATE INDEX IF NOT EXISTS messages_inbox_seq ON messages (temp_email_id, seq);
+CREATE UNIQUE INDEX IF NOT EXISTS messages_mail_tm ON messages (temp_email_id, mail_tm_id)
+    WHERE mail_tm_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS messages_inbox_codes ON messages (temp_email_id, received_ts, seq)
+    WHERE has_codes;
+
+CREATE TABLE IF NOT EXISTS inbox_versions (
+    temp_email_id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS inbox_views (
+    temp_email_id TEXT PRIMARY KEY,
+    viewed_ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS inbox_views_ts ON inbox_views (viewed_ts);
+CREATE TABLE IF NOT EXISTS change_sequence (
+    id INTEGER PRIMARY KEY AUTOINCREMENT
+);
+"""
+
+# Statements used on hot paths. They are module constants so every call hits
+# sqlite3's per-connection prepared statement cache.
+SELECT_INBOX = "SELECT data FROM inboxes WHERE id = ?"
+INBOX_EXISTS = "SELECT 1 FROM inboxes WHERE id = ?"
+SELECT_SESSION_INBOXES = "SELECT id, data FROM inboxes WHERE session_id = ? ORDER BY rowid"
+SELECT_SESSION_INBOX_IDS = "SELECT id FROM inboxes WHERE session_id = ? ORDER BY rowid"
+UPSERT_INBOX = (
+    "INSERT INTO inboxes (id, session_id, expires_ts, data) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (id) DO UPDATE SET session_id = excluded.session_id, "
+    "expires_ts = excluded.expires_ts, data = excluded.data"
+)
+DELETE_INBOX = "DELETE FROM inboxes WHERE id = ?"
+UPSERT_INBOX_VIEW = (
+    "INSERT INTO inbox_views (temp_email_id, viewed_ts) VALUES (?, ?) "
+    "ON CONFLICT (temp_email_id) DO UPDATE SET viewed_ts = excluded.viewed_ts"
+)
+SELECT_VIEWED_SINCE = "SELECT temp_email_id FROM inbox_views WHERE viewed_ts >= ?"
+DELETE_INBOX_VIEW = "DELETE FROM inbox_views WHERE temp_email_id = ?"
+SELECT_EXPIRED = "SELECT id, data FROM inboxes WHERE expires_ts <= ? ORDER BY expires_ts LIMIT ?"
+
+SELECT_MESSAGE = "SELECT data FROM messages WHERE id = ?"
+MESSAGE_EXISTS = "SELECT 1 FROM messages WHERE id = ?"
+SELECT_INBOX_MESSAGES = "SELECT data FROM messages WHERE temp_email_id = ? ORDER BY received_ts, seq"
+SELECT_INBOX_MESSAGES_DESC = (
+    "SELECT data FROM messages WHERE temp_email_id = ? ORDER BY received_ts DESC, seq DESC"
+)
+SELECT_LATEST_WITH_CODES = (
+    "SELECT data FROM messages WHERE temp_email_id = ? AND has_codes "
+    "ORDER BY received_ts DESC, seq DESC LIMIT 1"
+)
+SELECT_MESSAGES_SINCE = (
+    "SELECT data FROM messages WHERE temp_email_id = ? AND seq > ? ORDER BY received_ts, seq"
+)
+COUNT_INBOX_MESSAGES = "SELECT COUNT(*) FROM messages WHERE temp_email_id = ?"
+SELECT_BY_MAIL_TM_ID = "SELECT data FROM messages WHERE temp_email_id = ? AND mail_tm_id = ?"
+MAIL_TM_ID_EXISTS = "SELECT 1 FROM messages WHERE temp_email_id = ? AND mail_tm_id = ?"
+INSERT_MESSAGE = (
+    "INSERT OR IGNORE INTO messages (id, temp_email_id, mail_tm_id, received_ts, seq, has_codes, data) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+DELETE_MESSAGE = "DELETE FROM messages WHERE id = ? RETURNING temp_email_id, data"
+DELETE_INBOX_MESSAGES = "DELETE FROM messages WHERE temp_email_id = ? RETURNING id"
+TRIM_INBOX_MESSAGES = (
+    "DELETE FROM messages WHERE id IN (SELECT id FROM messages WHERE temp_email_id = ? "
+    "ORDER BY received_ts DESC, seq DESC LIMIT -1 OFFSET ?) RETURNING id"
+)
+SELECT_INBOX_VERSION = "SELECT version FROM inbox_versions WHERE temp_email_id = ?"
+UPSERT_INBOX_VERSION = (
+    "INSERT INTO inbox_versions (temp_email_id, version) VALUES (?, ?) "
+    "ON CONFLICT (temp_email_id) DO UPDATE SET version = excluded.version"
+)
+DELETE_INBOX_VERSION = "DELETE FROM inbox_versions WHERE temp_email_id = ?"
+NEXT_CHANGE = "INSERT INTO change_sequence DEFAULT VALUES"
+TRIM_CHANGES = "DELETE FROM change_sequence WHERE id < ?"
+
+
+def _dumps(record):
+    return json.dumps(record, separators=(',', ':'))
+
+
+class SQLiteDatabase:
+    """SQLite file shared by every worker process on a host
+
+    Runs in WAL mode so readers never block the single writer. Each thread
+    gets its own connection; writes go through ``write()``, which holds an
+    immediate transaction so concurrent writers queue on the busy timeout
+    instead of failing half-way.
+    """
+
+    def __init__(self, path, busy_timeout=5.0, statement_cache_size=256):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.statement_cache_size = statement_cache_size
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection.executescript(SCHEMA)
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path,
+                timeout=self.busy_timeout,
+                isolation_level=None,
+                check_same_thread=False,
+                cached_statements=self.statement_cache_size
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def query(self, sql, params=()):
+        return self.connection.execute(sql, params)
+
+    @contextmanager
+    def write(self):
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def data_version(self):
+        """Counter that changes whenever another connection commits"""
+        return self.query("PRAGMA data_version").fetchone()[0]
+
+
+class SQLiteInboxStore:
+    """TempEmail storage in SQLite with the same interface as ``store.InboxStore``
+
+    Inboxes are looked up by primary key, by session and by expiry time
+    through indexes. Up to ``max_objects`` of the objects handed out are
+    cached per process (LRU), so state kept on them between polls (such as
+    the mail.tm sync cursor) survives while the inbox is in use. Inboxes
+    removed by another worker leave the cache on a failed ``get`` or by
+    ageing out.
+    """
+
+    def __init__(self, db, max_objects=10000):
+        self.db = db
+        self.max_objects = max_objects
+        # Unused; the database is already durable
+        self.journal = None
+        self._objects = OrderedDict()
+        self._objects_lock = threading.Lock()
+
+    def _cache(self, email):
+        self._objects[email.id] = email
+        self._objects.move_to_end(email.id)
+        while len(self._objects) > self.max_objects:
+            self._objects.popitem(last=False)
+
+    def _inbox(self, email_id, data):
+        with self._objects_lock:
+            email = self._objects.get(email_id)
+            if email is None:
+                email = inbox_from_record(json.loads(data))
+            self._cache(email)
+            return email
+
+    def _forget(self, email_id):
+        with self._objects_lock:
+            self._objects.pop(email_id, None)
+
+    # Dict-style access (kept for backward compatibility)
+    def __setitem__(self, email_id, email):
+        if email_id != email.id:
+            raise KeyError(f"Email id mismatch: {email_id} != {email.id}")
+        self.add(email)
+
+    def __getitem__(self, email_id):
+        email = self.get(email_id)
+        if email is None:
+            raise KeyError(email_id)
+        return email
+
+    def __delitem__(self, email_id):
+        if not self.remove(email_id):
+            raise KeyError(email_id)
+
+    def __contains__(self, email_id):
+        return self.db.query(INBOX_EXISTS, (email_id,)).fetchone() is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self.db.query("SELECT COUNT(*) FROM inboxes").fetchone()[0]
+
+    def get(self, email_id, default=None):
+        row = self.db.query(SELECT_INBOX, (email_id,)).fetchone()
+        if row is None:
+            self._forget(email_id)
+            return default
+        return self._inbox(email_id, row[0])
+
+    def keys(self):
+        return [row[0] for row in self.db.query("SELECT id FROM inboxes ORDER BY rowid")]
+
+    def values(self):
+        return [email for _, email in self.items()]
+
+    def items(self):
+        rows = self.db.query("SELECT id, data FROM inboxes ORDER BY rowid").fetchall()
+        return [(email_id, self._inbox(email_id, data)) for email_id, data in rows]
+
+    # Indexed operations
+    def add(self, email):
+        """Store an inbox, replacing any inbox with the same id"""
+        expires_at = getattr(email, 'expires_at', None)
+        expires_ts = utc_timestamp(expires_at) if expires_at is not None else None
+        with self.db.write() as connection:
+            connection.execute(UPSERT_INBOX, (email.id, email.session_id, expires_ts,
+                                              _dumps(inbox_to_record(email))))
+        with self._objects_lock:
+            self._cache(email)
+        return email
+
+    def remove(self, email_id):
+        """Remove an inbox, returning it (or None if unknown)"""
+        with self.db.write() as connection:
+            row = connection.execute(SELECT_INBOX, (email_id,)).fetchone()
+            if row is None:
+                return None
+            connection.execute(DELETE_INBOX, (email_id,))
+            connection.execute(DELETE_INBOX_VIEW, (email_id,))
+        email = self._inbox(email_id, row[0])
+        self._forget(email_id)
+        return email
+
+    def ids_for_session(self, session_id):
+        """Return the ids of every inbox owned by a session"""
+        return [row[0] for row in self.db.query(SELECT_SESSION_INBOX_IDS, (session_id,))]
+
+    def for_session(self, session_id):
+        """Return every inbox owned by a session, oldest first"""
+        rows = self.db.query(SELECT_SESSION_INBOXES, (session_id,)).fetchall()
+        return [self._inbox(email_id, data) for email_id, data in rows]
+
+    def pop_expired(self, now, limit):
+        """Remove and return up to ``limit`` inboxes that expired before ``now``"""
+        expired = []
+        with self.db.write() as connection:
+            rows = connection.execute(SELECT_EXPIRED, (utc_timestamp(now), limit)).fetchall()
+            for email_id, data in rows:
+                connection.execute(DELETE_INBOX, (email_id,))
+                connection.execute(DELETE_INBOX_VIEW, (email_id,))
+                expired.append((email_id, data))
+        emails = []
+        for email_id, data in expired:
+            emails.append(self._inbox(email_id, data))
+            self._forget(email_id)
+        return emails
+
+    # Views, so the one worker polling mail.tm knows what the others show
+    def mark_viewed(self, email_id, viewed_ts=None):
+        with self.db.write() as connection:
+            connection.execute(UPSERT_INBOX_VIEW, (email_id, viewed_ts or time.time()))
+
+    def viewed_since(self, viewed_ts):
+        """Ids of inboxes viewed at or after the POSIX time ``viewed_ts``"""
+        return [row[0] for row in self.db.query(SELECT_VIEWED_SINCE, (viewed_ts,))]
+
+
+class SQLiteMessageStore:
+    """Message storage in SQLite with the same interface as ``store.MessageStore``
+
+    Inbox versions come from a database-wide change sequence, so ETags and
+    ``since`` cursors stay valid whichever worker answers a request. Change
+    notifications for ``subscribe`` cover other processes too: a watcher
+    thread checks ``PRAGMA data_version`` every ``notify_interval`` seconds
+    while anyone is subscribed. ``max_per_inbox`` caps how many messages one
+    inbox keeps, dropping the oldest first. Messages this process drops are
+    discarded from ``rendered_cache``, when given; other workers' caches
+    age them out.
+    """
+
+    def __init__(self, db, notify_interval=1.0, max_per_inbox=0, rendered_cache=None):
+        self.db = db
+        self.notify_interval = notify_interval
+        self.max_per_inbox = max_per_inbox
+        self.rendered_cache = rendered_cache
+        # Unused; the database is already durable
+        self.journal = None
+        self._lock = threading.Lock()
+        # temp_email_id -> [threading.Event] set whenever that inbox may have changed
+        self._subscribers = {}
+        self._watcher = None
+
+    def _messages(self, rows):
+        return [message_from_record(json.loads(row[0])) for row in rows]
+
+    def _discard_rendered(self, message_ids):
+        if self.rendered_cache is not None:
+            for message_id in message_ids:
+                self.rendered_cache.discard(message_id)
+
+    # Dict-style access (kept for backward compatibility)
+    def __setitem__(self, message_id, message):
+        if message_id != message.id:
+            raise KeyError(f"Message id mismatch: {message_id} != {message.id}")
+        self.add(message)
+
+    def __getitem__(self, message_id):
+        message = self.get(message_id)
+        if message is None:
+            raise KeyError(message_id)
+        return message
+
+    def __delitem__(self, message_id):
+        if not self.remove(message_id):
+            raise KeyError(message_id)
+
+    def __contains__(self, message_id):
+        return self.db.query(MESSAGE_EXISTS, (message_id,)).fetchone() is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self.db.query("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def get(self, message_id, default=None):
+        row = self.db.query(SELECT_MESSAGE, (message_id,)).fetchone()
+        return message_from_record(json.loads(row[0])) if row else default
+
+    def keys(self):
+        return [row[0] for row in self.db.query("SELECT id FROM messages ORDER BY rowid")]
+
+    def values(self):
+        return self._messages(self.db.query("SELECT data FROM messages ORDER BY rowid"))
+
+    def items(self):
+        return [(message.id, message) for message in self.values()]
+
+    # Indexed operations
+    def _next_change(self, connection):
+        change = connection.execute(NEXT_CHANGE).lastrowid
+        connection.execute(TRIM_CHANGES, (change,))
+        return change
+
+    def add(self, message):
+        """Store a message unless its mail.tm id is already stored for the inbox
+
+        Returns the stored message: ``message`` itself, or the message that
+        was already stored under its mail.tm id.
+        """
+        trimmed = []
+        with self.db.write() as connection:
+            connection.execute("DELETE FROM messages WHERE id = ?", (message.id,))
+            change = self._next_change(connection)
+            has_codes = bool(message.verification_codes or message.action_links)
+            inserted = connection.execute(INSERT_MESSAGE, (
+                message.id, message.temp_email_id, message.mail_tm_id,
+                utc_timestamp(message.received_at), change, has_codes,
+                _dumps(message_to_record(message))
+            )).rowcount
+            if inserted:
+                connection.execute(UPSERT_INBOX_VERSION, (message.temp_email_id, change))
+                if self.max_per_inbox:
+                    trimmed = [row[0] for row in connection.execute(
+                        TRIM_INBOX_MESSAGES, (message.temp_email_id, self.max_per_inbox)
+                    ).fetchall()]
+            else:
+                existing = connection.execute(
+                    SELECT_BY_MAIL_TM_ID, (message.temp_email_id, message.mail_tm_id)
+                ).fetchone()
+        self._discard_rendered(trimmed)
+        if not inserted:
+            return message_from_record(json.loads(existing[0]))
+        self._notify(message.temp_email_id)
+        return message
+
+    def remove(self, message_id):
+        """Remove a single message, returning it (or None if unknown)"""
+        with self.db.write() as connection:
+            row = connection.execute(DELETE_MESSAGE, (message_id,)).fetchone()
+            if row is None:
+                return None
+            temp_email_id, data = row
+            connection.execute(UPSERT_INBOX_VERSION, (temp_email_id, self._next_change(connection)))
+        self._discard_rendered((message_id,))
+        self._notify(temp_email_id)
+        return message_from_record(json.loads(data))
+
+    def for_inbox(self, temp_email_id, newest_first=True):
+        """Return the messages of one inbox sorted by received date"""
+        sql = SELECT_INBOX_MESSAGES_DESC if newest_first else SELECT_INBOX_MESSAGES
+        return self._messages(self.db.query(sql, (temp_email_id,)))
+
+    def messages_since(self, temp_email_id, since, newest_first=True):
+        """Return the messages of one inbox added after version ``since``"""
+        added = self._messages(self.db.query(SELECT_MESSAGES_SINCE, (temp_email_id, since)))
+        return added[::-1] if newest_first else added
+
+    def latest_with_codes(self, temp_email_id):
+        """Newest message of an inbox with verification codes or action links"""
+        row = self.db.query(SELECT_LATEST_WITH_CODES, (temp_email_id,)).fetchone()
+        return message_from_record(json.loads(row[0])) if row else None
+
+    def inbox_version(self, temp_email_id):
+        """Version of an inbox; it increases whenever a message is added or removed"""
+        row = self.db.query(SELECT_INBOX_VERSION, (temp_email_id,)).fetchone()
+        return row[0] if row else 0
+
+    def count_for_inbox(self, temp_email_id):
+        return self.db.query(COUNT_INBOX_MESSAGES, (temp_email_id,)).fetchone()[0]
+
+    def find_by_mail_tm_id(self, temp_email_id, mail_tm_id):
+        """Look up a stored message by its mail.tm id within one inbox"""
+        row = self.db.query(SELECT_BY_MAIL_TM_ID, (temp_email_id, mail_tm_id)).fetchone()
+        return message_from_record(json.loads(row[0])) if row else None
+
+    def has_mail_tm_id(self, temp_email_id, mail_tm_id):
+        return self.db.query(MAIL_TM_ID_EXISTS, (temp_email_id, mail_tm_id)).fetchone() is not None
+
+    def delete_for_inbox(self, temp_email_id):
+        """Delete every message of an inbox, returning how many were removed"""
+        with self.db.write() as connection:
+            removed = [row[0] for row in
+                       connection.execute(DELETE_INBOX_MESSAGES, (temp_email_id,)).fetchall()]
+            connection.execute(DELETE_INBOX_VERSION, (temp_email_id,))
+        self._discard_rendered(removed)
+        self._notify(temp_email_id)
+        return len(removed)
+
+    # Change notifications
+    def subscribe(self, temp_email_id):
+        """Return an Event that is set whenever the inbox may have changed"""
+        event = threading.Event()
+        with self._lock:
+            self._subscribers.setdefault(temp_email_id, []).append(event)
+            if self._watcher is None or not self._watcher.is_alive():
+                self._watcher = threading.Thread(target=self._watch, name='sqlite-store-watcher',
+                                                 daemon=True)
+                self._watcher.start()
+        return event
+
+    def unsubscribe(self, temp_email_id, event):
+        with self._lock:
+            events = self._subscribers.get(temp_email_id)
+            if events and event in events:
+                events.remove(event)
+                if not events:
+                    del self._subscribers[temp_email_id]
+
+    def _notify(self, temp_email_id):
+        with self._lock:
+            events = list(self._subscribers.get(temp_email_id, ()))
+        for event in events:
+            event.set()
+
+    def _watch(self):
+        """Wake every subscriber when another process commits, until none are left"""
+        try:
+            version = self.db.data_version()
+            while True:
+                with self._lock:
+                    if not self._subscribers:
+                        self._watcher = None
+                        return
+                time.sleep(self.notify_interval)
+                current = self.db.data_version()
+                if current != version:
+                    version = current
+                    with self._lock:
+                        events = [event for events in self._subscribers.values() for event in events]
+                    for event in events:
+                        event.set()
+        except Exception as e:
+            logging.error(f"Error watching message store: {e}")
+            with self._lock:
+                self._watcher = None
@@ -0,0 +1,475 @@
+import bisect
+import heapq
+import itertools
+import threading
+from datetime import timezone
+
+
+def utc_timestamp(value):
+    """POSIX timestamp of a datetime; naive datetimes are treated as UTC"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def _received_key(message):
+    """Sort key for messages by received date"""
+    return utc_timestamp(message.received_at)
+
+
+def _has_extras(message):
+    """True for messages with extracted verification codes or action links"""
+    return bool(getattr(message, 'verification_codes', None) or getattr(message, 'action_links', None))
+
+
+def _shard_index(key, shards):
+    return hash(key) % shards
+
+
+class _InboxShard:
+    __slots__ = ('lock', 'by_session')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # session_id -> {email_id: None}, a dict used as an ordered set
+        self.by_session = {}
+
+
+class InboxStore:
+    """In-memory TempEmail storage with a session index and expiry heap
+
+    Behaves like the plain ``{email_id: TempEmail}`` dict it replaces and
+    additionally maintains ``session_id -> {email_id}`` so a session's
+    inboxes can be listed or replaced without scanning every inbox. Inboxes
+    with an ``expires_at`` are also kept in a min-heap so expired ones can be
+    popped without looking at the rest.
+
+    The store is safe to share between threads. The session index is split
+    into ``shards`` by session id, each with its own lock, so requests for
+    different sessions do not wait on each other; readers get copies, never
+    live views of the underlying dicts.
+    """
+
+    def __init__(self, shards=32):
+        self._shards = [_InboxShard() for _ in range(shards)]
+        # email_id -> TempEmail; single get/set/pop calls and list() copies
+        # run without releasing the GIL, so readers need no lock
+        self._emails = {}
+        # (expires_at timestamp, email_id); stale entries are skipped on pop
+        self._expiry_lock = threading.Lock()
+        self._expiry_heap = []
+        # Optional journal.Journal that every change is recorded to
+        self.journal = None
+
+    def _shard(self, session_id):
+        return self._shards[_shard_index(session_id, len(self._shards))]
+
+    # Dict-style access (kept for backward compatibility)
+    def __setitem__(self, email_id, email):
+        if email_id != email.id:
+            raise KeyError(f"Email id mismatch: {email_id} != {email.id}")
+        self.add(email)
+
+    def __getitem__(self, email_id):
+        return self._emails[email_id]
+
+    def __delitem__(self, email_id):
+        if not self.remove(email_id):
+            raise KeyError(email_id)
+
+    def __contains__(self, email_id):
+        return email_id in self._emails
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._emails)
+
+    def get(self, email_id, default=None):
+        return self._emails.get(email_id, default)
+
+    def keys(self):
+        return list(self._emails)
+
+    def values(self):
+        return list(self._emails.values())
+
+    def items(self):
+        return list(self._emails.items())
+
+    # Indexed operations
+    def add(self, email):
+        """Store an inbox, register it under its session and schedule expiry"""
+        if email.id in self._emails:
+            self._remove(email.id)
+
+        shard = self._shard(email.session_id)
+        with shard.lock:
+            self._emails[email.id] = email
+            shard.by_session.setdefault(email.session_id, {})[email.id] = None
+            if self.journal is not None:
+                self.journal.inbox_added(email)
+
+        expires_at = getattr(email, 'expires_at', None)
+        if expires_at is not None:
+            with self._expiry_lock:
+                heapq.heappush(self._expiry_heap, (utc_timestamp(expires_at), email.id))
+        return email
+
+    def remove(self, email_id):
+        """Remove an inbox, returning it (or None if unknown)"""
+        return self._remove(email_id, journal=True)
+
+    def _remove(self, email_id, journal=False, expires_ts=None):
+        email = self._emails.get(email_id)
+        if email is None:
+            return None
+
+        shard = self._shard(email.session_id)
+        with shard.lock:
+            # Lost a race with another remove, or the inbox was replaced
+            if self._emails.get(email_id) is not email:
+                return None
+            # Only reap an inbox whose expiry has not been changed meanwhile
+            if expires_ts is not None and utc_timestamp(email.expires_at) != expires_ts:
+                return None
+            del self._emails[email_id]
+
+            session_emails = shard.by_session.get(email.session_id)
+            if session_emails is not None:
+                session_emails.pop(email_id, None)
+                if not session_emails:
+                    del shard.by_session[email.session_id]
+            if journal and self.journal is not None:
+                self.journal.inbox_removed(email_id)
+            return email
+
+    def ids_for_session(self, session_id):
+        """Return the ids of every inbox owned by a session"""
+        shard = self._shard(session_id)
+        with shard.lock:
+            return list(shard.by_session.get(session_id, ()))
+
+    def for_session(self, session_id):
+        """Return every inbox owned by a session, oldest first"""
+        shard = self._shard(session_id)
+        with shard.lock:
+            return [self._emails[email_id] for email_id in shard.by_session.get(session_id, ())]
+
+    def pop_expired(self, now, limit):
+        """Remove and return up to ``limit`` inboxes that expired before ``now``"""
+        now_ts = utc_timestamp(now)
+        due = []
+        with self._expiry_lock:
+            while self._expiry_heap and len(due) < limit:
+                expires_ts, email_id = self._expiry_heap[0]
+                if expires_ts > now_ts:
+                    break
+                heapq.heappop(self._expiry_heap)
+
+                # Skip entries for deleted inboxes; reschedule changed expiry times
+                email = self._emails.get(email_id)
+                expires_at = getattr(email, 'expires_at', None)
+                if expires_at is None:
+                    continue
+                if utc_timestamp(expires_at) != expires_ts:
+                    heapq.heappush(self._expiry_heap, (utc_timestamp(expires_at), email_id))
+                    continue
+                due.append((email_id, expires_ts))
+
+            # Deleted inboxes leave stale heap entries behind; rebuild the
+            # heap once they make up most of it so it cannot grow unbounded
+            if len(self._expiry_heap) > 2 * len(self._emails) + 64:
+                self._expiry_heap = [
+                    (utc_timestamp(email.expires_at), email.id)
+                    for email in self.values()
+                    if getattr(email, 'expires_at', None) is not None
+                ]
+                heapq.heapify(self._expiry_heap)
+
+        # Shard locks are taken after the expiry lock is released; add() takes
+        # them in the opposite order
+        expired = []
+        for email_id, expires_ts in due:
+            email = self._remove(email_id, journal=True, expires_ts=expires_ts)
+            if email is not None:
+                expired.append(email)
+        return expired
+
+
+class _MessageShard:
+    __slots__ = ('lock', 'by_inbox', 'by_mail_tm_id', 'message_sequence', 'inbox_version',
+                 'latest_extras', 'subscribers')
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # temp_email_id -> [EmailMessage] sorted oldest first
+        self.by_inbox = {}
+        # (temp_email_id, mail_tm_id) -> message id
+        self.by_mail_tm_id = {}
+        # Every message remembers the change number it was added at and every
+        # inbox the number of its last change
+        self.message_sequence = {}
+        self.inbox_version = {}
+        # temp_email_id -> newest message with verification codes or links
+        self.latest_extras = {}
+        # temp_email_id -> [threading.Event] set whenever that inbox changes
+        self.subscribers = {}
+
+
+class MessageStore:
+    """In-memory message storage indexed by inbox and by mail.tm message id
+
+    Behaves like the plain ``{message_id: EmailMessage}`` dict it replaces,
+    but also keeps per-inbox lists sorted by ``received_at`` so that routes
+    never have to scan every stored message to render one inbox.
+
+    ``max_per_inbox`` caps how many messages one inbox keeps (the oldest are
+    dropped first) and an optional ``body_budget.BodyBudget`` bounds the
+    memory held by message bodies across all inboxes. Dropped messages are
+    also discarded from ``rendered_cache``, when given.
+
+    Like ``InboxStore`` it is split into ``shards``, here by inbox id, so
+    that threads working on different inboxes never contend for a lock.
+    """
+
+    def __init__(self, max_per_inbox=0, budget=None, shards=32, rendered_cache=None):
+        self.max_per_inbox = max_per_inbox
+        self.budget = budget
+        self.rendered_cache = rendered_cache
+        self._shards = [_MessageShard() for _ in range(shards)]
+        # message_id -> EmailMessage, safe to read without a lock like
+        # InboxStore._emails
+        self._messages = {}
+        # Store-wide change counter shared by all shards
+        self._sequence = itertools.count(1)
+        # Optional journal.Journal that every change is recorded to
+        self.journal = None
+
+    def _shard(self, temp_email_id):
+        return self._shards[_shard_index(temp_email_id, len(self._shards))]
+
+    # Dict-style access (kept for backward compatibility)
+    def __setitem__(self, message_id, message):
+        if message_id != message.id:
+            raise KeyError(f"Message id mismatch: {message_id} != {message.id}")
+        self.add(message)
+
+    def __getitem__(self, message_id):
+        message = self._messages[message_id]
+        self._touch((message,))
+        return message
+
+    def __delitem__(self, message_id):
+        if not self.remove(message_id):
+            raise KeyError(message_id)
+
+    def __contains__(self, message_id):
+        return message_id in self._messages
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._messages)
+
+    def get(self, message_id, default=None):
+        message = self._messages.get(message_id)
+        if message is None:
+            return default
+        self._touch((message,))
+        return message
+
+    def keys(self):
+        return list(self._messages)
+
+    def values(self):
+        return list(self._messages.values())
+
+    def items(self):
+        return list(self._messages.items())
+
+    # Indexed operations
+    def add(self, message):
+        """Store a message unless its mail.tm id is already stored for the inbox
+
+        Returns the stored message: ``message`` itself, or the message that
+        was already stored under its mail.tm id.
+        """
+        existing = self._messages.get(message.id)
+        if existing is not None and existing.temp_email_id != message.temp_email_id:
+            with self._shard(existing.temp_email_id).lock:
+                self._remove(message.id)
+
+        shard = self._shard(message.temp_email_id)
+        with shard.lock:
+            if message.id in self._messages:
+                self._remove(message.id)
+            # Checked under the lock so concurrent syncs of one inbox cannot
+            # both store the same mail.tm message
+            stored_id = shard.by_mail_tm_id.get((message.temp_email_id, message.mail_tm_id))
+            if message.mail_tm_id and stored_id is not None:
+                return self._messages[stored_id]
+
+            self._messages[message.id] = message
+            inbox = shard.by_inbox.setdefault(message.temp_email_id, [])
+            bisect.insort(inbox, message, key=_received_key)
+            if message.mail_tm_id:
+                shard.by_mail_tm_id[(message.temp_email_id, message.mail_tm_id)] = message.id
+            if _has_extras(message):
+                latest = shard.latest_extras.get(message.temp_email_id)
+                # Ties go to the later insert, matching the order of by_inbox
+                if latest is None or _received_key(message) >= _received_key(latest):
+                    shard.latest_extras[message.temp_email_id] = message
+
+            sequence = next(self._sequence)
+            shard.message_sequence[message.id] = sequence
+            shard.inbox_version[message.temp_email_id] = sequence
+            self._notify(message.temp_email_id)
+            if self.journal is not None:
+                self.journal.message_added(message)
+
+            if self.max_per_inbox:
+                while len(inbox) > self.max_per_inbox:
+                    self.remove(inbox[0].id)
+
+        # Compression and spilling happen outside the shard lock. A message
+        # removed in the meantime was forgotten before it was admitted.
+        if self.budget is not None and self._messages.get(message.id) is message:
+            self.budget.admit(message)
+            if self._messages.get(message.id) is not message:
+                self.budget.forget(message)
+        return message
+
+    def remove(self, message_id):
+        """Remove a single message, returning it (or None if unknown)"""
+        message = self._messages.get(message_id)
+        if message is None:
+            return None
+        with self._shard(message.temp_email_id).lock:
+            message = self._remove(message_id)
+            if message is not None and self.journal is not None:
+                self.journal.message_removed(message_id)
+            return message
+
+    def _remove(self, message_id):
+        """Unindex a message (call with its shard's lock held)"""
+        message = self._messages.pop(message_id, None)
+        if message is None:
+            return None
+
+        shard = self._shard(message.temp_email_id)
+        inbox = shard.by_inbox.get(message.temp_email_id)
+        if inbox is not None:
+            inbox.remove(message)
+            if not inbox:
+                del shard.by_inbox[message.temp_email_id]
+        if message.mail_tm_id:
+            shard.by_mail_tm_id.pop((message.temp_email_id, message.mail_tm_id), None)
+        if shard.latest_extras.get(message.temp_email_id) is message:
+            # Only removing the pointed-to message needs a scan for the next one
+            latest = next((msg for msg in reversed(inbox or ()) if _has_extras(msg)), None)
+            if latest is None:
+                del shard.latest_extras[message.temp_email_id]
+            else:
+                shard.latest_extras[message.temp_email_id] = latest
+
+        shard.message_sequence.pop(message_id, None)
+        shard.inbox_version[message.temp_email_id] = next(self._sequence)
+        self._notify(message.temp_email_id)
+        if self.budget is not None:
+            self.budget.forget(message)
+        if self.rendered_cache is not None:
+            self.rendered_cache.discard(message_id)
+        return message
+
+    def _touch(self, messages):
+        """Record that messages are being read, for the body budget's LRU"""
+        if self.budget is not None:
+            self.budget.touch(messages)
+
+    def for_inbox(self, temp_email_id, newest_first=True):
+        """Return the messages of one inbox sorted by received date"""
+        shard = self._shard(temp_email_id)
+        with shard.lock:
+            inbox = shard.by_inbox.get(temp_email_id, [])
+            self._touch(inbox)
+            return inbox[::-1] if newest_first else list(inbox)
+
+    def latest_with_codes(self, temp_email_id):
+        """Newest message of an inbox with verification codes or action links"""
+        message = self._shard(temp_email_id).latest_extras.get(temp_email_id)
+        if message is not None:
+            self._touch((message,))
+        return message
+
+    def messages_since(self, temp_email_id, since, newest_first=True):
+        """Return the messages of one inbox added after version ``since``"""
+        shard = self._shard(temp_email_id)
+        with shard.lock:
+            inbox = shard.by_inbox.get(temp_email_id, [])
+            added = [message for message in inbox if shard.message_sequence[message.id] > since]
+            self._touch(added)
+            return added[::-1] if newest_first else added
+
+    def inbox_version(self, temp_email_id):
+        """Version of an inbox; it increases whenever a message is added or removed"""
+        return self._shard(temp_email_id).inbox_version.get(temp_email_id, 0)
+
+    def count_for_inbox(self, temp_email_id):
+        return len(self._shard(temp_email_id).by_inbox.get(temp_email_id, ()))
+
+    def find_by_mail_tm_id(self, temp_email_id, mail_tm_id):
+        """Look up a stored message by its mail.tm id within one inbox"""
+        message_id = self._shard(temp_email_id).by_mail_tm_id.get((temp_email_id, mail_tm_id))
+        return self._messages.get(message_id) if message_id else None
+
+    def has_mail_tm_id(self, temp_email_id, mail_tm_id):
+        return (temp_email_id, mail_tm_id) in self._shard(temp_email_id).by_mail_tm_id
+
+    def delete_for_inbox(self, temp_email_id):
+        """Delete every message of an inbox, returning how many were removed"""
+        shard = self._shard(temp_email_id)
+        with shard.lock:
+            inbox = shard.by_inbox.pop(temp_email_id, [])
+            for message in inbox:
+                if self.budget is not None:
+                    self.budget.forget(message)
+                if self.rendered_cache is not None:
+                    self.rendered_cache.discard(message.id)
+                self._messages.pop(message.id, None)
+                shard.message_sequence.pop(message.id, None)
+                if message.mail_tm_id:
+                    shard.by_mail_tm_id.pop((temp_email_id, message.mail_tm_id), None)
+            shard.inbox_version.pop(temp_email_id, None)
+            shard.latest_extras.pop(temp_email_id, None)
+            self._notify(temp_email_id)
+            if inbox and self.journal is not None:
+                self.journal.inbox_messages_removed(temp_email_id)
+            return len(inbox)
+
+    # Change notifications
+    def subscribe(self, temp_email_id):
+        """Return an Event that is set whenever the inbox changes"""
+        event = threading.Event()
+        shard = self._shard(temp_email_id)
+        with shard.lock:
+            shard.subscribers.setdefault(temp_email_id, []).append(event)
+        return event
+
+    def unsubscribe(self, temp_email_id, event):
+        shard = self._shard(temp_email_id)
+        with shard.lock:
+            events = shard.subscribers.get(temp_email_id)
+            if events and event in events:
+                events.remove(event)
+                if not events:
+                    del shard.subscribers[temp_email_id]
+
+    def _notify(self, temp_email_id):
+        shard = self._shard(temp_email_id)
+        with shard.lock:
+            events = list(shard.subscribers.get(temp_email_id, ()))
+        for event in events:
+            event.set()
@@ -0,0 +1,65 @@
+import time
+
+from account_pool import AccountPool
+from mail_tm_service import MailTMService
+from models import TempEmail
+
+
+class StubService(MailTMService):
+    """MailTMService creating accounts without a mail.tm upstream"""
+
+    def __init__(self):
+        super().__init__()
+        self.account_creation_interval = 30
+        self.created = []
+
+    def get_available_domains(self):
+        return ['fake.test']
+
+    def create_account(self, email_address, password):
+        self.created.append(email_address)
+        return {'id': f'id-{len(self.created)}'}
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_workers_share_one_pool_file(tmp_path):
+    path = str(tmp_path / 'pool.json')
+    refiller_service, taker_service = StubService(), StubService()
+    refiller = AccountPool(refiller_service, size=4, low_water=2, refill_interval=0.01, path=path)
+    taker = AccountPool(taker_service, size=4, low_water=2, refill_interval=0.01, path=path)
+    refiller.start()
+    wait_for(lambda: refiller.depth() == 4)
+    taker.start()
+
+    taken = [taker.take()['address'] for _ in range(3)]
+    wait_for(lambda: taker.depth() == 4)
+    refiller.stop()
+    taker.stop()
+
+    # Only the process holding the refill lock creates accounts
+    assert taker_service.created == []
+    assert set(taken) <= set(refiller_service.created)
+    assert len(set(taken)) == 3
+    # A new pool on the same file sees the accounts left over
+    assert AccountPool(StubService(), size=4, path=path).depth() == 4
+
+
+def test_miss_does_not_wait_for_paced_creations(tmp_path):
+    service = StubService()
+    service.account_pool = AccountPool(service, size=2, path=str(tmp_path / 'pool.json'))
+    # A paced creation in progress, such as one sleeping out the interval
+    service._account_creation_lock.acquire()
+    try:
+        started = time.monotonic()
+        temp_email = service.create_real_temp_email('session', None, TempEmail)
+        assert time.monotonic() - started < 1
+    finally:
+        service._account_creation_lock.release()
+    assert temp_email.email_address == service.created[0]
+    assert service.account_pool.stats()['misses'] == 1
@@ -0,0 +1,101 @@
+import time
+
+import pytest
+
+from email_utils import extract_verification_info, process_html_content, process_text_content
+
+WRAPPER = '<div class="gmail-email-content">{}</div>'
+
+# Outputs of the html.parser based sanitizer this one replaced
+BASELINE_RENDERS = [
+    ('<p>Hello <b>World</b></p>',
+     '<div class="email-paragraph mb-3">Hello<strong>World</strong></div>'),
+    ('<div><h1>Title</h1><p>Para &amp; more</p><br><p>Second<br/>line</p></div>',
+     '<div class="email-paragraph mb-3"><h1 class="email-heading font-bold mb-2">Title</h1><div class="email-paragraph mb-3">Para &amp; more</div><br><div class="email-paragraph mb-3">Second<br>line</div></div>'),
+    ('<p>Click <a href="https://example.com/verify?id=1&amp;x=2">here</a> now</p>',
+     '<div class="email-paragraph mb-3">Click<div class="email-link-section my-3"><a href="https://example.com/verify?id=1&amp;x=2" target="_blank" rel="noopener noreferrer" class="email-link-button">Verify Email</a></div>now</div>'),
+    ('<a href="https://example.com/path">Short text</a>',
+     '<div class="email-link-section my-3"><a href="https://example.com/path" target="_blank" rel="noopener noreferrer" class="email-link-button">Short text</a></div>'),
+    ('<a href="https://example.com/x">This is a long link text that exceeds thirty</a>',
+     '<div class="email-link-section my-3"><a href="https://example.com/x" target="_blank" rel="noopener noreferrer" class="email-link-button">Open Link</a></div>'),
+    ('<a href="mailto:someone@example.com">Mail us</a>',
+     '<div class="email-link-section my-3"><a href="mailto:someone@example.com" target="_blank" rel="noopener noreferrer" class="email-link-button">Mail us</a></div>'),
+    ("<a href='https://example.com/reset-password'>Reset</a>",
+     '<div class="email-link-section my-3"><a href="https://example.com/reset-password" target="_blank" rel="noopener noreferrer" class="email-link-button">Reset Password</a></div>'),
+    ('<table><tr><td><strong>Code:</strong> 123456</td></tr></table>',
+     '<strong>Code:</strong>123456'),
+    ('<!DOCTYPE html><p>After doctype</p><!-- comment --><p>x</p>',
+     '<div class="email-paragraph mb-3">After doctype</div><div class="email-paragraph mb-3">x</div>'),
+    ('<h2>Heading</h2><i>italic</i> and <b>bold</b>',
+     '<h2 class="email-heading font-bold mb-2">Heading</h2><em>italic</em>and<strong>bold</strong>'),
+    ('<p>Unicode: caf&eacute; &#8212; &lt;tag&gt;</p>',
+     '<div class="email-paragraph mb-3">Unicode: café — &lt;tag&gt;</div>'),
+    ('<div><p>Nested <b><i>formatting</i></b> here</p></div>',
+     '<div class="email-paragraph mb-3"><div class="email-paragraph mb-3">Nested<strong><em>formatting</em></strong>here</div></div>'),
+    ('<p>Text with <span style="x">span</span> and <img src="a.png" alt="img"></p>',
+     '<div class="email-paragraph mb-3">Text withspanand</div>'),
+    ('<p>a</p><p>b</p><h3>c</h3><h6>d</h6>',
+     '<div class="email-paragraph mb-3">a</div><div class="email-paragraph mb-3">b</div><h3 class="email-heading font-bold mb-2">c</h3><h6 class="email-heading font-bold mb-2">d</h6>'),
+]
+
+
+@pytest.mark.parametrize('markup, expected', BASELINE_RENDERS)
+def test_well_formed_html_renders_as_before(markup, expected):
+    assert process_html_content(markup) == WRAPPER.format(expected)
+
+
+def test_script_and_style_contents_are_dropped():
+    markup = '<style>p{color:red}</style><script>alert(1)</script><p>safe</p>'
+    assert process_html_content(markup) == WRAPPER.format('<div class="email-paragraph mb-3">safe</div>')
+
+
+@pytest.mark.parametrize('markup', [
+    '<a "' * 32000,
+    '<a ' * 40000,
+    '<!' * 60000,
+    '<?' * 60000,
+    '</a ' * 30000,
+    'a<b' * 40000,
+    '<b title="' * 12000,
+])
+def test_unterminated_tags_render_in_linear_time(markup):
+    started = time.perf_counter()
+    rendered = process_html_content(markup)
+    # Quadratic tokenizing took minutes on these inputs
+    assert time.perf_counter() - started < 2
+    assert '<a ' not in rendered and '<b ' not in rendered and '<!' not in rendered
+
+
+def test_unterminated_tag_keeps_preceding_markup():
+    rendered = process_html_content('<p>Code <b>123456</b></p><a href="x')
+    assert rendered == WRAPPER.format(
+        '<div class="email-paragraph mb-3">Code<strong>123456</strong></div>&lt;a href=&quot;x'
+    )
+
+
+def test_text_around_urls_is_escaped():
+    rendered = process_text_content('<img src=x onerror=alert(1)> https://a.com/verify and <b>x</b>')
+    assert '<img' not in rendered and '<b>' not in rendered
+    assert rendered == WRAPPER.format(
+        '&lt;img src=x onerror=alert(1)&gt; '
+        '<div class="email-link-section my-3"><a href="https://a.com/verify" target="_blank" '
+        'rel="noopener noreferrer" class="email-link-button">Verify Email</a></div>'
+        ' and &lt;b&gt;x&lt;/b&gt;'
+    )
+
+
+def test_extract_skips_script_and_style():
+    codes, links = extract_verification_info(
+        'Sign in', None,
+        '<p>Your code is <b>482913</b></p><script>var x = 999999;</script>'
+        '<STYLE>.a{}</style><a href="https://example.com/verify?t=1">go</a>'
+    )
+    assert codes == ['482913']
+    assert links == [{'url': 'https://example.com/verify?t=1', 'label': 'Verify Email'}]
+
+
+@pytest.mark.parametrize('markup', ['<script>' * 40000, '<style ' * 40000, '<!' * 60000, 'x<b' * 40000])
+def test_extract_from_unterminated_tags_in_linear_time(markup):
+    started = time.perf_counter()
+    extract_verification_info('', None, markup)
+    assert time.perf_counter() - started < 2
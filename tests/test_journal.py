@@ -0,0 +1,90 @@
+from journal import Journal
+from models import EmailMessage, TempEmail
+from store import InboxStore, MessageStore
+
+
+def make_inbox():
+    return TempEmail('session', use_real_email=False)
+
+
+def load(directory):
+    inboxes, messages = InboxStore(), MessageStore()
+    Journal(directory).load(inboxes, messages)
+    return inboxes, messages
+
+
+def test_round_trip_through_compaction(tmp_path):
+    journal = Journal(str(tmp_path))
+    email = make_inbox()
+    kept = EmailMessage(email.id, 'a@example.com', subject='kept')
+    dropped = EmailMessage(email.id, 'b@example.com', subject='dropped')
+    journal.inbox_added(email)
+    journal.message_added(kept)
+    journal.message_added(dropped)
+    journal.message_removed(dropped.id)
+
+    inboxes, messages = load(str(tmp_path))
+    assert list(inboxes.keys()) == [email.id]
+    assert list(messages.keys()) == [kept.id]
+
+    assert journal.compact() == 1
+    inboxes, messages = load(str(tmp_path))
+    assert inboxes.get(email.id).email_address == email.email_address
+    assert messages.get(kept.id).subject == 'kept'
+    assert dropped.id not in messages
+
+
+def test_delete_in_later_segment_is_not_undone(tmp_path):
+    writer = Journal(str(tmp_path))
+    deleter = Journal(str(tmp_path))
+    email = make_inbox()
+    message = EmailMessage(email.id, 'a@example.com')
+    writer.inbox_added(email)
+    writer.message_added(message)
+    deleter.message_removed(message.id)
+
+    # The writer still holds its older segment, so the delete is not folded
+    assert deleter.compact() == 0
+    assert message.id not in load(str(tmp_path))[1]
+
+    # Once the writer's segment is finished both fold, in order
+    assert writer.compact() == 2
+    inboxes, messages = load(str(tmp_path))
+    assert email.id in inboxes
+    assert message.id not in messages
+
+
+def test_older_segment_deleting_from_held_segment_is_not_folded(tmp_path):
+    deleter = Journal(str(tmp_path))
+    writer = Journal(str(tmp_path))
+    email = make_inbox()
+    message = EmailMessage(email.id, 'a@example.com')
+    deleter.inbox_added(email)
+    writer.message_added(message)
+    deleter.message_removed(message.id)
+
+    # The deleter's segment is older by name but its delete is newer than
+    # the held segment's add; folding it would let replay re-add the message
+    assert deleter.compact() == 0
+    assert message.id not in load(str(tmp_path))[1]
+
+    assert writer.compact() == 2
+    inboxes, messages = load(str(tmp_path))
+    assert email.id in inboxes
+    assert message.id not in messages
+
+
+def test_inbox_messages_delete_across_segments(tmp_path):
+    first = Journal(str(tmp_path))
+    email = make_inbox()
+    first.inbox_added(email)
+    first.message_added(EmailMessage(email.id, 'a@example.com'))
+    first.compact()
+
+    second = Journal(str(tmp_path))
+    second.inbox_messages_removed(email.id)
+    second.message_added(EmailMessage(email.id, 'b@example.com', subject='after'))
+    second.compact()
+
+    inboxes, messages = load(str(tmp_path))
+    assert [message.subject for message in messages.values()] == ['after']
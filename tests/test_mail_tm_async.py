@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from benchmarks.fake_mail_tm import PAGE_SIZE, FakeMailTM
+from mail_tm_async import AsyncMailTMClient
+from mail_tm_service import SyncCursor
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    with FakeMailTM() as server:
+        monkeypatch.setenv('MAIL_TM_BASE_URL', server.url + '/')
+        yield server
+
+
+def run(coroutine_function):
+    async def main():
+        async with AsyncMailTMClient() as client:
+            return await coroutine_function(client)
+    return asyncio.run(main())
+
+
+def test_operations_against_fake_server(fake):
+    async def scenario(client):
+        assert client.base_url == fake.url
+        assert await client.get_available_domains() == ['fake.test']
+        account = await client.create_account('user@fake.test', 'secret')
+        assert account['address'] == 'user@fake.test'
+        assert await client.create_account('user@fake.test', 'secret') is None
+        assert await client.get_auth_token('user@fake.test', 'wrong') is None
+
+        for number in range(PAGE_SIZE + 5):
+            fake.inject_message('user@fake.test', subject=f'message {number}')
+        token = await client.get_auth_token('user@fake.test', 'secret')
+        messages = await client.get_messages(token)
+        details = await client.get_message_details(messages[0]['id'], token)
+        return messages, details
+
+    messages, details = run(scenario)
+    assert [msg['subject'] for msg in messages] == [f'message {n}' for n in range(PAGE_SIZE + 4, -1, -1)]
+    assert details['subject'] == f'message {PAGE_SIZE + 4}'
+    assert fake.requests['GET /messages'] == 2
+
+
+def test_incremental_sync_with_cursor(fake):
+    fake.create_account('user@fake.test', 'secret')
+    for number in range(PAGE_SIZE + 5):
+        fake.inject_message('user@fake.test', subject=f'message {number}')
+    account = ('user@fake.test', 'secret')
+    cursor = SyncCursor()
+
+    async def sync(client):
+        token = await client.get_cached_token(*account)
+        new_items, known_items, complete = await client.get_new_messages(token, cursor, account)
+        cursor.advance(new_items + known_items, complete=complete)
+        return len(new_items), complete
+
+    async def scenario(client):
+        first = await sync(client)
+        fake.inject_message('user@fake.test', subject='late')
+        return first, await sync(client), await sync(client)
+
+    assert run(scenario) == ((PAGE_SIZE + 5, True), (1, True), (0, True))
+
+
+def test_concurrent_token_requests_share_one_fetch(fake):
+    fake.create_account('user@fake.test', 'secret')
+
+    async def scenario(client):
+        tokens = await asyncio.gather(*(client.get_cached_token('user@fake.test', 'secret')
+                                        for _ in range(20)))
+        return tokens, client.token_cache.stats()
+
+    tokens, stats = run(scenario)
+    assert len(set(tokens)) == 1
+    assert stats['misses'] == 1
+    assert fake.requests['POST /token'] == 1
+
+
+def test_expired_token_is_refreshed_once(fake):
+    fake.create_account('user@fake.test', 'secret')
+    fake.inject_message('user@fake.test', subject='hello')
+    account = ('user@fake.test', 'secret')
+
+    async def scenario(client):
+        messages = await client.get_messages('stale-token', account)
+        lists = await client.fetch_message_lists([account, ('nobody@fake.test', 'x')])
+        return messages, lists
+
+    messages, lists = run(scenario)
+    assert [msg['subject'] for msg in messages] == ['hello']
+    assert [msg['subject'] for msg in lists['user@fake.test']] == ['hello']
+    assert lists['nobody@fake.test'] == []
+    assert fake.requests['POST /token'] == 2
@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from models import EmailMessage
+from sqlite_store import SQLiteDatabase, SQLiteMessageStore
+from store import MessageStore
+
+START = datetime(2024, 1, 1, 12, 0, 0)
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def make_store(request, tmp_path):
+    def make(max_per_inbox=0):
+        if request.param == 'memory':
+            return MessageStore(max_per_inbox=max_per_inbox)
+        return SQLiteMessageStore(SQLiteDatabase(str(tmp_path / 'store.db')), max_per_inbox=max_per_inbox)
+    return make
+
+
+def message(temp_email_id, minute, mail_tm_id=None, subject=None):
+    msg = EmailMessage(temp_email_id, 'sender@example.com', subject=subject or f'm{minute}',
+                       text_content='body', mail_tm_id=mail_tm_id)
+    msg.received_at = START + timedelta(minutes=minute)
+    return msg
+
+
+def subjects(messages):
+    return [msg.subject for msg in messages]
+
+
+def test_add_orders_by_received_date(make_store):
+    store = make_store()
+    for minute in (2, 0, 1):
+        store.add(message('inbox', minute))
+    store.add(message('other', 5))
+
+    assert subjects(store.for_inbox('inbox')) == ['m2', 'm1', 'm0']
+    assert subjects(store.for_inbox('inbox', newest_first=False)) == ['m0', 'm1', 'm2']
+    assert store.count_for_inbox('inbox') == 3
+    assert len(store) == 4
+
+
+def test_add_skips_known_mail_tm_id(make_store):
+    store = make_store()
+    first = message('inbox', 0, mail_tm_id='mt-1', subject='first')
+    assert store.add(first) is first
+    again = message('inbox', 1, mail_tm_id='mt-1', subject='again')
+    stored = store.add(again)
+    assert stored is not again
+    assert (stored.id, stored.subject) == (first.id, 'first')
+    other = message('other', 1, mail_tm_id='mt-1', subject='other inbox')
+    assert store.add(other) is other
+
+    assert subjects(store.for_inbox('inbox')) == ['first']
+    assert store.has_mail_tm_id('inbox', 'mt-1')
+    assert store.find_by_mail_tm_id('inbox', 'mt-1').id == first.id
+    assert subjects(store.for_inbox('other')) == ['other inbox']
+
+
+def test_max_per_inbox_trims_oldest(make_store):
+    store = make_store(max_per_inbox=2)
+    for minute in (1, 3, 0, 2):
+        store.add(message('inbox', minute))
+
+    assert subjects(store.for_inbox('inbox')) == ['m3', 'm2']
+    assert store.count_for_inbox('inbox') == 2
+
+
+def test_messages_since_returns_later_additions(make_store):
+    store = make_store()
+    store.add(message('inbox', 0))
+    since = store.inbox_version('inbox')
+    assert store.messages_since('inbox', since) == []
+
+    store.add(message('inbox', 2))
+    store.add(message('inbox', 1))
+    store.add(message('other', 3))
+
+    assert store.inbox_version('inbox') > since
+    assert subjects(store.messages_since('inbox', since)) == ['m2', 'm1']
+    assert subjects(store.messages_since('inbox', since, newest_first=False)) == ['m1', 'm2']
+    assert subjects(store.messages_since('inbox', 0, newest_first=False)) == ['m0', 'm1', 'm2']
+
+
+def test_remove_and_delete_for_inbox(make_store):
+    store = make_store()
+    kept = store.add(message('inbox', 0))
+    dropped = store.add(message('inbox', 1))
+    store.add(message('other', 0))
+    version = store.inbox_version('inbox')
+
+    assert store.remove(dropped.id).id == dropped.id
+    assert store.remove(dropped.id) is None
+    assert store.inbox_version('inbox') > version
+    assert [msg.id for msg in store.for_inbox('inbox')] == [kept.id]
+
+    assert store.delete_for_inbox('inbox') == 1
+    assert store.for_inbox('inbox') == []
+    assert store.count_for_inbox('other') == 1
+
+
+def test_latest_with_codes(make_store):
+    store = make_store(max_per_inbox=3)
+    assert store.latest_with_codes('inbox') is None
+
+    coded = message('inbox', 1, subject='code')
+    coded.verification_codes = ('123456',)
+    store.add(coded)
+    store.add(message('inbox', 2))
+    older = message('inbox', 0, subject='older code')
+    older.verification_codes = ('654321',)
+    store.add(older)
+    assert store.latest_with_codes('inbox').subject == 'code'
+
+    store.remove(coded.id)
+    assert store.latest_with_codes('inbox').subject == 'older code'
+    store.delete_for_inbox('inbox')
+    assert store.latest_with_codes('inbox') is None
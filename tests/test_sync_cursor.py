@@ -0,0 +1,103 @@
+from mail_tm_service import MailTMService, SyncCursor, parse_created_at
+
+
+def listing(msg_id, minute):
+    return {'id': msg_id, 'createdAt': f'2024-01-01T12:{minute:02d}:00+00:00'}
+
+
+def test_failed_item_mid_page_holds_back_watermark():
+    cursor = SyncCursor()
+    newest, failed, oldest = listing('m3', 3), listing('m2', 2), listing('m1', 1)
+
+    # mail.tm lists newest first; the middle message could not be fetched
+    cursor.advance([newest, oldest], failed=[failed])
+
+    assert cursor.watermark == parse_created_at(failed['createdAt'])
+    assert cursor.last_seen_id == 'm3'
+    assert cursor.classify(newest) == SyncCursor.SEEN
+    assert cursor.classify(failed) == SyncCursor.NEW
+    assert cursor.classify(oldest) == SyncCursor.OLDER
+
+    # Once the failed message is stored the watermark catches up
+    cursor.advance([failed])
+    assert cursor.watermark == parse_created_at(newest['createdAt'])
+    assert cursor.classify(newest) == SyncCursor.SEEN
+    assert cursor.classify(failed) == SyncCursor.OLDER
+    assert cursor.classify(listing('m4', 4)) == SyncCursor.NEW
+
+
+def test_failed_item_without_date_keeps_watermark():
+    cursor = SyncCursor()
+    cursor.advance([listing('m1', 1)])
+    watermark = cursor.watermark
+
+    cursor.advance([listing('m3', 3)], failed=[{'id': 'm2', 'createdAt': None}])
+    assert cursor.watermark == watermark
+    assert cursor.classify({'id': 'm2', 'createdAt': None}) == SyncCursor.NEW
+    assert cursor.classify(listing('m3', 3)) == SyncCursor.SEEN
+
+
+def test_watermark_never_moves_back():
+    cursor = SyncCursor()
+    cursor.advance([listing('m5', 5)])
+    cursor.advance([], failed=[listing('m2', 2)])
+    assert cursor.watermark == parse_created_at(listing('m5', 5)['createdAt'])
+
+
+class PagedService(MailTMService):
+    """mail.tm listing of ``messages`` newest first, 30 per page"""
+
+    def __init__(self, messages, failing_pages=()):
+        super().__init__()
+        self.messages = messages
+        self.failing_pages = set(failing_pages)
+
+    def get_messages_page(self, token, page=1, account=None):
+        if page in self.failing_pages:
+            self.failing_pages.discard(page)
+            return None, False
+        start = (page - 1) * 30
+        return self.messages[start:start + 30], start + 30 < len(self.messages)
+
+
+def sync(service, cursor, stored):
+    new_items, known_items, complete = service.get_new_messages('token', cursor)
+    stored.update(msg['id'] for msg in new_items)
+    cursor.advance(new_items + known_items, complete=complete)
+    return len(new_items), complete
+
+
+def inbox(count):
+    # Newest first, one minute apart
+    return [{'id': f'm{minute}', 'createdAt': f'2024-01-01T{minute // 60:02d}:{minute % 60:02d}:00+00:00'}
+            for minute in range(count - 1, -1, -1)]
+
+
+def test_failed_page_is_read_on_the_next_sync():
+    service = PagedService(inbox(60), failing_pages=[2])
+    cursor = SyncCursor()
+    stored = set()
+
+    assert sync(service, cursor, stored) == (30, False)
+    assert cursor.watermark is None
+    assert sync(service, cursor, stored) == (30, True)
+    assert stored == {msg['id'] for msg in service.messages}
+
+    service.messages.insert(0, {'id': 'm60', 'createdAt': '2024-01-01T01:00:00+00:00'})
+    assert sync(service, cursor, stored) == (1, True)
+    assert sync(service, cursor, stored) == (0, True)
+
+
+def test_page_limit_keeps_unread_pages_new():
+    service = PagedService(inbox(60))
+    service.sync_max_pages = 1
+    cursor = SyncCursor()
+    stored = set()
+
+    assert sync(service, cursor, stored) == (30, False)
+    assert cursor.watermark is None
+    assert all(cursor.classify(msg) == SyncCursor.NEW for msg in service.messages[30:])
+
+    service.sync_max_pages = 2
+    assert sync(service, cursor, stored) == (30, True)
+    assert len(stored) == 60
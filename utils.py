@@ -21,24 +21,58 @@ SPAM_SENDER_PATTERNS = [
     r'.*\d{8,}@.*'
 ]
 
-def is_spam_email(sender: str, subject: str, body: str) -> bool:
-    """Simple spam detection based on keywords and patterns"""
+class SpamMatcher:
+    """Precompiled spam classifier
     
-    # Check sender patterns
-    for pattern in SPAM_SENDER_PATTERNS:
-        if re.search(pattern, sender.lower()):
-            return True
+    All sender patterns are combined into one alternation regex and all
+    keywords into one lookahead regex, so classifying a message is one scan
+    of the sender and one scan of the content. A message is spam if its
+    sender matches a pattern or its subject and body contain at least
+    ``keyword_threshold`` different keywords.
+    """
     
-    # Check content for spam keywords
-    content = f"{subject} {body}".lower()
-    spam_count = 0
+    def __init__(self, keywords, sender_patterns, keyword_threshold=2):
+        self.keyword_threshold = keyword_threshold
+        self.sender_re = re.compile('|'.join(f'(?:{pattern})' for pattern in sender_patterns))
+        # Zero-width lookahead so overlapping keywords are all found
+        self.keyword_re = re.compile('(?=(%s))' % '|'.join(
+            map(re.escape, sorted(keywords, key=len, reverse=True))
+        ))
+    
+    def is_spam(self, sender: str, subject: str, body: str) -> bool:
+        if self.sender_re.search(sender.lower()):
+            return True
+        return self._has_spam_keywords(f"{subject} {body}".lower())
     
-    for keyword in SPAM_KEYWORDS:
-        if keyword in content:
-            spam_count += 1
+    def _has_spam_keywords(self, content: str) -> bool:
+        found = set()
+        for match in self.keyword_re.finditer(content):
+            found.add(match.group(1))
+            if len(found) >= self.keyword_threshold:
+                return True
+        return False
     
-    # If more than 2 spam keywords found, mark as spam
-    return spam_count >= 2
+    def classify_batch(self, messages) -> List[bool]:
+        """Classify many ``(sender, subject, body)`` tuples at once
+        
+        Senders repeat a lot within one sync, so each distinct sender is
+        only matched once per batch.
+        """
+        sender_verdicts = {}
+        results = []
+        for sender, subject, body in messages:
+            sender = (sender or '').lower()
+            if sender not in sender_verdicts:
+                sender_verdicts[sender] = bool(self.sender_re.search(sender))
+            results.append(sender_verdicts[sender]
+                           or self._has_spam_keywords(f"{subject or ''} {body or ''}".lower()))
+        return results
+
+spam_matcher = SpamMatcher(SPAM_KEYWORDS, SPAM_SENDER_PATTERNS)
+
+def is_spam_email(sender: str, subject: str, body: str) -> bool:
+    """Simple spam detection based on keywords and patterns"""
+    return spam_matcher.is_spam(sender, subject, body)
 
 def generate_random_string(length: int = 8) -> str:
     """Generate a random string for email addresses"""